@@ -0,0 +1,60 @@
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import requests
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+def summarize(samples):
+    return {
+        'iterations': len(samples),
+        'mean_ms': sum(samples) / len(samples),
+        'p50_ms': percentile(samples, 50),
+        'p99_ms': percentile(samples, 99),
+        'max_ms': max(samples),
+    }
+
+def measure(fn, iterations, warmup=50):
+    # warm up connections and caches before timing
+    for i in range(min(warmup, iterations)):
+        fn()
+
+    samples = []
+    for i in range(iterations):
+        start = time.time()
+        fn()
+        samples.append((time.time() - start) * 1000)
+    return summarize(samples)
+
+def start_server(port, unix_socket=None):
+    command = [sys.executable, '-m', 'ctrlk.ctrlk_server', '-p', str(port)]
+    if unix_socket is not None:
+        command += ['-u', unix_socket]
+    return subprocess.Popen(command)
+
+def stop_server(server):
+    server.terminate()
+    server.wait()
+
+def wait_for_server(api, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            api.safe_get('')
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise Exception("ctrlk_server did not come up in %s seconds" % timeout)
+
+def environment():
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.sysconf('SC_NPROCESSORS_ONLN'),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
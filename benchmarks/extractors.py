@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# Compares the two ways the indexer extracts entries from a parsed file: the AST visitor and
+# libclang's index action. Generates a synthetic project (see gen_project.py), indexes it from
+# scratch once per extractor with python -m ctrlk.index, and reports, as JSON:
+#
+#   - full index time and index size on disk
+#   - the number of entries per key prefix
+#   - the entries that only one of the extractors wrote, per key prefix
+#
+#   python benchmarks/extractors.py --library-path /usr/lib/llvm/lib -j 8 -o results.json
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import gen_project
+from bench_util import environment
+from ctrlk import indexer
+from ctrlk.project import EXTRACTORS
+from run_benchmarks import directory_size
+
+# how many of the entries that differ to list per prefix
+EXAMPLES = 5
+
+def key_prefix(key):
+    return key[:key.find('%%%')]
+
+def run_indexer(options, root, extractor):
+    command = [sys.executable, '-m', 'ctrlk.index', '--library-path', options.library_path,
+               '--extractor', extractor, '--no-compact', '-q', root]
+    if options.jobs:
+        command += ['-j', str(options.jobs)]
+    start = time.time()
+    subprocess.check_call(command)
+    return time.time() - start
+
+def read_keys(index_path):
+    conn = indexer.LevelDB(index_path, create_if_missing=False)
+    # f%%% holds mtimes and x%%%/slow%%% hold timings, neither says anything about the extractor
+    return set(key for key in conn.RangeIter(None, None, include_value=False)
+               if key_prefix(key) not in ('f', 'x', 'slow'))
+
+def count_by_prefix(keys):
+    ret = {}
+    for key in keys:
+        ret[key_prefix(key)] = ret.get(key_prefix(key), 0) + 1
+    return ret
+
+def examples_by_prefix(keys):
+    ret = {}
+    for key in sorted(keys):
+        examples = ret.setdefault(key_prefix(key), [])
+        if len(examples) < EXAMPLES:
+            examples.append(key)
+    return ret
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--library-path', dest='library_path', required=True)
+    parser.add_argument('--project', dest='project', default=None,
+                        help='where to generate the project, a temporary directory by default')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=None)
+    parser.add_argument('-o', '--output', dest='output', default=None)
+    gen_project.add_arguments(parser)
+    options = parser.parse_args()
+
+    root = options.project or tempfile.mkdtemp(prefix='ctrlk-bench-')
+    index_path = os.path.join(root, '.ctrlk-index')
+    config = gen_project.generate_from_options(root, options)
+
+    results = {}
+    keys = {}
+    for extractor in sorted(EXTRACTORS):
+        if os.path.exists(index_path):
+            shutil.rmtree(index_path)
+        seconds = run_indexer(options, root, extractor)
+        keys[extractor] = read_keys(index_path)
+        results[extractor] = {
+            'full_index_seconds': seconds,
+            'index_bytes': directory_size(index_path),
+            'entries': count_by_prefix(keys[extractor]),
+        }
+
+    only_visitor = keys['visitor'] - keys['index_action']
+    only_index_action = keys['index_action'] - keys['visitor']
+    results['difference'] = {
+        'only_visitor': count_by_prefix(only_visitor),
+        'only_index_action': count_by_prefix(only_index_action),
+        'only_visitor_examples': examples_by_prefix(only_visitor),
+        'only_index_action_examples': examples_by_prefix(only_index_action),
+    }
+    results['speedup'] = results['visitor']['full_index_seconds'] / results['index_action']['full_index_seconds']
+
+    output = json.dumps({'environment': environment(), 'project': config, 'results': results}, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    print output
+
+if __name__ == '__main__':
+    main()
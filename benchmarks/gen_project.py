@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+# Generates a synthetic C++ project for benchmarking the indexer, together with a matching
+# compile_commands.json. The shape is deterministic for a given set of options and seed.
+#
+#   python benchmarks/gen_project.py /tmp/bench-project --files 200 --headers 50 --fanout 8
+
+import argparse
+import json
+import os
+import random
+
+def header_name(i):
+    return 'h_%d.h' % i
+
+def source_name(i):
+    return 'f_%d.cpp' % i
+
+def template_chain(depth):
+    lines = [
+        'template <int N> struct Depth {',
+        '    typedef typename Depth<N - 1>::type type;',
+        '    static int value() { return Depth<N - 1>::value() + 1; }',
+        '};',
+        'template <> struct Depth<0> {',
+        '    typedef int type;',
+        '    static int value() { return 0; }',
+        '};',
+        'static const int kDepth%d = Depth<%d>::value();' % (depth, depth),
+    ]
+    return '\n'.join(lines)
+
+def generate_header(i, includes, template_depth):
+    lines = ['#pragma once', '']
+    lines += ['#include "%s"' % header_name(j) for j in includes]
+    lines += ['', 'namespace bench_%d {' % i, '']
+    if i == 0:
+        lines += [template_chain(template_depth), '']
+    lines += [
+        'class Class_%d {' % i,
+        'public:',
+        '    Class_%d() : value_(%d) {}' % (i, i),
+        '    int method_%d(int x) const { return x + value_; }' % i,
+        '    int other_method_%d() const;' % i,
+        'private:',
+        '    int value_;',
+        '};',
+        '',
+        'template <typename T> T identity_%d(T x) { return x; }' % i,
+        '',
+        'int free_function_%d(int x);' % i,
+        '',
+        '}',
+    ]
+    return '\n'.join(lines) + '\n'
+
+def generate_source(i, includes, n_functions):
+    lines = ['#include "%s"' % header_name(j) for j in includes]
+    lines += ['', 'namespace src_%d {' % i, '']
+    for f in range(n_functions):
+        body = []
+        for j in includes:
+            body.append('    bench_%d::Class_%d c%d;' % (j, j, j))
+            body.append('    total += c%d.method_%d(total);' % (j, j))
+            body.append('    total += bench_%d::identity_%d<int>(total);' % (j, j))
+        lines.append('int function_%d_%d(int total) {' % (i, f))
+        lines += body
+        lines.append('    return total;')
+        lines.append('}')
+        lines.append('')
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+def generate(root, n_files, n_headers, fanout, template_depth, n_functions, seed):
+    rng = random.Random(seed)
+    root = os.path.abspath(root)
+    include_dir = os.path.join(root, 'include')
+    source_dir = os.path.join(root, 'src')
+    for d in [include_dir, source_dir]:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+
+    # headers only include lower numbered headers, so the include graph is a DAG
+    for i in range(n_headers):
+        includes = sorted(rng.sample(range(i), min(i, max(1, fanout / 4)))) if i > 0 else []
+        with open(os.path.join(include_dir, header_name(i)), 'w') as f:
+            f.write(generate_header(i, includes, template_depth))
+
+    compile_commands = []
+    for i in range(n_files):
+        # every source reaches header 0, which holds the template chain
+        includes = sorted(set(rng.sample(range(n_headers), min(n_headers, fanout))) | set([0]))
+        file_name = os.path.join(source_dir, source_name(i))
+        with open(file_name, 'w') as f:
+            f.write(generate_source(i, includes, n_functions))
+        compile_commands.append({
+            'directory': root,
+            'command': 'clang++ -std=c++11 -I%s -c %s -o /dev/null' % (include_dir, file_name),
+            'file': file_name,
+        })
+
+    with open(os.path.join(root, 'compile_commands.json'), 'w') as f:
+        json.dump(compile_commands, f, indent=1)
+
+    return {
+        'root': root,
+        'files': n_files,
+        'headers': n_headers,
+        'fanout': fanout,
+        'template_depth': template_depth,
+        'functions_per_file': n_functions,
+        'seed': seed,
+    }
+
+def add_arguments(parser):
+    parser.add_argument('--files', dest='files', type=int, default=100)
+    parser.add_argument('--headers', dest='headers', type=int, default=30)
+    parser.add_argument('--fanout', dest='fanout', type=int, default=8)
+    parser.add_argument('--template-depth', dest='template_depth', type=int, default=16)
+    parser.add_argument('--functions', dest='functions', type=int, default=10)
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+
+def generate_from_options(root, options):
+    return generate(root, options.files, options.headers, options.fanout, options.template_depth,
+                    options.functions, options.seed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root')
+    add_arguments(parser)
+    options = parser.parse_args()
+    print json.dumps(generate_from_options(options.root, options), indent=2, sort_keys=True)
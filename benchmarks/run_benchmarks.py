@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+# End to end CtrlK benchmark. Generates a synthetic project (see gen_project.py), indexes it
+# through a ctrlk_server and reports, as JSON:
+#
+#   - full index time, the size of .ctrlk-index afterwards and the indexer stats, which include the
+#     writes that extraction skipped as duplicates
+#   - incremental reindex time after touching some sources and a header
+#   - /match latency percentiles for a set of prefixes
+#   - get_usr_under_cursor latency percentiles on a parsed current file
+#
+#   python benchmarks/run_benchmarks.py --library-path /usr/lib/llvm/lib -o results.json
+
+import argparse
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import gen_project
+from bench_util import environment, measure, start_server, stop_server, wait_for_server
+from ctrlk import client_api
+
+MATCH_PREFIXES = ['class_1', 'method', 'function_1', 'identity', 'f_1', 'depth', 'zzz']
+
+def directory_size(path):
+    total = 0
+    for dir_path, dir_names, file_names in os.walk(path):
+        for file_name in file_names:
+            total += os.path.getsize(os.path.join(dir_path, file_name))
+    return total
+
+# the queue size alone drops to 0 while the last files are still being parsed
+def wait_for_indexing(api, poll_seconds=0.05):
+    while api.get_indexer_stats()['outstanding'] > 0:
+        time.sleep(poll_seconds)
+
+def timed_index(api):
+    start = time.time()
+    api.parse()
+    wait_for_indexing(api)
+    return time.time() - start
+
+# bumps the mtime so that the indexer sees the files as changed without changing their content
+def touch(file_names):
+    now = time.time() + 2
+    for file_name in file_names:
+        os.utime(file_name, (now, now))
+
+def identifier_positions(file_name, pattern, limit):
+    ret = []
+    with open(file_name) as f:
+        for line_number, line in enumerate(f, 1):
+            for m in re.finditer(pattern, line):
+                ret.append((line_number, m.start() + 1))
+                if len(ret) >= limit:
+                    return ret
+    return ret
+
+def wait_for_current_file(api, file_name, row, col, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if api.get_usr_under_cursor(file_name, row, col):
+            return
+        time.sleep(0.1)
+    raise Exception("%s was not parsed in %s seconds" % (file_name, timeout))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--library-path', dest='library_path', required=True)
+    parser.add_argument('--project', dest='project', default=None,
+                        help='where to generate the project, a temporary directory by default')
+    parser.add_argument('--touch', dest='touch', type=int, default=5,
+                        help='number of sources to touch for the incremental reindex')
+    parser.add_argument('-n', '--iterations', dest='iterations', type=int, default=200)
+    parser.add_argument('-p', '--port', dest='port', type=int, default=client_api.DEFAULT_PORT + 101)
+    parser.add_argument('--cursor-table', dest='cursor_table', action='store_true', default=False)
+    parser.add_argument('-o', '--output', dest='output', default=None)
+    gen_project.add_arguments(parser)
+    options = parser.parse_args()
+
+    root = options.project or tempfile.mkdtemp(prefix='ctrlk-bench-')
+    index_path = os.path.join(root, '.ctrlk-index')
+    if os.path.exists(index_path):
+        shutil.rmtree(index_path)
+    config = gen_project.generate_from_options(root, options)
+
+    results = {}
+    server = start_server(options.port)
+    try:
+        api = client_api.CtrlKApi(port=options.port)
+        wait_for_server(api)
+        api.register(options.library_path, root, cursor_table=options.cursor_table)
+
+        results['full_index_seconds'] = timed_index(api)
+        results['index_bytes'] = directory_size(index_path)
+        results['full_index_stats'] = api.get_indexer_stats()
+
+        sources = [os.path.join(root, 'src', gen_project.source_name(i)) for i in range(options.files)]
+        touch(sources[:options.touch] + [os.path.join(root, 'include', gen_project.header_name(0))])
+        results['incremental_index_seconds'] = timed_index(api)
+        results['incremental_touched_files'] = min(options.touch, options.files) + 1
+
+        results['match'] = {}
+        for prefix in MATCH_PREFIXES:
+            results['match'][prefix] = measure(lambda: api.get_items_matching_pattern(prefix, 30), options.iterations)
+
+        current_file = sources[0]
+        with open(current_file) as f:
+            content = f.read()
+        api.parse_current_file(api.get_file_args(current_file), current_file, content)
+
+        positions = identifier_positions(current_file, r'method_\d+|Class_\d+|identity_\d+', 50)
+        wait_for_current_file(api, current_file, positions[0][0], positions[0][1])
+
+        state = {'i': 0}
+        def query_next_position():
+            row, col = positions[state['i'] % len(positions)]
+            state['i'] += 1
+            api.get_usr_under_cursor(current_file, row, col)
+        results['get_usr_under_cursor'] = measure(query_next_position, options.iterations)
+    finally:
+        stop_server(server)
+
+    output = json.dumps({'environment': environment(), 'project': config, 'results': results}, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    print output
+
+if __name__ == '__main__':
+    main()
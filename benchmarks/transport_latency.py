@@ -0,0 +1,50 @@
+#!/usr/bin/python
+
+# Measures round trip latency of a trivial request (the ping handler) for each way a
+# client can talk to ctrlk_server: a new TCP connection per call (what CtrlKApi used to
+# do), a keep-alive TCP session, and a keep-alive session over a Unix domain socket.
+#
+#   python benchmarks/transport_latency.py [-n 2000] [-o results.json]
+
+import argparse
+import json
+import os
+import tempfile
+
+import requests
+
+from bench_util import environment, measure, start_server, stop_server, wait_for_server
+from ctrlk import client_api
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--iterations', dest='iterations', type=int, default=2000)
+    parser.add_argument('-p', '--port', dest='port', type=int, default=client_api.DEFAULT_PORT + 100)
+    parser.add_argument('-o', '--output', dest='output', default=None)
+    options = parser.parse_args()
+
+    socket_path = os.path.join(tempfile.mkdtemp(), 'ctrlk.sock')
+    server = start_server(options.port, socket_path)
+    try:
+        tcp_api = client_api.CtrlKApi(port=options.port)
+        unix_api = client_api.CtrlKApi(unix_socket=socket_path)
+        wait_for_server(tcp_api)
+        wait_for_server(unix_api)
+
+        fresh_url = tcp_api.get_url('')
+        results = {
+            'tcp_new_connection': measure(lambda: requests.get(fresh_url), options.iterations),
+            'tcp_keep_alive': measure(lambda: tcp_api.safe_get(''), options.iterations),
+            'unix_socket_keep_alive': measure(lambda: unix_api.safe_get(''), options.iterations),
+        }
+    finally:
+        stop_server(server)
+
+    output = json.dumps({'environment': environment(), 'results': results}, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    print output
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,16 @@
 import collections
+import contextlib
 
 import json
 import os
 import requests
+import requests.adapters
+import socket
+
+from ctrlk import search
+
+from requests.packages.urllib3 import connection as urllib3_connection
+from requests.packages.urllib3 import connectionpool as urllib3_connectionpool
 
 DEFAULT_PORT=7934
 
@@ -12,6 +20,12 @@ class ApiException(Exception):
     def __str__(self):
         return "API Exception: %s, %s" % (self.response.status_code, self.response.content)
 
+class BatchException(Exception):
+    def __init__(self, error):
+        self.error = error
+    def __str__(self):
+        return "Batch operation failed: %s" % (self.error)
+
 def convert(data):
     if isinstance(data, basestring):
         return data.encode('utf-8')
@@ -22,14 +36,140 @@ def convert(data):
     else:
         return data
 
+# Placeholder for the result of a call made inside CtrlKApi.batch(). The value is
+#    available once the batch is flushed, when the `with` block exits.
+class BatchResult(object):
+    def __init__(self):
+        self.done = False
+        self._value = None
+        self._error = None
+
+    @property
+    def value(self):
+        if not self.done:
+            raise BatchException("the batch has not been flushed yet")
+        if self._error is not None:
+            raise BatchException(self._error)
+        return self._value
+
+class Batch(object):
+    def __init__(self, api):
+        self.api = api
+        self.ops = []
+        self.results = []
+
+    def add(self, op, args, decode):
+        result = BatchResult()
+        self.ops.append({'op': op, 'args': args})
+        self.results.append((result, decode))
+        return result
+
+    def flush(self):
+        if not self.ops:
+            return
+        ops, results = self.ops, self.results
+        self.ops, self.results = [], []
+
+        r = self.api.safe_post('batch', data={'ops': json.dumps(ops)})
+        for (result, decode), response in zip(results, r.json()):
+            if 'error' in response:
+                result._error = convert(response['error'])
+            else:
+                result._value = decode(response['result'])
+            result.done = True
+
+# HTTP over a Unix domain socket, for the server's --unix-socket transport. requests only
+#    speaks TCP, so this plugs a connection pool that connects to the socket path into a
+#    transport adapter, mounted for the http+unix:// scheme.
+class UnixSocketConnection(urllib3_connection.HTTPConnection):
+    def __init__(self, socket_path, *args, **kwargs):
+        self.socket_path = socket_path
+        urllib3_connection.HTTPConnection.__init__(self, 'localhost', *args, **kwargs)
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+class UnixSocketConnectionPool(urllib3_connectionpool.HTTPConnectionPool):
+    def __init__(self, socket_path, **kwargs):
+        urllib3_connectionpool.HTTPConnectionPool.__init__(self, 'localhost', **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        return UnixSocketConnection(self.socket_path, timeout=self.timeout.connect_timeout)
+
+class UnixSocketAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, socket_path, pool_size=10):
+        requests.adapters.HTTPAdapter.__init__(self)
+        self.socket_path = socket_path
+        self.unix_pool = UnixSocketConnectionPool(socket_path, maxsize=pool_size)
+
+    def get_connection(self, url, proxies=None):
+        return self.unix_pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.unix_pool
+
+    def close(self):
+        requests.adapters.HTTPAdapter.close(self)
+        self.unix_pool.close()
+
+def encode(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+# Decoders for the format=compact responses. They rebuild exactly what convert() returns for
+#    the default format, in a single flat pass over the columns.
+def decode_matches(data):
+    if isinstance(data, list):
+        return convert(data)
+    if 'message' in data:
+        if 'truncated' in data:
+            return [[encode(data['message'])], [], data['truncated']]
+        return [[encode(data['message'])], []]
+
+    paths = [encode(path) for path in data['paths']]
+    ret = []
+    locations = []
+    for ordinal, (name, use_type, path_id, line, col) in enumerate(zip(
+            data['names'], data['use_types'], data['path_ids'], data['lines'], data['cols'])):
+        path = paths[path_id]
+        if name is None:
+            ret.append(search.format_file_item(path, ordinal))
+        else:
+            ret.append(search.format_symbol_item(encode(name), use_type, path, ordinal))
+        locations.append([path, line, col])
+    if 'truncated' in data:
+        return [ret, locations, data['truncated']]
+    return [ret, locations]
+
+def decode_leveldb_search(data):
+    if isinstance(data, list):
+        return convert(data)
+    prefix = encode(data['prefix'])
+    return [[prefix + encode(key), encode(value)] for key, value in zip(data['keys'], data['values'])]
+
 class CtrlKApi(object):
-    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT):
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, unix_socket=None):
         self.host=host
         self.port=port
+        self.unix_socket = unix_socket
         self.project_root = None
+        self._batch = None
+
+        # one keep-alive session per client, instead of a new TCP connection per call
+        self.session = requests.Session()
+        if self.unix_socket is not None:
+            self.session.mount('http+unix://', UnixSocketAdapter(self.unix_socket))
 
     @property
     def base_url(self):
+        if self.unix_socket is not None:
+            return 'http+unix://ctrlk'
         return 'http://' + self.host + ':' + str(self.port)
 
     def get_url(self, path):
@@ -40,7 +180,7 @@ class CtrlKApi(object):
             if 'params' not in kwargs:
                 kwargs['params'] = {}
             kwargs['params']['project_root'] = self.project_root
-        r = requests.get(self.get_url(path), *args, **kwargs)
+        r = self.session.get(self.get_url(path), *args, **kwargs)
         if not r.ok:
             assert r.status_code != 200
             raise ApiException(r)
@@ -51,14 +191,43 @@ class CtrlKApi(object):
             if 'data' not in kwargs:
                 kwargs['data'] = {}
             kwargs['data']['project_root'] = self.project_root
-        r = requests.post(self.get_url(path), *args, **kwargs)
+        r = self.session.post(self.get_url(path), *args, **kwargs)
         if not r.ok:
             assert r.status_code != 200
             raise ApiException(r)
         return r
 
-    def register(self, library_path, project_root):
-        self.safe_get('register', params={'project_root' : project_root, 'library_path' : library_path})
+    # Inside `with api.batch():` the calls below are queued instead of sent, and return a
+    #    BatchResult. All of them go to the server in one request when the block exits.
+    @contextlib.contextmanager
+    def batch(self):
+        if self._batch is not None:
+            yield self._batch
+            return
+
+        self._batch = Batch(self)
+        try:
+            yield self._batch
+            self._batch.flush()
+        finally:
+            self._batch = None
+
+    def call(self, path, payload, post=False, decode=convert):
+        if self._batch is not None:
+            return self._batch.add(path, payload, decode)
+        if post:
+            r = self.safe_post(path, data=payload)
+        else:
+            r = self.safe_get(path, params=payload)
+        if not r.content:
+            return None
+        return decode(r.json())
+
+    def register(self, library_path, project_root, cursor_table=False):
+        payload = {'project_root' : project_root, 'library_path' : library_path}
+        if cursor_table:
+            payload['cursor_table'] = '1'
+        self.safe_get('register', params=payload)
         self.project_root = project_root
         return None
 
@@ -66,35 +235,99 @@ class CtrlKApi(object):
         payload = {}
         if file_name:
             payload['file_name'] = file_name
-        self.safe_get('parse', params=payload)
+        return self.call('parse', payload)
 
     def get_queue_size(self):
-        return convert(self.safe_get('queue_size').json())
+        return self.call('queue_size', {})
+
+    def get_indexer_stats(self):
+        return self.call('indexer_stats', {})
+
+    def get_parse_failures(self):
+        return self.call('parse_failures', {})
+
+    def get_slow_files(self):
+        return self.call('slow_files', {})
+
+    def get_scope_stats(self):
+        return self.call('scope_stats', {})
+
+    def get_compaction_status(self):
+        return self.call('compaction_status', {})
+
+    # compacts the given key prefixes, e.g. ['s', 'c'], or all the ones with deleted keys
+    def compact(self, prefixes=None):
+        payload = {}
+        if prefixes:
+            payload['prefixes'] = ','.join(prefixes)
+        return self.call('compact', payload)
+
+    # changes the given options of the worker pool shared by all projects, e.g.
+    #    api.get_pool(background=1, pool_size=4), and returns its state
+    def get_pool(self, **options):
+        return self.call('pool', options)
+
+    # Yields a progress snapshot (see progress.ProgressFeed.snapshot) every time the indexer
+    #    reports events. Between events it waits in a single long-poll request.
+    def subscribe_progress(self, since=0, wait=300):
+        while True:
+            progress = convert(self.safe_get('progress', params={'since': since, 'wait': wait}).json())
+            since = progress['seq']
+            if progress['events']:
+                yield progress
 
     def leveldb_search(self, starts_with):
-        return convert(self.safe_get('leveldb_search', params={'starts_with' : starts_with}).json())
+        payload = {'starts_with' : starts_with, 'format' : 'compact'}
+        return self.call('leveldb_search', payload, decode=decode_leveldb_search)
+
+    # ranked=True orders the symbols of each kind of match by how often they are referenced, and
+    #    adds a third element, True if more items matched than limit (see search.rank_items_matching_pattern)
+    def get_items_matching_pattern(self, prefix, limit, ranked=False):
+        payload = {'prefix' : prefix, 'limit' : limit, 'format' : 'compact'}
+        if ranked:
+            payload['rank'] = 1
+        return self.call('match', payload, decode=decode_matches)
 
-    def get_items_matching_pattern(self, prefix, limit):
-        return convert(self.safe_get('match', params={'prefix' : prefix, 'limit' : limit}).json())
+    # (refs, defs, files) of a symbol across the index
+    def get_symbol_counts(self, symbol):
+        return self.call('symbol_counts', {'symbol' : symbol})
+
+    # the call graph edges around a function, see search.walk_graph
+    def get_callers(self, symbol, depth=1, limit=100):
+        return self.call('callers', {'symbol' : symbol, 'depth' : depth, 'limit' : limit})
+
+    def get_callees(self, symbol, depth=1, limit=100):
+        return self.call('callees', {'symbol' : symbol, 'depth' : depth, 'limit' : limit})
+
+    # the type hierarchy around a class, in the same form
+    def get_subtypes(self, symbol, depth=1, limit=100):
+        return self.call('subtypes', {'symbol' : symbol, 'depth' : depth, 'limit' : limit})
+
+    def get_supertypes(self, symbol, depth=1, limit=100):
+        return self.call('supertypes', {'symbol' : symbol, 'depth' : depth, 'limit' : limit})
 
     def get_builtin_header_path(self):
-        return convert(self.safe_get('builtin_header_path').json())
+        return self.call('builtin_header_path', {})
 
     def get_file_args(self, file_name):
-        return convert(self.safe_get('file_args', params={'file_name' : file_name}).json())
+        return self.call('file_args', {'file_name' : file_name})
 
     def parse_current_file(self, command, file_name, content):
         payload = {'command': json.dumps(command), 'file_name': file_name, 'content': content}
-        self.safe_post('parse_current_file', data=payload)
+        return self.call('parse_current_file', payload, post=True)
 
     def unload_current_file(self, file_name):
         payload = {'file_name': file_name}
-        self.safe_get('unload_current_file', params=payload)
+        return self.call('unload_current_file', payload)
 
     def get_usr_under_cursor(self, file_name, row, col):
         payload = {'file_name': file_name, 'row': row, 'col': col}
-        return convert(self.safe_get('get_usr_under_cursor', params=payload).json())
+        return self.call('get_usr_under_cursor', payload)
+
+    def get_usrs_under_cursor(self, file_name, positions):
+        payload = {'file_name': file_name, 'positions': json.dumps(positions)}
+        return self.call('get_usrs_under_cursor', payload)
 
     def get_current_scope_str(self, file_name, row):
         payload = {'file_name': file_name, 'row': row}
-        return convert(self.safe_get('get_current_scope_str', params=payload).json())
+        return self.call('get_current_scope_str', payload)
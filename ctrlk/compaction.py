@@ -0,0 +1,146 @@
+import collections
+import sys
+import threading
+import time
+
+from ctrlk import indexer
+
+POLL_SECONDS = 5
+
+# a key prefix is compacted once this many of its keys were deleted since its last compaction
+DELETED_KEYS_THRESHOLD = 100000
+
+# with nothing queued for this long, the hot prefixes are compacted even without a bulk index
+IDLE_SECONDS = 60
+
+# after compacting a prefix, the scheduler pauses this many times as long as the compaction took
+THROTTLE_FACTOR = 1.0
+
+MAX_HISTORY = 50
+
+def prefix_range(prefix):
+    return prefix + '%%%', prefix + '%%^'
+
+# Reindexing a file deletes all of its entries before writing them again, and the tombstones slow
+#    down the scans of search.py until LevelDB compacts them away. This follows the deleted keys
+#    per key prefix (see indexer.deleted_keys) on a background thread, and compacts the ranges of
+#    the prefixes with the most tombstones once a bulk index is done, or while the indexer idles.
+#    One prefix is compacted at a time, with a pause after each, and a scheduled compaction stops
+#    as soon as files are queued again.
+class CompactionScheduler(object):
+    def __init__(self, project, threshold=DELETED_KEYS_THRESHOLD, idle_seconds=IDLE_SECONDS):
+        self.project = project
+        self.threshold = threshold
+        self.idle_seconds = idle_seconds
+
+        self.lock = threading.Lock()
+        self.compact_lock = threading.Lock()
+        # prefix => deleted keys at its last compaction
+        self.compacted_at = {}
+        self.history = collections.deque(maxlen=MAX_HISTORY)
+        self.running = None
+        self.last_busy = time.time()
+        self.indexed_since_compaction = False
+
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def deleted_keys(self):
+        if not self.project.indexer_running:
+            return {}
+        return indexer.deleted_keys(self.project.indexer_id)
+
+    # prefix => keys deleted since the prefix was last compacted
+    def pending(self):
+        counts = self.deleted_keys()
+        with self.lock:
+            return dict((prefix, count - self.compacted_at.get(prefix, 0)) for prefix, count in counts.iteritems())
+
+    def hot_prefixes(self):
+        pending = self.pending()
+        return sorted((prefix for prefix, count in pending.iteritems() if count >= self.threshold),
+                      key=lambda prefix: -pending[prefix])
+
+    def indexing(self):
+        return self.project.indexer_stats()['outstanding'] > 0
+
+    def run(self):
+        while True:
+            time.sleep(POLL_SECONDS)
+            try:
+                self.poll()
+            except Exception as e:
+                print >>sys.stderr, "ctrlk: compaction of %s failed: %s" % (self.project.project_root, e)
+
+    def poll(self):
+        if not self.project.indexer_running:
+            return
+
+        now = time.time()
+        if self.indexing():
+            self.last_busy = now
+            self.indexed_since_compaction = True
+            return
+
+        if self.indexed_since_compaction:
+            reason = 'after_indexing'
+        elif now - self.last_busy >= self.idle_seconds:
+            reason = 'idle'
+        else:
+            return
+
+        self.indexed_since_compaction = False
+        self.compact(self.hot_prefixes(), reason, throttle=True)
+
+    # Compacts the ranges of the given prefixes, all the ones with deleted keys if None. Returns
+    #    what was compacted, as in status()['history'].
+    def compact(self, prefixes=None, reason='requested', throttle=False):
+        if prefixes is None:
+            prefixes = sorted(prefix for prefix, count in self.pending().iteritems() if count > 0)
+
+        ret = []
+        with self.compact_lock:
+            for prefix in prefixes:
+                if throttle and self.indexing():
+                    break
+
+                counts = self.deleted_keys()
+                start = time.time()
+                with self.lock:
+                    self.running = prefix
+                try:
+                    key_from, key_to = prefix_range(prefix)
+                    self.project.leveldb_connection.CompactRange(key_from, key_to)
+                finally:
+                    with self.lock:
+                        self.running = None
+                seconds = time.time() - start
+
+                entry = {
+                    'prefix': prefix,
+                    'reason': reason,
+                    'time': start,
+                    'seconds': seconds,
+                    'deleted_keys': counts.get(prefix, 0) - self.compacted_at.get(prefix, 0),
+                }
+                with self.lock:
+                    self.compacted_at[prefix] = counts.get(prefix, 0)
+                    self.history.append(entry)
+                ret.append(entry)
+
+                if throttle:
+                    time.sleep(seconds * THROTTLE_FACTOR)
+        return ret
+
+    def status(self):
+        pending = self.pending()
+        with self.lock:
+            return {
+                'running': self.running,
+                'pending_deleted_keys': pending,
+                'hot_prefixes': sorted(prefix for prefix, count in pending.iteritems() if count >= self.threshold),
+                'threshold': self.threshold,
+                'idle_seconds': max(0, time.time() - self.last_busy),
+                'history': list(self.history),
+            }
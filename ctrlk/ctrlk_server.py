@@ -1,17 +1,43 @@
+import time
+g_start_time = time.time()
+
 import argparse
+import datetime
 import json
 import os
 import signal
+import sys
 import threading
-import time
+import tornado.gen
+import tornado.httpserver
+import tornado.ioloop
+import tornado.locks
+import tornado.netutil
 import tornado.web
 
+from concurrent.futures import ThreadPoolExecutor
+
 from ctrlk import client_api
+from ctrlk import metrics
 from ctrlk import project
 from ctrlk import search
 
 g_projects = {}
+g_projects_lock = threading.Lock()
 g_last_request_time = time.time()
+g_request_metrics = metrics.RequestMetrics()
+
+# Blocking work (LevelDB scans, libclang calls, project setup) never runs on the IOLoop
+# thread. Cheap per-keystroke queries go to the interactive pool, scans and indexing
+# requests go to the bulk pool, so that a slow /match cannot delay a scope lookup.
+DEFAULT_INTERACTIVE_THREADS = 4
+DEFAULT_BULK_THREADS = 4
+
+INTERACTIVE_TIMEOUT = 10
+BULK_TIMEOUT = 120
+
+g_interactive_executor = ThreadPoolExecutor(DEFAULT_INTERACTIVE_THREADS)
+g_bulk_executor = ThreadPoolExecutor(DEFAULT_BULK_THREADS)
 
 def get_absolute_path():
     return os.path.abspath(os.path.realpath(__file__))
@@ -23,65 +49,274 @@ def killer_thread(suicide_seconds):
             os.kill(os.getpid(), signal.SIGINT)
         time.sleep(10)
 
+def get_or_create_project(library_path, project_root, cursor_table):
+    abs_project_root = os.path.abspath(project_root)
+    with g_projects_lock:
+        if abs_project_root not in g_projects:
+            proj = project.Project(library_path, project_root, cursor_table=cursor_table)
+            # a long running server reindexes the same files over and over
+            proj.compaction_scheduler
+            g_projects[abs_project_root] = proj
+        return g_projects[abs_project_root]
+
 class MyRequestHandler(tornado.web.RequestHandler):
     def prepare(self):
         global g_last_request_time
         g_last_request_time = time.time()
+        self.response_bytes = 0
+        g_request_metrics.start(self.request.path)
+
+    def write(self, chunk):
+        if isinstance(chunk, basestring):
+            self.response_bytes += len(chunk)
+        super(MyRequestHandler, self).write(chunk)
+
+    def on_finish(self):
+        # prepare() does not run for requests tornado rejects before routing them
+        if not hasattr(self, 'response_bytes'):
+            return
+        request_bytes = len(self.request.uri) + len(self.request.body or '')
+        g_request_metrics.finish(self.request.path, self.get_status(), self.request.request_time(),
+                                 request_bytes, self.response_bytes)
     def get_project(self):
         project_root = self.get_argument("project_root")
         abs_project_root = os.path.abspath(project_root)
         return g_projects[abs_project_root]
 
+    # the caller can ask for a shorter deadline than the default for the pool, never a longer one
+    def get_timeout(self, default_timeout):
+        timeout = float(self.get_argument("timeout", default_timeout))
+        return min(timeout, default_timeout)
+
+    @tornado.gen.coroutine
+    def run_blocking(self, executor, timeout, fn, *args, **kwargs):
+        future = executor.submit(fn, *args, **kwargs)
+        try:
+            ret = yield tornado.gen.with_timeout(datetime.timedelta(seconds=timeout), future)
+        except tornado.gen.TimeoutError:
+            raise tornado.web.HTTPError(504, "%s did not finish in %s seconds" % (self.request.path, timeout))
+        raise tornado.gen.Return(ret)
+
+    def run_interactive(self, fn, *args, **kwargs):
+        return self.run_blocking(g_interactive_executor, self.get_timeout(INTERACTIVE_TIMEOUT), fn, *args, **kwargs)
+
+    def run_bulk(self, fn, *args, **kwargs):
+        return self.run_blocking(g_bulk_executor, self.get_timeout(BULK_TIMEOUT), fn, *args, **kwargs)
+
 class PingHandler(MyRequestHandler):
     def get(self):
         self.write("Hello, world!")
 
 class RegisterHandler(MyRequestHandler):
+    @tornado.gen.coroutine
     def get(self):
-        global g_projects
-
         library_path = self.get_argument("library_path")
         project_root = self.get_argument("project_root")
 
-        abs_project_root = os.path.abspath(project_root)
+        cursor_table = self.get_argument("cursor_table", "0") == "1"
 
-        if abs_project_root not in g_projects:
-            g_projects[abs_project_root] = project.Project(library_path, project_root)
+        yield self.run_bulk(get_or_create_project, library_path, project_root, cursor_table)
 
 class ParseHandler(MyRequestHandler):
+    @tornado.gen.coroutine
     def get(self):
         file_name = self.get_argument("file_name", None)
         if file_name:
-            self.get_project().parse_file(file_name)
+            yield self.run_bulk(self.get_project().parse_file, file_name)
         else:
-            self.get_project().scan_and_index()
+            yield self.run_bulk(self.get_project().scan_and_index)
 
 class QueueSizeHandler(MyRequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        ret = yield self.run_interactive(self.get_project().work_queue_size)
+        self.write(json.dumps(ret))
+
+class IndexerStatsHandler(MyRequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        ret = yield self.run_interactive(self.get_project().indexer_stats)
+        self.write(json.dumps(ret))
+
+class ParseFailuresHandler(MyRequestHandler):
+    @tornado.gen.coroutine
     def get(self):
-        self.write(json.dumps(self.get_project().work_queue_size()))
+        ret = yield self.run_bulk(self.get_project().parse_failures)
+        self.write(json.dumps(ret))
+
+class SlowFilesHandler(MyRequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        ret = yield self.run_bulk(self.get_project().slow_files)
+        self.write(json.dumps(ret))
+
+class ScopeStatsHandler(MyRequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        ret = yield self.run_interactive(self.get_project().scope_stats)
+        self.write(json.dumps(ret))
+
+class CompactionStatusHandler(MyRequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        ret = yield self.run_interactive(self.get_project().compaction_scheduler.status)
+        self.write(json.dumps(ret))
+
+# compacts the ranges of the given key prefixes (a comma separated list), or of all the prefixes
+#    with deleted keys
+class CompactHandler(MyRequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        prefixes = self.get_argument('prefixes', None)
+        if prefixes is not None:
+            prefixes = prefixes.split(',')
+        ret = yield self.run_bulk(self.get_project().compaction_scheduler.compact, prefixes)
+        self.write(json.dumps(ret))
+
+# Changes the options of the worker pool that are given, see project.POOL_OPTIONS, and returns its
+#    state. The pool is shared by all projects, so this takes no project_root.
+class PoolHandler(MyRequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        options = dict((name, self.get_argument(name)) for name in project.POOL_OPTIONS
+                       if self.get_argument(name, None) is not None)
+        ret = yield self.run_interactive(project.configure_pool, **options)
+        self.write(json.dumps(ret))
+
+# format=compact selects the columnar encodings from search, the default is the original layout
+def leveldb_search(proj, starts_with, fmt='json'):
+    if fmt == 'compact':
+        return search.leveldb_search_compact(proj.query_connection, starts_with)
+    return [x for x in search.leveldb_range_iter(proj.query_connection, starts_with)]
+
+# rank=1 orders the symbols of each navigation prefix by their references, and the response says
+#    whether more entries matched than limit: a third element in the json format, `truncated` in the
+#    compact one. See search.rank_items_matching_pattern
+def match(proj, prefix, limit, fmt='json', ranked=False):
+    if fmt == 'compact':
+        return search.get_items_matching_pattern_compact(proj.query_connection, prefix, limit, ranked)
+    return search.get_items_matching_pattern(proj.query_connection, prefix, limit, ranked)
 
 class LevelDBSearchHandler(MyRequestHandler):
+    @tornado.gen.coroutine
     def get(self):
         starts_with = self.get_argument('starts_with')
-        ret = [x for x in search.leveldb_range_iter(self.get_project().leveldb_connection, starts_with)]
+        fmt = self.get_argument('format', 'json')
+        ret = yield self.run_bulk(leveldb_search, self.get_project(), starts_with, fmt)
         self.write(json.dumps(ret))
 
 class MatchHandler(MyRequestHandler):
+    @tornado.gen.coroutine
     def get(self):
         prefix = self.get_argument('prefix')
         limit = int(self.get_argument('limit'))
-        ret = search.get_items_matching_pattern(self.get_project().leveldb_connection, prefix, limit)
+        fmt = self.get_argument('format', 'json')
+        ranked = self.get_argument('rank', '0') == '1'
+        ret = yield self.run_bulk(match, self.get_project(), prefix, limit, fmt, ranked)
+        self.write(json.dumps(ret))
+
+# depth is how many edges away from symbol to go, limit how many edges to return
+class CallersHandler(MyRequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        symbol = self.get_argument('symbol')
+        depth = int(self.get_argument('depth', search.DEFAULT_GRAPH_DEPTH))
+        limit = int(self.get_argument('limit', search.DEFAULT_GRAPH_LIMIT))
+        ret = yield self.run_bulk(search.get_callers, self.get_project().query_connection, symbol, depth, limit)
+        self.write(json.dumps(ret))
+
+class CalleesHandler(MyRequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        symbol = self.get_argument('symbol')
+        depth = int(self.get_argument('depth', search.DEFAULT_GRAPH_DEPTH))
+        limit = int(self.get_argument('limit', search.DEFAULT_GRAPH_LIMIT))
+        ret = yield self.run_bulk(search.get_callees, self.get_project().query_connection, symbol, depth, limit)
+        self.write(json.dumps(ret))
+
+class SubtypesHandler(MyRequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        symbol = self.get_argument('symbol')
+        depth = int(self.get_argument('depth', search.DEFAULT_GRAPH_DEPTH))
+        limit = int(self.get_argument('limit', search.DEFAULT_GRAPH_LIMIT))
+        ret = yield self.run_bulk(search.get_subtypes, self.get_project().query_connection, symbol, depth, limit)
+        self.write(json.dumps(ret))
+
+class SupertypesHandler(MyRequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        symbol = self.get_argument('symbol')
+        depth = int(self.get_argument('depth', search.DEFAULT_GRAPH_DEPTH))
+        limit = int(self.get_argument('limit', search.DEFAULT_GRAPH_LIMIT))
+        ret = yield self.run_bulk(search.get_supertypes, self.get_project().query_connection, symbol, depth, limit)
+        self.write(json.dumps(ret))
+
+class SymbolCountsHandler(MyRequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        symbol = self.get_argument('symbol')
+        ret = yield self.run_interactive(search.get_symbol_counts, self.get_project().query_connection, symbol)
+        self.write(json.dumps(ret))
+
+MAX_PROGRESS_WAIT = 600
+
+g_progress_conditions = {}
+
+# Only called on the IOLoop thread. The project's progress feed wakes up the waiting
+#    handlers through the IOLoop, since tornado conditions are not thread safe.
+def get_progress_condition(proj):
+    if proj not in g_progress_conditions:
+        condition = tornado.locks.Condition()
+        ioloop = tornado.ioloop.IOLoop.current()
+        proj.progress_feed.add_listener(lambda: ioloop.add_callback(condition.notify_all))
+        g_progress_conditions[proj] = condition
+    return g_progress_conditions[proj]
+
+# Long poll: answers as soon as there are indexer events after `since`, or after `wait`
+#    seconds with no events, so an idle client keeps at most one request open.
+class ProgressHandler(MyRequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        proj = self.get_project()
+        since = int(self.get_argument('since', 0))
+        wait = min(float(self.get_argument('wait', 30)), MAX_PROGRESS_WAIT)
+
+        condition = get_progress_condition(proj)
+        deadline = time.time() + wait
+        while proj.progress_feed.seq <= since and time.time() < deadline:
+            yield condition.wait(timeout=datetime.timedelta(seconds=deadline - time.time()))
+
+        ret = yield self.run_interactive(proj.progress_feed.snapshot, since)
         self.write(json.dumps(ret))
 
+def render_metrics():
+    lines = g_request_metrics.render()
+    projects = sorted(g_projects.items())
+    lines += metrics.render_indexer_stats([(project_root, proj.indexer_stats())
+                                           for project_root, proj in projects if proj.indexer_running])
+    leveldb_stats = [(project_root, proj.leveldb_stats()) for project_root, proj in projects]
+    lines += metrics.render_leveldb_stats([(project_root, stats) for project_root, stats in leveldb_stats
+                                           if stats is not None])
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(MyRequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        ret = yield self.run_interactive(render_metrics)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(ret)
+
 class BuiltinHeaderPathHandler(MyRequestHandler):
     def get(self):
         self.write(json.dumps(self.get_project().builtin_header_path))
 
 class FileArgsHandler(MyRequestHandler):
+    @tornado.gen.coroutine
     def get(self):
         file_name = self.get_argument('file_name')
 
-        origin_file, compile_command, mod_time = self.get_project().get_file_args(file_name)
+        origin_file, compile_command, mod_time = yield self.run_interactive(self.get_project().get_file_args, file_name)
         self.write(json.dumps(compile_command))
 
 class ParseCurrentFileHandler(MyRequestHandler):
@@ -97,20 +332,107 @@ class UnloadCurrentFileHandler(MyRequestHandler):
         self.get_project().unload_current_file(file_name)
 
 class GetUsrUnderCursorHandler(MyRequestHandler):
+    @tornado.gen.coroutine
     def get(self):
         file_name = self.get_argument('file_name')
         row = self.get_argument('row')
         col = self.get_argument('col')
-        ret = self.get_project().get_usr_under_cursor(file_name, row, col)
+        ret = yield self.run_interactive(self.get_project().get_usr_under_cursor, file_name, row, col)
+        self.write(json.dumps(ret))
+
+class GetUsrsUnderCursorHandler(MyRequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        file_name = self.get_argument('file_name')
+        positions = json.loads(self.get_argument('positions'))
+        ret = yield self.run_interactive(self.get_project().get_usrs_under_cursor, file_name, positions)
         self.write(json.dumps(ret))
 
 class GetCurrentScopeStrHandler(MyRequestHandler):
+    @tornado.gen.coroutine
     def get(self):
         file_name = self.get_argument('file_name')
         row = self.get_argument('row')
-        ret = self.get_project().get_current_scope_str(file_name, row)
+        ret = yield self.run_interactive(self.get_project().get_current_scope_str, file_name, row)
         self.write(json.dumps(ret))
 
+# name => (pool, whether it may run concurrently with the operations around it, implementation)
+BATCH_OPERATIONS = {
+    'queue_size': ('interactive', True, lambda proj, args: proj.work_queue_size()),
+    'indexer_stats': ('interactive', True, lambda proj, args: proj.indexer_stats()),
+    'parse_failures': ('bulk', True, lambda proj, args: proj.parse_failures()),
+    'slow_files': ('bulk', True, lambda proj, args: proj.slow_files()),
+    'scope_stats': ('interactive', True, lambda proj, args: proj.scope_stats()),
+    'compaction_status': ('interactive', True, lambda proj, args: proj.compaction_scheduler.status()),
+    'compact': ('bulk', False,
+        lambda proj, args: proj.compaction_scheduler.compact(args['prefixes'].split(',') if args.get('prefixes') else None)),
+    'builtin_header_path': ('interactive', True, lambda proj, args: proj.builtin_header_path),
+    'file_args': ('interactive', True, lambda proj, args: proj.get_file_args(args['file_name'])[1]),
+    'get_usr_under_cursor': ('interactive', True,
+        lambda proj, args: proj.get_usr_under_cursor(args['file_name'], args['row'], args['col'])),
+    'get_usrs_under_cursor': ('interactive', True,
+        lambda proj, args: proj.get_usrs_under_cursor(args['file_name'], json.loads(args['positions']))),
+    'get_current_scope_str': ('interactive', True,
+        lambda proj, args: proj.get_current_scope_str(args['file_name'], args['row'])),
+    'leveldb_search': ('bulk', True,
+        lambda proj, args: leveldb_search(proj, args['starts_with'], args.get('format', 'json'))),
+    'match': ('bulk', True,
+        lambda proj, args: match(proj, args['prefix'], int(args['limit']), args.get('format', 'json'),
+                                 str(args.get('rank', '0')) == '1')),
+    'callers': ('bulk', True,
+        lambda proj, args: search.get_callers(proj.query_connection, args['symbol'],
+            int(args.get('depth', search.DEFAULT_GRAPH_DEPTH)), int(args.get('limit', search.DEFAULT_GRAPH_LIMIT)))),
+    'callees': ('bulk', True,
+        lambda proj, args: search.get_callees(proj.query_connection, args['symbol'],
+            int(args.get('depth', search.DEFAULT_GRAPH_DEPTH)), int(args.get('limit', search.DEFAULT_GRAPH_LIMIT)))),
+    'subtypes': ('bulk', True,
+        lambda proj, args: search.get_subtypes(proj.query_connection, args['symbol'],
+            int(args.get('depth', search.DEFAULT_GRAPH_DEPTH)), int(args.get('limit', search.DEFAULT_GRAPH_LIMIT)))),
+    'supertypes': ('bulk', True,
+        lambda proj, args: search.get_supertypes(proj.query_connection, args['symbol'],
+            int(args.get('depth', search.DEFAULT_GRAPH_DEPTH)), int(args.get('limit', search.DEFAULT_GRAPH_LIMIT)))),
+    'symbol_counts': ('interactive', True,
+        lambda proj, args: search.get_symbol_counts(proj.query_connection, args['symbol'])),
+    'parse': ('bulk', False,
+        lambda proj, args: proj.parse_file(args['file_name']) if args.get('file_name') else proj.scan_and_index()),
+    'parse_current_file': ('interactive', False,
+        lambda proj, args: proj.parse_current_file(args['command'], args['file_name'], args['content'])),
+    'unload_current_file': ('interactive', False, lambda proj, args: proj.unload_current_file(args['file_name'])),
+}
+
+# Runs a list of operations against one project in a single round trip. Consecutive read
+#    operations run concurrently, operations that change state run alone and in order. A failing
+#    operation reports its error in its own slot and does not fail the rest of the batch.
+class BatchHandler(MyRequestHandler):
+    @tornado.gen.coroutine
+    def run_operation(self, proj, op):
+        try:
+            pool, concurrent, fn = BATCH_OPERATIONS[op['op']]
+            run = self.run_interactive if pool == 'interactive' else self.run_bulk
+            ret = yield run(fn, proj, op.get('args', {}))
+        except Exception as e:
+            raise tornado.gen.Return({'error': "%s: %s" % (op.get('op'), e)})
+        raise tornado.gen.Return({'result': ret})
+
+    @tornado.gen.coroutine
+    def post(self):
+        proj = self.get_project()
+        ops = json.loads(self.get_argument('ops'))
+
+        results = []
+        pending = []
+        for op in ops:
+            concurrent = op.get('op') in BATCH_OPERATIONS and BATCH_OPERATIONS[op['op']][1]
+            if not concurrent:
+                results += yield pending
+                pending = []
+                results.append((yield self.run_operation(proj, op)))
+            else:
+                pending.append(self.run_operation(proj, op))
+        results += yield pending
+
+        self.write(json.dumps(results))
+
 def sigint_handler(signum, frame):
     for v in g_projects.itervalues():
         v.wait_on_work()
@@ -121,24 +443,53 @@ application = tornado.web.Application([
     (r"/register", RegisterHandler),
     (r"/parse", ParseHandler),
     (r"/queue_size", QueueSizeHandler),
+    (r"/indexer_stats", IndexerStatsHandler),
+    (r"/parse_failures", ParseFailuresHandler),
+    (r"/slow_files", SlowFilesHandler),
+    (r"/scope_stats", ScopeStatsHandler),
+    (r"/pool", PoolHandler),
+    (r"/compaction_status", CompactionStatusHandler),
+    (r"/compact", CompactHandler),
+    (r"/progress", ProgressHandler),
     (r"/leveldb_search", LevelDBSearchHandler),
     (r"/match", MatchHandler),
+    (r"/symbol_counts", SymbolCountsHandler),
+    (r"/callers", CallersHandler),
+    (r"/callees", CalleesHandler),
+    (r"/subtypes", SubtypesHandler),
+    (r"/supertypes", SupertypesHandler),
     (r"/builtin_header_path", BuiltinHeaderPathHandler),
     (r"/file_args", FileArgsHandler),
     (r"/parse_current_file", ParseCurrentFileHandler),
     (r"/unload_current_file", UnloadCurrentFileHandler),
     (r"/get_usr_under_cursor", GetUsrUnderCursorHandler),
+    (r"/get_usrs_under_cursor", GetUsrsUnderCursorHandler),
     (r"/get_current_scope_str", GetCurrentScopeStrHandler),
-])
+    (r"/batch", BatchHandler),
+    (r"/metrics", MetricsHandler),
+], compress_response=True)
+
+def launch_server(port, suicide_seconds, interactive_threads=DEFAULT_INTERACTIVE_THREADS, bulk_threads=DEFAULT_BULK_THREADS,
+                  unix_socket=None, pool_options={}):
+    global g_interactive_executor, g_bulk_executor
+    g_interactive_executor = ThreadPoolExecutor(interactive_threads)
+    g_bulk_executor = ThreadPoolExecutor(bulk_threads)
+
+    project.configure_pool(**pool_options)
 
-def launch_server(port, suicide_seconds):
     application.listen(port)
 
+    if unix_socket:
+        unix_server = tornado.httpserver.HTTPServer(application)
+        unix_server.add_socket(tornado.netutil.bind_unix_socket(unix_socket))
+
     signal.signal(signal.SIGINT, sigint_handler)
 
     t = threading.Thread(target=killer_thread, args=(suicide_seconds,))
     t.start()
 
+    print >>sys.stderr, "ctrlk: listening on port %d, startup took %.1f ms" % (port, (time.time() - g_start_time) * 1000)
+
     tornado.ioloop.IOLoop.instance().start()
 
 if __name__ == "__main__":
@@ -146,7 +497,21 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(conflict_handler='resolve')
     parser.add_argument('-p', '--port', dest='port', type=int, default=client_api.DEFAULT_PORT)
     parser.add_argument('-s', '--suicide-seconds', dest='suicide_seconds', type=int, default=3600)
+    parser.add_argument('--interactive-threads', dest='interactive_threads', type=int, default=DEFAULT_INTERACTIVE_THREADS)
+    parser.add_argument('--bulk-threads', dest='bulk_threads', type=int, default=DEFAULT_BULK_THREADS)
+    parser.add_argument('-u', '--unix-socket', dest='unix_socket', default=None)
+    parser.add_argument('--background', dest='background', action='store_true', default=False,
+                        help='index at a lower CPU and I/O priority')
+    parser.add_argument('--memory-limit-mb', dest='memory_limit_mb', type=float, default=None,
+                        help='upper bound for the estimated memory of the files parsed at once')
     options = parser.parse_args()
 
-    launch_server(options.port, options.suicide_seconds)
+    pool_options = {}
+    if options.background:
+        pool_options['background'] = 1
+    if options.memory_limit_mb is not None:
+        pool_options['memory_limit_mb'] = options.memory_limit_mb
+
+    launch_server(options.port, options.suicide_seconds, options.interactive_threads, options.bulk_threads,
+                  options.unix_socket, pool_options)
 
@@ -0,0 +1,149 @@
+import argparse
+import os
+import sys
+import time
+
+from ctrlk import indexer
+from ctrlk.project import EXTRACTORS, Project, configure_pool
+
+# Offline indexer: builds the .ctrlk-index of a project without a ctrlk_server, e.g. to prebuild
+# indexes in CI or on build machines.
+#
+#   python -m ctrlk.index --library-path /usr/lib/llvm/lib [-j 8] [--only-changed] [--time-budget 600] [project_root]
+
+PROGRESS_INTERVAL = 1.0
+
+def format_progress(stats, elapsed):
+    done = stats['files_indexed'] + stats['files_up_to_date']
+    return "%d files done (%d indexed, %d up to date), %d active, %d queued, %d references queued, %.0fs" % \
+            (done, stats['files_indexed'], stats['files_up_to_date'], stats['active'], stats['queued'],
+             stats['queued_references'], elapsed)
+
+class ProgressPrinter(object):
+    def __init__(self, stream, quiet):
+        self.stream = stream
+        self.quiet = quiet
+        self.interactive = stream.isatty()
+
+    def update(self, line):
+        if self.quiet:
+            return
+        if self.interactive:
+            self.stream.write("\r\033[K" + line)
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+    def done(self, line):
+        if self.interactive and not self.quiet:
+            self.stream.write("\r\033[K")
+        self.stream.write(line + "\n")
+        self.stream.flush()
+
+# waits until the indexer is done or the deadline passes, returns False in the latter case
+def wait_for_indexer(project, deadline, printer, start):
+    while True:
+        timeout = PROGRESS_INTERVAL
+        if deadline is not None:
+            timeout = min(timeout, max(0, deadline - time.time()))
+
+        done = project.wait_on_work(timeout)
+        printer.update(format_progress(project.indexer_stats(), time.time() - start))
+        if done:
+            return True
+        if deadline is not None and time.time() >= deadline:
+            return False
+
+def run(options):
+    start = time.time()
+    printer = ProgressPrinter(sys.stderr, options.quiet)
+
+    pool_options = {}
+    if options.background:
+        pool_options['background'] = 1
+    if options.memory_limit is not None:
+        pool_options['memory_limit_mb'] = options.memory_limit
+    configure_pool(**pool_options)
+
+    project = Project(options.library_path, options.project_root, n_workers=options.jobs)
+
+    if not options.only_changed and os.path.exists(project.index_db_path):
+        print >>sys.stderr, "ctrlk: removing %s" % project.index_db_path
+        indexer.DestroyDB(project.index_db_path)
+    if not options.only_changed and os.path.exists(project.segment_path):
+        os.remove(project.segment_path)
+
+    if options.file_time_budget is not None:
+        project.set_indexer_option('time_budget_seconds', options.file_time_budget)
+    if options.extract_time_budget is not None:
+        project.set_indexer_option('extract_time_budget_seconds', options.extract_time_budget)
+    if options.memory_budget is not None:
+        project.set_indexer_option('memory_budget_mb', options.memory_budget)
+    if options.tiered:
+        project.set_indexer_option('tiered', 1)
+    if options.extractor is not None:
+        project.set_indexer_option('extractor', EXTRACTORS[options.extractor])
+
+    project.scan_and_index()
+
+    deadline = start + options.time_budget if options.time_budget else None
+    finished = wait_for_indexer(project, deadline, printer, start)
+    if not finished:
+        dropped = project.clear_queue()
+        printer.done("ctrlk: time budget of %ds exhausted, %d queued files left for the next --only-changed run" % \
+                (options.time_budget, dropped))
+        # the files that are being parsed are still written out completely
+        wait_for_indexer(project, None, printer, start)
+
+    stats = project.indexer_stats()
+    printer.done(format_progress(stats, time.time() - start))
+
+    if options.compact:
+        compact_start = time.time()
+        project.leveldb_connection.CompactRange()
+        print >>sys.stderr, "ctrlk: compacted %s in %.1fs" % (project.index_db_path, time.time() - compact_start)
+
+    if options.freeze:
+        freeze_start = time.time()
+        count = project.freeze_index()
+        print >>sys.stderr, "ctrlk: froze %d entries into %s in %.1fs" % (count, project.segment_path, time.time() - freeze_start)
+
+    return 0 if finished else 2
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ctrlk.index')
+    parser.add_argument('project_root', nargs='?', default=os.getcwd(),
+                        help='any directory at or below the one with compile_commands.json')
+    parser.add_argument('--library-path', dest='library_path', required=True,
+                        help='directory that contains libclang')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=None,
+                        help='number of files to parse in parallel')
+    parser.add_argument('--only-changed', dest='only_changed', action='store_true', default=False,
+                        help='keep the existing index and only reindex files that changed since')
+    parser.add_argument('--time-budget', dest='time_budget', type=int, default=None,
+                        help='stop starting new files after this many seconds, and exit with 2 if some were left')
+    parser.add_argument('--file-time-budget', dest='file_time_budget', type=float, default=None,
+                        help='seconds after which a file is reported as slow and parsed cheaply next time')
+    parser.add_argument('--extract-time-budget', dest='extract_time_budget', type=float, default=None,
+                        help='seconds after which symbol extraction stops for a file, which is then parsed cheaply')
+    parser.add_argument('--memory-budget', dest='memory_budget', type=float, default=None,
+                        help='TU size in MB over which a file is reparsed cheaply')
+    parser.add_argument('--tiered', dest='tiered', action='store_true', default=False,
+                        help='index declarations of all files first, then their references')
+    parser.add_argument('--extractor', dest='extractor', choices=sorted(EXTRACTORS), default=None,
+                        help='how entries are extracted from parsed files, the AST visitor by default')
+    parser.add_argument('--background', dest='background', action='store_true', default=False,
+                        help='index at a lower CPU and I/O priority')
+    parser.add_argument('--memory-limit', dest='memory_limit', type=float, default=None,
+                        help='upper bound in MB for the estimated memory of the files parsed at once')
+    parser.add_argument('--no-compact', dest='compact', action='store_false', default=True,
+                        help='skip compacting the index at the end')
+    parser.add_argument('--freeze', dest='freeze', action='store_true', default=False,
+                        help='move the read-mostly part of the index into a memory mapped segment')
+    parser.add_argument('-q', '--quiet', dest='quiet', action='store_true', default=False)
+    options = parser.parse_args(argv)
+
+    return run(options)
+
+if __name__ == '__main__':
+    sys.exit(main())
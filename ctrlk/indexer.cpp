@@ -15,13 +15,24 @@
 
 #include <vector>
 #include <queue>
+#include <deque>
+#include <map>
+#include <list>
 #include <thread>
 #include <set>
+#include <unordered_map>
+#include <unordered_set>
+#include <functional>
 
 #include <clang-c/CXCompilationDatabase.h>
 #include <clang-c/Index.h>
 
 #include <pthread.h>
+#include <errno.h>
+#include <fnmatch.h>
+#include <sys/stat.h>
+#include <sys/resource.h>
+#include <sys/syscall.h>
 #include <leveldb/db.h>
 #include <leveldb/write_batch.h>
 
@@ -98,9 +109,6 @@ std::string ExtractPart(std::string s, int ordinal)
     return std::string("");
 }
 
-leveldb::DB* db;
-std::vector<std::thread> g_workers;
-
 struct CompileCommand
 {
     CompileCommand(const char* arg_fileName, const std::vector<std::string>& arg_args, time_t arg_modTime)
@@ -115,6 +123,7 @@ struct CompileCommand
         }
 
         modTime = arg_modTime;
+        tier = 0;
     }
 
     void Clear()
@@ -132,15 +141,342 @@ struct CompileCommand
     char** args;
     int nargs;
     time_t modTime;
+
+    // 0 indexes the file in one pass. With tiered indexing, 1 is the declaration pass and
+    //    2 the reference pass that follows it, see IndexReferences.
+    //
+    int tier;
+};
+
+// Index scope rules, see set_scope_rules. The first rule that matches a file decides how much of
+//    it is indexed; files that match no rule are indexed fully.
+//
+enum ScopeMode
+{
+    Scope_Full,
+    Scope_Declarations,
+    Scope_Exclude,
+};
+
+struct ScopeRule
+{
+    std::string pattern;
+    ScopeMode mode;
+    bool glob;
+    bool systemHeaders;
+};
+
+// what each rule kept out of the index
+//
+struct ScopeRuleStats
+{
+    ScopeRuleStats() : files(0), sourceBytes(0), cursorsSkipped(0) {}
+
+    long files;
+    long sourceBytes;
+    long cursorsSkipped;
+};
+
+const char* c_systemHeadersPattern = "<system>";
+
+// file name => index of the rule that matched it, -1 for none
+//
+typedef std::map<std::string, int> AllowedFiles_t;
+
+// Progress events, kept in a bounded log per project so that clients can wait for what
+//    happened after the last event they saw instead of polling the queue size.
+//
+struct IndexerEvent
+{
+    long seq;
+    const char* type;
+    std::string fileName;
+    double time;
+};
+
+const size_t c_maxEvents = 1024;
+
+// Defaults for the retry schedule of files that fail to parse, see set_option.
+//
+const double c_defaultParseRetrySeconds = 60;
+const double c_defaultMaxParseRetrySeconds = 24 * 3600;
+const int c_defaultMaxParseAttempts = 5;
+
+// Defaults for the per-file budgets, see set_option. 0 turns a budget off, and they are all off
+//    unless the project opts in (.ctrlk.json, or the options of ctrlk.index).
+//
+const double c_defaultTimeBudgetSeconds = 0;
+const double c_defaultExtractTimeBudgetSeconds = 0;
+const double c_defaultMemoryBudgetMb = 0;
+
+// how many cursors the symbol visitor handles between checks of the extraction deadline
+//
+const int c_deadlineCheckInterval = 256;
+
+// Defaults for admission control, see set_pool_option. A file that was not parsed yet is assumed
+//    to need as much as the running average of the ones that were, which starts here.
+//
+const double c_defaultMemoryReserveMb = 512;
+const double c_initialTuEstimateMb = 256;
+
+// what a worker in background mode lowers its thread to: nice 10 and the idle I/O class
+//
+const int c_backgroundNice = 10;
+const int c_ioprioWhoProcess = 1;
+const int c_ioprioIdle = 3 << 13;
+
+// How the entries are extracted from a parsed file, see set_option. The visitor walks the whole
+//    AST, the index action gets the entries from libclang's indexing callbacks.
+//
+enum Extractor
+{
+    Extractor_Visitor = 0,
+    Extractor_IndexAction = 1
+};
+
+// All the state that belongs to one project: its index, its own work queue and stats.
+//    Every registered project gets one of these, and they all share a single worker pool.
+//
+struct ProjectIndexer
+{
+    ProjectIndexer(int arg_id, PyLevelDB* arg_pyDb)
+    {
+        id = arg_id;
+        pyDb = arg_pyDb;
+        db = arg_pyDb->_db;
+        outstandingTasks = 0;
+        activeTasks = 0;
+        filesIndexed = 0;
+        filesUpToDate = 0;
+        filesFailed = 0;
+        filesSkipped = 0;
+        parseRetrySeconds = c_defaultParseRetrySeconds;
+        maxParseRetrySeconds = c_defaultMaxParseRetrySeconds;
+        maxParseAttempts = c_defaultMaxParseAttempts;
+        timeBudgetSeconds = c_defaultTimeBudgetSeconds;
+        extractTimeBudgetSeconds = c_defaultExtractTimeBudgetSeconds;
+        memoryBudgetMb = c_defaultMemoryBudgetMb;
+        filesOverBudget = 0;
+        scopeGeneration = 0;
+        tiered = false;
+        extractor = Extractor_Visitor;
+        sessionIndex = nullptr;
+        indexAction = nullptr;
+        filesReferenced = 0;
+        writesSkipped = 0;
+        writeBytesSkipped = 0;
+        scheduled = false;
+        lowScheduled = false;
+        paused = false;
+        lastEventSeq = 0;
+        pthread_mutex_init(&claimLock, nullptr);
+        pthread_mutex_init(&aggregateLock, nullptr);
+        pthread_cond_init(&finishedCond, nullptr);
+        pthread_cond_init(&eventCond, nullptr);
+    }
+
+    int id;
+    PyLevelDB* pyDb;
+    leveldb::DB* db;
+
+    // guarded by g_worklock
+    //
+    std::queue<CompileCommand> work;
+    // reference passes, only served when no project has other work
+    std::queue<CompileCommand> lowWork;
+    int outstandingTasks;
+    int activeTasks;
+    long filesIndexed;
+    long filesUpToDate;
+    long filesFailed;
+    long filesSkipped;
+    long filesOverBudget;
+    long filesReferenced;
+    long writesSkipped;
+    long writeBytesSkipped;
+    bool scheduled;
+    bool lowScheduled;
+    // (file, mtime) of the reference passes that are queued or running, a file gets one at a time
+    std::set<std::pair<std::string, time_t> > referencePasses;
+    // queued work is held back, see pause_queue
+    bool paused;
+    pthread_cond_t finishedCond;
+    std::deque<IndexerEvent> events;
+    long lastEventSeq;
+    pthread_cond_t eventCond;
+
+    // options, see set_option
+    //
+    double parseRetrySeconds;
+    double maxParseRetrySeconds;
+    int maxParseAttempts;
+    double timeBudgetSeconds;
+    double extractTimeBudgetSeconds;
+    double memoryBudgetMb;
+    bool tiered;
+    int extractor;
+
+    // the session of the index action extractor, lives as long as the project, guarded by g_worklock
+    //
+    CXIndex sessionIndex;
+    CXIndexAction indexAction;
+
+    // guarded by g_worklock
+    //
+    std::vector<ScopeRule> scopeRules;
+    std::vector<ScopeRuleStats> scopeStats;
+    std::set<std::string> scopeSeen;
+    int scopeGeneration;
+
+    // serializes claiming of the headers against this project's index
+    //
+    pthread_mutex_t claimLock;
+
+    // serializes the read-modify-write updates of the c%%% counts and the a%%% aggregates
+    //
+    pthread_mutex_t aggregateLock;
+
+    // file => TU size in MB when it was last parsed, guarded by g_worklock
+    //
+    std::map<std::string, double> tuSizes;
+
+    // key prefix => keys deleted since the indexer started, for scheduling compactions, guarded
+    //    by g_worklock
+    //
+    std::map<std::string, long> deletedKeys;
+};
+
+std::map<int, ProjectIndexer*> g_indexers;
+int g_nextIndexerId = 1;
+
+// Projects that have queued work, in the order they will be served. A worker takes one file
+//    from the project at the front and moves the project to the back, so that a project with
+//    a huge queue cannot starve the others.
+//
+std::deque<ProjectIndexer*> g_runnable;
+std::deque<ProjectIndexer*> g_runnableLow;
+
+// A file that runs past its project's time budget is marked stuck by the watchdog, which starts
+//    a replacement worker so that the rest of the queues keep their throughput. Once the stuck
+//    file is done, the pool shrinks back to g_poolTarget.
+//
+struct ActiveTask
+{
+    ProjectIndexer* indexer;
+    std::string fileName;
+    double startTime;
+    bool stuck;
+    // a worker was started in place of this one, and is counted in g_stuckWorkers
+    bool replaced;
+    int generation;
+    double estimateMb;
 };
 
-std::queue<CompileCommand> work;
-int g_outstandingTasks = 0;
-typedef std::set<std::string> AllowedFiles_t;
+std::list<ActiveTask*> g_activeTasks;
+int g_stuckWorkers = 0;
+bool g_watchdogStarted = false;
+
+// g_poolSize and g_stuckWorkers only count the workers of the current generation. Leaving
+//    background mode starts a new generation, since a thread cannot raise its own priority
+//    back without privileges, and the old workers exit after their current file.
+//
+int g_poolSize = 0;
+int g_poolTarget = 0;
+int g_poolGeneration = 0;
+int g_maxPoolSize = std::max(1u, std::thread::hardware_concurrency() * 3 / 2);
+// the pool size set with set_pool_option, which projects that start later do not override; 0
+//    while the pool grows with the projects
+int g_userPoolSize = 0;
+bool g_background = false;
+
+// Admission control: a worker only starts a file if the estimated TU sizes of the running files
+//    stay under g_memoryLimitMb, and the system keeps g_memoryReserveMb available after it.
+//
+double g_memoryLimitMb = 0;
+double g_memoryReserveMb = c_defaultMemoryReserveMb;
+double g_admittedMb = 0;
+double g_averageTuMb = c_initialTuEstimateMb;
+long g_admissionWaits = 0;
 
 pthread_mutex_t g_worklock = PTHREAD_MUTEX_INITIALIZER;
 pthread_cond_t g_workcond = PTHREAD_COND_INITIALIZER;
-pthread_cond_t g_finished_cond = PTHREAD_COND_INITIALIZER;
+
+double CurrentTime()
+{
+    struct timeval now;
+    gettimeofday(&now, NULL);
+    return now.tv_sec + now.tv_usec / 1000000.0;
+}
+
+// Must hold g_worklock.
+//
+void RecordEvent(ProjectIndexer* indexer, const char* type, const std::string& fileName)
+{
+    IndexerEvent event;
+    event.seq = ++indexer->lastEventSeq;
+    event.type = type;
+    event.fileName = fileName;
+    event.time = CurrentTime();
+
+    indexer->events.push_back(event);
+    if (indexer->events.size() > c_maxEvents)
+    {
+        indexer->events.pop_front();
+    }
+    pthread_cond_broadcast(&indexer->eventCond);
+}
+
+void RecordEventLocked(ProjectIndexer* indexer, const char* type, const std::string& fileName)
+{
+    pthread_mutex_lock(&g_worklock);
+    RecordEvent(indexer, type, fileName);
+    pthread_mutex_unlock(&g_worklock);
+}
+
+// Must hold g_worklock. The queue owns the command's strings from here on.
+//
+void EnqueueWork(ProjectIndexer* indexer, const CompileCommand& command)
+{
+    if (command.tier == 2 &&
+            !indexer->referencePasses.insert(std::make_pair(std::string(command.fileName), command.modTime)).second)
+    {
+        // the same pass is already queued or running, and would count its references again
+        CompileCommand duplicate = command;
+        duplicate.Clear();
+        return;
+    }
+
+    indexer->outstandingTasks++;
+    if (command.tier == 2)
+    {
+        indexer->lowWork.push(command);
+        if (!indexer->lowScheduled && !indexer->paused)
+        {
+            indexer->lowScheduled = true;
+            g_runnableLow.push_back(indexer);
+        }
+    }
+    else
+    {
+        indexer->work.push(command);
+        if (!indexer->scheduled && !indexer->paused)
+        {
+            indexer->scheduled = true;
+            g_runnable.push_back(indexer);
+        }
+    }
+    pthread_cond_signal(&g_workcond);
+}
+
+// Converts an absolute deadline in seconds to what pthread_cond_timedwait expects.
+//
+struct timespec DeadlineToTimespec(double deadline)
+{
+    struct timespec ret;
+    ret.tv_sec = (time_t) deadline;
+    ret.tv_nsec = (long) ((deadline - ret.tv_sec) * 1000000000.0);
+    return ret;
+}
 
 std::string ExtractString(CXString clangString)
 {
@@ -206,7 +542,7 @@ time_t GetFileModificationTime(const char* fileName)
     return info.st_mtime;
 }
 
-bool NeedToParseFile(std::string fileName, time_t& actualModTime, time_t& savedModTime)
+bool NeedToParseFile(leveldb::DB* db, std::string fileName, time_t& actualModTime, time_t& savedModTime)
 {
     if (actualModTime == 0)
     {
@@ -225,7 +561,7 @@ bool NeedToParseFile(std::string fileName, time_t& actualModTime, time_t& savedM
     return actualModTime > savedModTime;
 }
 
-void SaveParsedFile(std::string fileName, time_t modTime)
+void SaveParsedFile(leveldb::DB* db, std::string fileName, time_t modTime)
 {
     char buf[100];
     snprintf(buf, sizeof(buf), "%ld", modTime);
@@ -234,412 +570,2673 @@ void SaveParsedFile(std::string fileName, time_t modTime)
             + std::string("%%%") + fileName, std::string("1"));
 }
 
-struct IncludedFileContext
+// t%%%<file> => 1 after the declaration pass, 2 once the references are in too. Files indexed
+//    in one pass get 2, and so do the files of indexes that predate tiers, which have no entry.
+//
+int GetTier(leveldb::DB* db, const std::string& fileName)
 {
-    std::string originFile;
-    AllowedFiles_t allowedFiles;
-};
+    std::string value;
+    if (!db->Get(leveldb::ReadOptions(), std::string("t%%%") + fileName, &value).ok())
+    {
+        return 2;
+    }
+    return atoi(value.c_str());
+}
 
-void IncludedFileVisitor(CXFile includedFile, CXSourceLocation* inclusionStack, uint32_t includeLen, CXClientData data)
+void SaveTier(leveldb::DB* db, const std::string& fileName, int tier)
 {
-    std::string relativeFileName = ExtractString(clang_getFileName(includedFile));
-    std::string fileName = NormPath(relativeFileName);
+    db->Put(leveldb::WriteOptions(), std::string("t%%%") + fileName, tier == 1 ? std::string("1") : std::string("2"));
+}
 
-    time_t actualModTime = GetFileModificationTime(fileName.c_str());
+// true if the reference pass of originFile has something to visit: the file itself, or one of the
+//    headers it claimed (h%%%<header> => originFile), is still at tier 1
+//
+bool HasTierOneFiles(leveldb::DB* db, const std::string& originFile)
+{
+    if (GetTier(db, originFile) == 1)
+    {
+        return true;
+    }
 
-    IncludedFileContext* ctx = reinterpret_cast<IncludedFileContext*>(data); 
-    if (fileName == ctx->originFile)
+    bool ret = false;
+    std::string rangeEnd("t%%^");
+    leveldb::Iterator* iter = db->NewIterator(leveldb::ReadOptions());
+    for (iter->Seek(leveldb::Slice("t%%%")); iter->Valid() && iter->key().compare(leveldb::Slice(rangeEnd)) < 0; iter->Next())
     {
-        return;
+        if (iter->value() != leveldb::Slice("1"))
+        {
+            continue;
+        }
+        std::string header = iter->key().ToString().substr(4);
+        std::string origin;
+        if (db->Get(leveldb::ReadOptions(), std::string("h%%%") + header, &origin).ok() && origin == originFile)
+        {
+            ret = true;
+            break;
+        }
     }
+    delete iter;
+    return ret;
+}
 
-    std::string modTime;
-    time_t savedModTime = 0;
+// x%%%<file> => <failures> <next retry> <mtime> <args hash>\n<diagnostics>
+//    Files that libclang could not parse are not stamped, and are retried with an exponential
+//    backoff. After maxParseAttempts failures the file is skipped until its mtime or its compile
+//    command changes. Files that parse with errors are indexed as usual and recorded with 0
+//    failures, so that their diagnostics can be listed.
+//
+struct ParseFailure
+{
+    int failures;
+    double nextRetry;
+    time_t modTime;
+    size_t argsHash;
+};
 
-    if (!NeedToParseFile(fileName, actualModTime, savedModTime))
+size_t HashArgs(const CompileCommand& command)
+{
+    std::string joined;
+    for (int i = 0; i < command.nargs; i++)
     {
-        return;
+        joined += command.args[i];
+        joined += '\0';
     }
+    return std::hash<std::string>()(joined);
+}
 
-    pthread_mutex_lock(&g_worklock);
-    Auto(pthread_mutex_unlock(&g_worklock));
-
-    // Repeat the same check, but with the lock
-    //
-    if (!NeedToParseFile(fileName, actualModTime, savedModTime))
+bool GetParseFailure(leveldb::DB* db, const std::string& fileName, ParseFailure& failure)
+{
+    std::string value;
+    if (!db->Get(leveldb::ReadOptions(), std::string("x%%%") + fileName, &value).ok())
     {
-        return;
+        return false;
     }
 
-    ctx->allowedFiles.insert(fileName);
+    long savedModTime = 0;
+    if (sscanf(value.c_str(), "%d %lf %ld %zu", &failure.failures, &failure.nextRetry, &savedModTime, &failure.argsHash) != 4)
+    {
+        return false;
+    }
+    failure.modTime = savedModTime;
+    return true;
+}
 
-    SaveParsedFile(fileName, actualModTime);
-    db->Put(leveldb::WriteOptions(), std::string("h%%%") + fileName, ctx->originFile);
+void SaveParseFailure(leveldb::DB* db, const std::string& fileName, const ParseFailure& failure, const std::string& diagnostics)
+{
+    char buf[200];
+    snprintf(buf, sizeof(buf), "%d %.0f %ld %zu\n", failure.failures, failure.nextRetry, (long) failure.modTime, failure.argsHash);
+    db->Put(leveldb::WriteOptions(), std::string("x%%%") + fileName, std::string(buf) + diagnostics);
 }
 
-CXChildVisitResult SymbolVisitor(CXCursor cursor, CXCursor parent, CXClientData data)
+void ClearParseFailure(leveldb::DB* db, const std::string& fileName)
 {
-    CXSourceLocation source = clang_getCursorLocation(cursor);
-    CXFile cxfile;
-    uint32_t lineNumber = 0;
-    uint32_t columnNumber = 0;
-    clang_getExpansionLocation(source, &cxfile, &lineNumber, &columnNumber, nullptr);
-    std::string relativeFileName = ExtractString(clang_getFileName(cxfile));
+    db->Delete(leveldb::WriteOptions(), std::string("x%%%") + fileName);
+}
 
-    if (relativeFileName.empty())
-    {
-        return CXChildVisit_Recurse;
-    }
+// Whether a file that failed before is still backing off, or gave up on, for this content and
+//    compile command. hasFailure is set if the file has an x%%% entry, failedBefore if it counts
+//    against this content and compile command.
+//
+bool IsParseBackingOff(ProjectIndexer* indexer, const std::string& fileName, time_t modTime, size_t argsHash,
+        ParseFailure& failure, bool& hasFailure, bool& failedBefore)
+{
+    hasFailure = GetParseFailure(indexer->db, fileName, failure);
+    failedBefore = hasFailure && failure.modTime == modTime && failure.argsHash == argsHash;
+    return failedBefore && failure.failures > 0 &&
+            (failure.failures >= indexer->maxParseAttempts || CurrentTime() < failure.nextRetry);
+}
 
-    std::string fileName = NormPath(relativeFileName);
+// Records one more failed parse of the file, and when to retry it.
+//
+void SaveFailedParse(ProjectIndexer* indexer, const std::string& fileName, time_t modTime, size_t argsHash,
+        ParseFailure& failure, bool failedBefore)
+{
+    failure.failures = (failedBefore ? failure.failures : 0) + 1;
+    failure.nextRetry = CurrentTime() + std::min(indexer->maxParseRetrySeconds,
+            indexer->parseRetrySeconds * (1 << std::min(failure.failures - 1, 20)));
+    failure.modTime = modTime;
+    failure.argsHash = argsHash;
+    SaveParseFailure(indexer->db, fileName, failure, std::string("libclang could not parse the file\n"));
+}
 
-    AllowedFiles_t* allowedFiles = reinterpret_cast<AllowedFiles_t*>(data);
-    bool foundMatch = false;
-    for (std::string actualFileName : *allowedFiles)
+// Errors and fatal errors only, one per line.
+//
+std::string GetErrorDiagnostics(CXTranslationUnit tu)
+{
+    std::string ret;
+    unsigned numDiagnostics = clang_getNumDiagnostics(tu);
+    for (unsigned i = 0; i < numDiagnostics; i++)
     {
-        if (strcmp(fileName.c_str(), actualFileName.c_str()) == 0)
+        CXDiagnostic diagnostic = clang_getDiagnostic(tu, i);
+        if (clang_getDiagnosticSeverity(diagnostic) >= CXDiagnostic_Error)
         {
-            foundMatch = true;
-            break;
+            ret += ExtractString(clang_formatDiagnostic(diagnostic, clang_defaultDiagnosticDisplayOptions()));
+            ret += '\n';
         }
+        clang_disposeDiagnostic(diagnostic);
     }
+    return ret;
+}
+
+// slow%%%<file> => <times over budget> <seconds> <memory mb> <mode> <reason> <mtime>
+//    Files that went over their time or memory budget. <mode> is how the file is parsed the next
+//    time: "cheap" skips function bodies and the preprocessing record. It only holds for the
+//    content at <mtime>, a file that changes gets a full parse again.
+//
+struct SlowFile
+{
+    int timesOverBudget;
+    double seconds;
+    double memoryMb;
+    bool cheap;
+    time_t modTime;
+};
 
-    if (!foundMatch)
+bool GetSlowFile(leveldb::DB* db, const std::string& fileName, SlowFile& slowFile)
+{
+    std::string value;
+    if (!db->Get(leveldb::ReadOptions(), std::string("slow%%%") + fileName, &value).ok())
     {
-        return CXChildVisit_Continue;
+        return false;
     }
 
-    int kind = (int) clang_getCursorKind(cursor);
-    if (clang_isCursorDefinition(cursor))
+    char mode[16];
+    char reason[32];
+    // entries from before <mtime> was recorded have none, and count as a different content
+    long savedModTime = 0;
+    if (sscanf(value.c_str(), "%d %lf %lf %15s %31s %ld", &slowFile.timesOverBudget, &slowFile.seconds,
+            &slowFile.memoryMb, mode, reason, &savedModTime) < 4)
     {
-        kind = -kind;
+        return false;
     }
-    char kindBuf[32];
-    snprintf(kindBuf, sizeof(kindBuf), "%d", kind);
+    slowFile.cheap = strcmp(mode, "cheap") == 0;
+    slowFile.modTime = savedModTime;
+    return true;
+}
 
-    std::string symbol = ExtractString(clang_getCursorUSR(cursor));
-    std::string spelling = GetSpelling(cursor);
-    std::string displayName = ExtractString(clang_getCursorDisplayName(cursor));
+void SaveSlowFile(leveldb::DB* db, const std::string& fileName, const SlowFile& slowFile, const char* reason)
+{
+    char buf[200];
+    snprintf(buf, sizeof(buf), "%d %.3f %.1f %s %s %ld", slowFile.timesOverBudget, slowFile.seconds, slowFile.memoryMb,
+            slowFile.cheap ? "cheap" : "full", reason, (long) slowFile.modTime);
+    db->Put(leveldb::WriteOptions(), std::string("slow%%%") + fileName, std::string(buf));
+}
 
-    if (!symbol.empty() && spelling.empty())
+double GetMemoryUsageMb(CXTranslationUnit tu)
+{
+    CXTUResourceUsage usage = clang_getCXTUResourceUsage(tu);
+    double total = 0;
+    for (unsigned i = 0; i < usage.numEntries; i++)
     {
-        spelling = displayName;
+        total += usage.entries[i].amount;
     }
+    clang_disposeCXTUResourceUsage(usage);
+    return total / (1024 * 1024);
+}
 
-    bool addToN = true;
-
-    CXCursor reference = clang_getCursorReferenced(cursor);
-    if (!clang_Cursor_isNull(reference))
+int MatchScopeRule(const std::vector<ScopeRule>& rules, const std::string& fileName, bool isSystemHeader)
+{
+    for (size_t i = 0; i < rules.size(); i++)
     {
-        if (symbol.empty())
+        const ScopeRule& rule = rules[i];
+        bool matches = false;
+        if (rule.systemHeaders)
         {
-            symbol = ExtractString(clang_getCursorUSR(reference));
-            addToN = false;
+            matches = isSystemHeader;
         }
-        if (spelling.empty())
+        else if (rule.glob)
         {
-            spelling = GetSpelling(reference);
+            matches = fnmatch(rule.pattern.c_str(), fileName.c_str(), 0) == 0;
         }
-        if (!symbol.empty() && spelling.empty())
+        else
         {
-            spelling = ExtractString(clang_getCursorDisplayName(reference));
+            matches = fileName.compare(0, rule.pattern.size(), rule.pattern) == 0;
         }
-    }
-
-    if (!symbol.empty() && !spelling.empty())
-    {
-        leveldb::WriteBatch batch;
-        batch.Put(std::string("spelling%%%") + symbol, spelling);
-
-        std::string key = std::string("c%%%") + fileName + std::string("%%%") + symbol;
-        batch.Put(key, std::string("1"));
-
-        std::stringstream locationString;
-        locationString << "s%%%" << symbol << "%%%" << fileName << "%%%" << lineNumber << "%%%" << columnNumber;
-        batch.Put(locationString.str(), std::string(kindBuf));
 
-        if (addToN)
+        if (matches)
         {
-            CXCursor parent = cursor;
-            while (!clang_Cursor_isNull(parent = clang_getCursorSemanticParent(parent)))
-            {
-                std::string parentSpelling = GetSpelling(parent);
-                if (!parentSpelling.empty())
-                {
-                    displayName = parentSpelling + std::string("::") + displayName;
-                }
-            }
-
-            for (size_t i = 0; i < spelling.size(); i++)
-            {
-                std::string suffix = std::string(spelling, i, spelling.size());
-                std::transform(suffix.begin(), suffix.end(), suffix.begin(), ::tolower);
-
-                std::stringstream suffixStream;
-                suffixStream << DbEntryPrefix(i, cursor) << "%%%" << suffix << "%%%" << symbol << "%%%" << fileName 
-                                << "%%%" << lineNumber << "%%%" << columnNumber << "%%%" << displayName;
-                batch.Put(suffixStream.str(), std::string(kindBuf));
-            }
+            return (int) i;
         }
-
-        db->Write(leveldb::WriteOptions(), &batch);
     }
-
-    return CXChildVisit_Recurse;
+    return -1;
 }
 
-void DeleteFromIndex(std::string prefix, leveldb::WriteBatch* batch, 
-        const std::function<void (std::string, leveldb::WriteBatch*)> callback)
+bool HasSystemHeadersRule(const std::vector<ScopeRule>& rules)
 {
-    std::string rangeStart = prefix + std::string("%%%");
-    std::string rangeEnd = prefix + std::string("%%^");
-    leveldb::Iterator* iter = db->NewIterator(leveldb::ReadOptions());
-    leveldb::Slice start(rangeStart);
-    leveldb::Slice end(rangeEnd);
-
-    iter->Seek(start);
-    while(iter->Valid())
+    for (const ScopeRule& rule : rules)
     {
-        leveldb::Slice key = iter->key();
-        if (key.compare(end) >= 0)
+        if (rule.systemHeaders)
         {
-            break;
+            return true;
         }
-
-        std::string keyS(key.data(), 0, key.size());
-        batch->Delete(key);
-        callback(keyS, batch);
-        iter->Next();
     }
-
-    delete iter;
+    return false;
+}
+
+long GetFileSize(const std::string& fileName)
+{
+    struct stat info;
+    if (stat(fileName.c_str(), &info) != 0)
+    {
+        return 0;
+    }
+    return info.st_size;
+}
+
+// Names of a cursor that the extraction needs over and over in a TU: the USR, spelling and display
+//    name of the declarations that references point to, and the qualified name prefix of the
+//    namespaces and classes that declarations are in. Each is computed on first use.
+//
+struct CursorNames
+{
+    CursorNames(CXCursor arg_cursor)
+    {
+        cursor = arg_cursor;
+        hasUsr = false;
+        hasSpelling = false;
+        hasDisplayName = false;
+        hasQualifiedPrefix = false;
+    }
+
+    CXCursor cursor;
+    bool hasUsr, hasSpelling, hasDisplayName, hasQualifiedPrefix;
+    std::string usr;
+    std::string spelling;
+    std::string displayName;
+    std::string qualifiedPrefix;
+};
+
+// clang_hashCursor => names, entries stay in place as the table grows
+//
+typedef std::unordered_multimap<unsigned, CursorNames> CursorNames_t;
+
+// What a TU found of one symbol in one file, the value of its c%%% entry once committed.
+//
+struct SymbolCounts
+{
+    std::string symbol;
+    long refs;
+    long defs;
+};
+
+struct IncludedFileContext
+{
+    ProjectIndexer* indexer;
+    std::string originFile;
+    AllowedFiles_t allowedFiles;
+
+    // a copy of the project's scope rules, what they saved in this TU, and the excluded files
+    //    that were seen for the first time in this TU
+    //
+    CXTranslationUnit tu;
+    std::vector<ScopeRule> scopeRules;
+    bool checkSystemHeaders;
+    std::vector<ScopeRuleStats> scopeStats;
+    AllowedFiles_t excludedFiles;
+
+    // the symbol visitor stops once the extraction deadline passes
+    //
+    double deadline;
+    int visited;
+    bool truncated;
+
+    // see CompileCommand::tier
+    //
+    int tier;
+
+    // the files that the index action extractor has seen an entry of
+    //
+    std::set<std::string> checkedFiles;
+
+    // valid as long as tu, see CursorNames
+    //
+    CursorNames_t cursorNames;
+
+    // what this TU wrote already: the symbols of its spelling%%% entries and the keys of its s%%%
+    //    entries, which every reference would write again otherwise
+    //
+    std::unordered_set<std::string> writtenSpellings;
+    std::unordered_set<std::string> writtenLocations;
+    long writesSkipped;
+    long writeBytesSkipped;
+
+    // c%%% key => what the TU found, committed by CommitSymbolCounts
+    //
+    std::map<std::string, SymbolCounts> symbolCounts;
+
+    // the cg%%% and th%%% keys of the call graph and type hierarchy edges this TU wrote
+    //
+    std::unordered_set<std::string> writtenEdges;
+};
+
+CursorNames& LookupCursorNames(IncludedFileContext* ctx, CXCursor cursor)
+{
+    unsigned hash = clang_hashCursor(cursor);
+    auto range = ctx->cursorNames.equal_range(hash);
+    for (auto it = range.first; it != range.second; ++it)
+    {
+        if (clang_equalCursors(it->second.cursor, cursor))
+        {
+            return it->second;
+        }
+    }
+    return ctx->cursorNames.insert(std::make_pair(hash, CursorNames(cursor)))->second;
+}
+
+const std::string& CursorUsr(IncludedFileContext* ctx, CXCursor cursor)
+{
+    CursorNames& names = LookupCursorNames(ctx, cursor);
+    if (!names.hasUsr)
+    {
+        names.usr = ExtractString(clang_getCursorUSR(cursor));
+        names.hasUsr = true;
+    }
+    return names.usr;
+}
+
+const std::string& CursorSpelling(IncludedFileContext* ctx, CXCursor cursor)
+{
+    CursorNames& names = LookupCursorNames(ctx, cursor);
+    if (!names.hasSpelling)
+    {
+        names.spelling = GetSpelling(cursor);
+        names.hasSpelling = true;
+    }
+    return names.spelling;
+}
+
+const std::string& CursorDisplayName(IncludedFileContext* ctx, CXCursor cursor)
+{
+    CursorNames& names = LookupCursorNames(ctx, cursor);
+    if (!names.hasDisplayName)
+    {
+        names.displayName = ExtractString(clang_getCursorDisplayName(cursor));
+        names.hasDisplayName = true;
+    }
+    return names.displayName;
+}
+
+// what the names declared in cursor are qualified with, e.g. "ns::Class::" for a class in a namespace
+//
+std::string QualifiedPrefix(IncludedFileContext* ctx, CXCursor cursor)
+{
+    if (clang_Cursor_isNull(cursor))
+    {
+        return std::string("");
+    }
+
+    CursorNames& names = LookupCursorNames(ctx, cursor);
+    if (!names.hasQualifiedPrefix)
+    {
+        std::string prefix = QualifiedPrefix(ctx, clang_getCursorSemanticParent(cursor));
+        const std::string& spelling = CursorSpelling(ctx, cursor);
+        if (!spelling.empty())
+        {
+            prefix += spelling + std::string("::");
+        }
+        names.qualifiedPrefix = prefix;
+        names.hasQualifiedPrefix = true;
+    }
+    return names.qualifiedPrefix;
+}
+
+void SkipWrite(IncludedFileContext* ctx, const std::string& key, const std::string& value)
+{
+    ctx->writesSkipped++;
+    ctx->writeBytesSkipped += key.size() + value.size();
+}
+
+bool IsStored(leveldb::DB* db, const std::string& key, const std::string& value)
+{
+    std::string stored;
+    return db->Get(leveldb::ReadOptions(), key, &stored).ok() && stored == value;
+}
+
+// Decides whether this TU writes the entries of an included file, and adds it to allowedFiles if so.
+//    A header is claimed by the first TU that sees it changed, see the h%%% entries.
+//
+void ClaimIncludedFile(IncludedFileContext* ctx, const std::string& fileName, bool isSystemHeader)
+{
+    time_t actualModTime = GetFileModificationTime(fileName.c_str());
+
+    // excluded files are never claimed, so nothing about them is written
+    //
+    int rule = MatchScopeRule(ctx->scopeRules, fileName, isSystemHeader);
+    if (rule >= 0 && ctx->scopeRules[rule].mode == Scope_Exclude)
+    {
+        pthread_mutex_lock(&g_worklock);
+        bool firstSeen = ctx->indexer->scopeSeen.insert(fileName).second;
+        pthread_mutex_unlock(&g_worklock);
+
+        if (firstSeen)
+        {
+            ctx->excludedFiles[fileName] = rule;
+            ctx->scopeStats[rule].files++;
+            ctx->scopeStats[rule].sourceBytes += GetFileSize(fileName);
+        }
+        return;
+    }
+
+    leveldb::DB* db = ctx->indexer->db;
+
+    // the reference pass covers the headers that the declaration pass of the same file claimed
+    //
+    if (ctx->tier == 2)
+    {
+        std::string claimedBy;
+        if (db->Get(leveldb::ReadOptions(), std::string("h%%%") + fileName, &claimedBy).ok() &&
+                claimedBy == ctx->originFile && GetTier(db, fileName) == 1)
+        {
+            ctx->allowedFiles[fileName] = rule;
+        }
+        return;
+    }
+
+    std::string modTime;
+    time_t savedModTime = 0;
+
+    if (!NeedToParseFile(db, fileName, actualModTime, savedModTime))
+    {
+        return;
+    }
+
+    pthread_mutex_lock(&ctx->indexer->claimLock);
+    Auto(pthread_mutex_unlock(&ctx->indexer->claimLock));
+
+    // Repeat the same check, but with the lock
+    //
+    if (!NeedToParseFile(db, fileName, actualModTime, savedModTime))
+    {
+        return;
+    }
+
+    ctx->allowedFiles[fileName] = rule;
+    if (rule >= 0)
+    {
+        ctx->scopeStats[rule].files++;
+    }
+
+    SaveParsedFile(db, fileName, actualModTime);
+    db->Put(leveldb::WriteOptions(), std::string("h%%%") + fileName, ctx->originFile);
+}
+
+// Takes back the claims of a TU whose extraction did not complete: the headers keep their h%%%
+//    entry but lose their stamp, so the next TU that includes them (or a rescan, see
+//    Project.scan_and_index) indexes them again.
+//
+void UnclaimIncludedFiles(IncludedFileContext* ctx)
+{
+    for (auto& allowedFile : ctx->allowedFiles)
+    {
+        if (allowedFile.first != ctx->originFile)
+        {
+            SaveParsedFile(ctx->indexer->db, allowedFile.first, 0);
+        }
+    }
+}
+
+void IncludedFileVisitor(CXFile includedFile, CXSourceLocation* inclusionStack, uint32_t includeLen, CXClientData data)
+{
+    std::string relativeFileName = ExtractString(clang_getFileName(includedFile));
+    std::string fileName = NormPath(relativeFileName);
+
+    IncludedFileContext* ctx = reinterpret_cast<IncludedFileContext*>(data); 
+    if (fileName == ctx->originFile)
+    {
+        return;
+    }
+
+    bool isSystemHeader = ctx->checkSystemHeaders &&
+            clang_Location_isInSystemHeader(clang_getLocation(ctx->tu, includedFile, 1, 1));
+    ClaimIncludedFile(ctx, fileName, isSystemHeader);
+}
+
+// Where the entries of a cursor are recorded: the expansion location, so that what a macro expands
+//    to is found at the macro. Returns false for cursors that are not in a file.
+//
+bool GetCursorPosition(CXCursor cursor, std::string& fileName, uint32_t& lineNumber, uint32_t& columnNumber)
+{
+    CXSourceLocation source = clang_getCursorLocation(cursor);
+    CXFile cxfile;
+    clang_getExpansionLocation(source, &cxfile, &lineNumber, &columnNumber, nullptr);
+    std::string relativeFileName = ExtractString(clang_getFileName(cxfile));
+
+    if (relativeFileName.empty())
+    {
+        return false;
+    }
+
+    fileName = NormPath(relativeFileName);
+    return true;
+}
+
+bool IsFunctionKind(CXCursorKind cursorKind)
+{
+    return cursorKind == CXCursor_FunctionDecl || cursorKind == CXCursor_CXXMethod ||
+            cursorKind == CXCursor_Constructor || cursorKind == CXCursor_Destructor ||
+            cursorKind == CXCursor_ConversionFunction || cursorKind == CXCursor_FunctionTemplate;
+}
+
+// The function whose body cursor is in, or a null cursor if it is not in one.
+//
+CXCursor EnclosingFunction(CXCursor cursor)
+{
+    CXCursor parent = clang_getCursorSemanticParent(cursor);
+    while (!clang_Cursor_isNull(parent))
+    {
+        CXCursorKind parentKind = clang_getCursorKind(parent);
+        if (IsFunctionKind(parentKind))
+        {
+            return parent;
+        }
+        if (clang_isTranslationUnit(parentKind) || clang_isInvalid(parentKind))
+        {
+            break;
+        }
+
+        CXCursor next = clang_getCursorSemanticParent(parent);
+        if (clang_equalCursors(next, parent))
+        {
+            break;
+        }
+        parent = next;
+    }
+    return clang_getNullCursor();
+}
+
+// The edges of the call graph and the type hierarchy, each stored under three prefixes:
+//
+//    <forward>%%%<from>%%%<to>%%%<file> => <line> <col>
+//    <backward>%%%<to>%%%<from>%%%<file> => <line> <col>
+//    <perFile>%%%<file>%%%<from>%%%<to> => 1, to delete the edges of a file
+//
+struct EdgeIndex
+{
+    const char* perFile;
+    const char* forward;
+    const char* backward;
+};
+
+const EdgeIndex c_callGraph = {"cg", "calls", "calledby"};
+const EdgeIndex c_typeHierarchy = {"th", "bases", "derived"};
+
+// Writes an edge of a file once per TU, with the first of its sites in the file.
+//
+void RecordEdge(IncludedFileContext* ctx, const EdgeIndex& edges, const std::string& from, const std::string& to,
+        const std::string& fileName, uint32_t lineNumber, uint32_t columnNumber, leveldb::WriteBatch* batch)
+{
+    std::string fileKey = std::string(edges.perFile) + "%%%" + fileName + "%%%" + from + "%%%" + to;
+    if (!ctx->writtenEdges.insert(fileKey).second)
+    {
+        return;
+    }
+
+    char site[64];
+    snprintf(site, sizeof(site), "%u %u", lineNumber, columnNumber);
+    batch->Put(fileKey, std::string("1"));
+    batch->Put(std::string(edges.forward) + "%%%" + from + "%%%" + to + "%%%" + fileName, std::string(site));
+    batch->Put(std::string(edges.backward) + "%%%" + to + "%%%" + from + "%%%" + fileName, std::string(site));
+}
+
+// Writes the call graph edge from the function that cursor is in to callee, a function that cursor
+//    references: a call, or a use such as taking its address.
+//
+void RecordCall(IncludedFileContext* ctx, CXCursor cursor, const std::string& callee, const std::string& fileName,
+        uint32_t lineNumber, uint32_t columnNumber, leveldb::WriteBatch* batch)
+{
+    CXCursor callerCursor = EnclosingFunction(cursor);
+    if (clang_Cursor_isNull(callerCursor))
+    {
+        return;
+    }
+    const std::string& caller = CursorUsr(ctx, callerCursor);
+    if (caller.empty())
+    {
+        return;
+    }
+
+    RecordEdge(ctx, c_callGraph, caller, callee, fileName, lineNumber, columnNumber, batch);
+}
+
+// The class that a base specifier names, the template itself if it names a specialization of one.
+//
+CXCursor BaseClass(CXCursor baseSpecifier)
+{
+    CXCursor base = clang_getCursorReferenced(baseSpecifier);
+    if (clang_Cursor_isNull(base) || clang_isInvalid(clang_getCursorKind(base)))
+    {
+        base = clang_getTypeDeclaration(clang_getCursorType(baseSpecifier));
+    }
+
+    CXCursor specialized = clang_getSpecializedCursorTemplate(base);
+    if (!clang_Cursor_isNull(specialized) && !clang_isInvalid(clang_getCursorKind(specialized)))
+    {
+        base = specialized;
+    }
+    return base;
+}
+
+// Writes the type hierarchy edge from the class declared by derived to the class that the base
+//    specifier names. Bases that do not resolve to a class, such as dependent ones, are skipped.
+//
+void RecordBase(IncludedFileContext* ctx, CXCursor derived, CXCursor baseSpecifier, const std::string& fileName,
+        uint32_t lineNumber, uint32_t columnNumber)
+{
+    CXCursor base = BaseClass(baseSpecifier);
+    if (clang_Cursor_isNull(base) || clang_isInvalid(clang_getCursorKind(base)))
+    {
+        return;
+    }
+
+    const std::string& derivedSymbol = CursorUsr(ctx, derived);
+    const std::string& baseSymbol = CursorUsr(ctx, base);
+    if (derivedSymbol.empty() || baseSymbol.empty())
+    {
+        return;
+    }
+
+    leveldb::WriteBatch batch;
+    RecordEdge(ctx, c_typeHierarchy, derivedSymbol, baseSymbol, fileName, lineNumber, columnNumber, &batch);
+    ctx->indexer->db->Write(leveldb::WriteOptions(), &batch);
+}
+
+// Writes the spelling%%%, c%%%, s%%% and n* entries for one cursor of a file that this TU indexes.
+//    Shared by both extractors, so that they produce the same keys.
+//
+void RecordCursor(IncludedFileContext* ctx, CXCursor cursor, const std::string& fileName, uint32_t lineNumber, uint32_t columnNumber)
+{
+    int kind = (int) clang_getCursorKind(cursor);
+    if (clang_isCursorDefinition(cursor))
+    {
+        kind = -kind;
+    }
+    char kindBuf[32];
+    snprintf(kindBuf, sizeof(kindBuf), "%d", kind);
+
+    std::string symbol = ExtractString(clang_getCursorUSR(cursor));
+    std::string spelling = GetSpelling(cursor);
+    std::string displayName = ExtractString(clang_getCursorDisplayName(cursor));
+
+    if (!symbol.empty() && spelling.empty())
+    {
+        spelling = displayName;
+    }
+
+    bool addToN = true;
+
+    CXCursor reference = clang_getCursorReferenced(cursor);
+    if (!clang_Cursor_isNull(reference))
+    {
+        if (symbol.empty())
+        {
+            symbol = CursorUsr(ctx, reference);
+            addToN = false;
+        }
+        if (spelling.empty())
+        {
+            spelling = CursorSpelling(ctx, reference);
+        }
+        if (!symbol.empty() && spelling.empty())
+        {
+            spelling = CursorDisplayName(ctx, reference);
+        }
+    }
+
+    if (!symbol.empty() && !spelling.empty())
+    {
+        leveldb::WriteBatch batch;
+        std::string spellingKey = std::string("spelling%%%") + symbol;
+        if (!ctx->writtenSpellings.insert(symbol).second || IsStored(ctx->indexer->db, spellingKey, spelling))
+        {
+            SkipWrite(ctx, spellingKey, spelling);
+        }
+        else
+        {
+            batch.Put(spellingKey, spelling);
+        }
+
+        // the c%%% entry is written uncommitted along with the first s%%% entry, so that the file's
+        //    entries can be removed even if the TU never gets to CommitSymbolCounts
+        //
+        std::string key = std::string("c%%%") + fileName + std::string("%%%") + symbol;
+        auto counts = ctx->symbolCounts.find(key);
+        if (counts != ctx->symbolCounts.end())
+        {
+            SkipWrite(ctx, key, std::string("1"));
+        }
+        else
+        {
+            SymbolCounts newCounts;
+            newCounts.symbol = symbol;
+            newCounts.refs = 0;
+            newCounts.defs = 0;
+            counts = ctx->symbolCounts.insert(std::make_pair(key, newCounts)).first;
+
+            // the reference pass adds to what the declaration pass committed
+            std::string stored;
+            if (ctx->tier != 2 || !ctx->indexer->db->Get(leveldb::ReadOptions(), key, &stored).ok())
+            {
+                batch.Put(key, std::string("1"));
+            }
+        }
+
+        // the declaration pass only writes what navigation needs
+        //
+        if (ctx->tier != 1)
+        {
+            std::stringstream locationString;
+            locationString << "s%%%" << symbol << "%%%" << fileName << "%%%" << lineNumber << "%%%" << columnNumber;
+            std::string locationKey = locationString.str();
+            if (!ctx->writtenLocations.insert(locationKey).second)
+            {
+                SkipWrite(ctx, locationKey, std::string(kindBuf));
+            }
+            else
+            {
+                batch.Put(locationKey, std::string(kindBuf));
+                if (kind < 0)
+                {
+                    counts->second.defs++;
+                }
+                else
+                {
+                    counts->second.refs++;
+                }
+            }
+
+            if (clang_isExpression(clang_getCursorKind(cursor)) && !clang_Cursor_isNull(reference) &&
+                    IsFunctionKind(clang_getCursorKind(reference)))
+            {
+                RecordCall(ctx, cursor, symbol, fileName, lineNumber, columnNumber, &batch);
+            }
+        }
+
+        if (addToN)
+        {
+            displayName = QualifiedPrefix(ctx, clang_getCursorSemanticParent(cursor)) + displayName;
+
+            for (size_t i = 0; i < spelling.size(); i++)
+            {
+                std::string suffix = std::string(spelling, i, spelling.size());
+                std::transform(suffix.begin(), suffix.end(), suffix.begin(), ::tolower);
+
+                std::stringstream suffixStream;
+                suffixStream << DbEntryPrefix(i, cursor) << "%%%" << suffix << "%%%" << symbol << "%%%" << fileName 
+                                << "%%%" << lineNumber << "%%%" << columnNumber << "%%%" << displayName;
+                batch.Put(suffixStream.str(), std::string(kindBuf));
+            }
+        }
+
+        ctx->indexer->db->Write(leveldb::WriteOptions(), &batch);
+    }
+}
+
+CXChildVisitResult SymbolVisitor(CXCursor cursor, CXCursor parent, CXClientData data)
+{
+    std::string fileName;
+    uint32_t lineNumber = 0;
+    uint32_t columnNumber = 0;
+    if (!GetCursorPosition(cursor, fileName, lineNumber, columnNumber))
+    {
+        return CXChildVisit_Recurse;
+    }
+
+    IncludedFileContext* ctx = reinterpret_cast<IncludedFileContext*>(data);
+    if (ctx->deadline > 0 && ++ctx->visited % c_deadlineCheckInterval == 0 && CurrentTime() > ctx->deadline)
+    {
+        ctx->truncated = true;
+        return CXChildVisit_Break;
+    }
+
+    auto allowed = ctx->allowedFiles.find(fileName);
+    if (allowed == ctx->allowedFiles.end())
+    {
+        auto excluded = ctx->excludedFiles.find(fileName);
+        if (excluded != ctx->excludedFiles.end())
+        {
+            ctx->scopeStats[excluded->second].cursorsSkipped++;
+        }
+        return CXChildVisit_Continue;
+    }
+
+    int rule = allowed->second;
+    bool scopeDeclarationsOnly = rule >= 0 && ctx->scopeRules[rule].mode == Scope_Declarations;
+    bool declarationsOnly = scopeDeclarationsOnly || ctx->tier == 1;
+    CXCursorKind cursorKind = clang_getCursorKind(cursor);
+    if (declarationsOnly && !clang_isDeclaration(cursorKind))
+    {
+        if (scopeDeclarationsOnly)
+        {
+            ctx->scopeStats[rule].cursorsSkipped++;
+        }
+        return CXChildVisit_Recurse;
+    }
+
+    RecordCursor(ctx, cursor, fileName, lineNumber, columnNumber);
+
+    if (cursorKind == CXCursor_CXXBaseSpecifier)
+    {
+        RecordBase(ctx, parent, cursor, fileName, lineNumber, columnNumber);
+    }
+
+    // function bodies only hold references and locals
+    //
+    if (declarationsOnly && IsFunctionKind(cursorKind))
+    {
+        return CXChildVisit_Continue;
+    }
+
+    return CXChildVisit_Recurse;
+}
+
+void DeleteFromIndex(leveldb::DB* db, std::string prefix, leveldb::WriteBatch* batch, 
+        const std::function<void (std::string, leveldb::WriteBatch*)> callback)
+{
+    std::string rangeStart = prefix + std::string("%%%");
+    std::string rangeEnd = prefix + std::string("%%^");
+    leveldb::Iterator* iter = db->NewIterator(leveldb::ReadOptions());
+    leveldb::Slice start(rangeStart);
+    leveldb::Slice end(rangeEnd);
+
+    iter->Seek(start);
+    while(iter->Valid())
+    {
+        leveldb::Slice key = iter->key();
+        if (key.compare(end) >= 0)
+        {
+            break;
+        }
+
+        std::string keyS(key.data(), 0, key.size());
+        batch->Delete(key);
+        callback(keyS, batch);
+        iter->Next();
+    }
+
+    delete iter;
 }
 
 void EmptyDeleteCallback(std::string, leveldb::WriteBatch*) { }
 
-void DeleteFromIndex(std::string prefix, leveldb::WriteBatch* batch)
+void DeleteFromIndex(leveldb::DB* db, std::string prefix, leveldb::WriteBatch* batch)
+{
+    DeleteFromIndex(db, prefix, batch, EmptyDeleteCallback);
+}
+
+std::string GetSymbolSpelling(leveldb::DB* db, std::string spelling)
+{
+    std::string ret;
+    leveldb::Status status = db->Get(leveldb::ReadOptions(), std::string("spelling%%%") + spelling, &ret);
+    if (status.ok())
+    {
+        return ret;
+    }
+    else
+    {
+        return std::string("(not found)");
+    }
+}
+
+void RemoveSymbol(leveldb::DB* db, std::string symbolKey, leveldb::WriteBatch* batch)
+{
+    std::string fname = ExtractPart(symbolKey, 1);
+    std::string symbol = ExtractPart(symbolKey, 2);
+    std::string spelling = GetSymbolSpelling(db, symbol);
+
+    DeleteFromIndex(db, std::string("s%%%") + symbol + std::string("%%%") + fname , batch);
+
+    // UNDONE: refactor this so it's shared with SymbolVisitor
+    //
+    for (const char* symbolType : {"def", "decl"})
+    {
+        for (size_t i = 0; i < spelling.size(); i++)
+        {
+            std::string suffix = std::string(spelling, i, spelling.size());
+            std::transform(suffix.begin(), suffix.end(), suffix.begin(), ::tolower);
+
+            std::string entryPrefix = DbEntryPrefix(i, symbolType) + "%%%" + suffix + "%%%" + symbol + "%%%" + fname;
+            DeleteFromIndex(db, entryPrefix, batch);
+        }
+    }
+}
+
+// counts the deletes in a batch by key prefix, the part before the first %%%
+//
+class DeleteCounter : public leveldb::WriteBatch::Handler
+{
+public:
+    std::map<std::string, long> counts;
+
+    virtual void Put(const leveldb::Slice& key, const leveldb::Slice& value) { }
+
+    virtual void Delete(const leveldb::Slice& key)
+    {
+        std::string keyS(key.data(), key.size());
+        counts[keyS.substr(0, keyS.find("%%%"))]++;
+    }
+};
+
+// c%%%<file>%%%<symbol> => <refs> <defs> once committed, 1 before
+// a%%%<symbol> => <refs> <defs> <files>, the sums over the committed c%%% entries of the symbol
+//
+bool ParseSymbolCounts(const std::string& value, long& refs, long& defs)
+{
+    return sscanf(value.c_str(), "%ld %ld", &refs, &defs) == 2;
+}
+
+struct SymbolAggregate
+{
+    long refs;
+    long defs;
+    long files;
+};
+
+// Adds the deltas to the a%%% entries of their symbols, in batch. Caller holds aggregateLock.
+//
+void ApplyAggregateDeltas(leveldb::DB* db, const std::map<std::string, SymbolAggregate>& deltas, leveldb::WriteBatch* batch)
+{
+    for (auto& delta : deltas)
+    {
+        std::string key = std::string("a%%%") + delta.first;
+        std::string value;
+        SymbolAggregate aggregate = {0, 0, 0};
+        if (db->Get(leveldb::ReadOptions(), key, &value).ok())
+        {
+            sscanf(value.c_str(), "%ld %ld %ld", &aggregate.refs, &aggregate.defs, &aggregate.files);
+        }
+
+        aggregate.refs = std::max(0L, aggregate.refs + delta.second.refs);
+        aggregate.defs = std::max(0L, aggregate.defs + delta.second.defs);
+        aggregate.files = std::max(0L, aggregate.files + delta.second.files);
+        if (aggregate.files == 0)
+        {
+            batch->Delete(key);
+            continue;
+        }
+
+        char buf[96];
+        snprintf(buf, sizeof(buf), "%ld %ld %ld", aggregate.refs, aggregate.defs, aggregate.files);
+        batch->Put(key, std::string(buf));
+    }
+}
+
+// Writes the counts of the TU into its c%%% entries and adds them to the a%%% aggregates.
+//
+void CommitSymbolCounts(IncludedFileContext* ctx)
+{
+    leveldb::DB* db = ctx->indexer->db;
+    leveldb::WriteBatch batch;
+    std::map<std::string, SymbolAggregate> deltas;
+
+    pthread_mutex_lock(&ctx->indexer->aggregateLock);
+    for (auto& entry : ctx->symbolCounts)
+    {
+        const SymbolCounts& counts = entry.second;
+        SymbolAggregate& delta = deltas[counts.symbol];
+
+        long refs = counts.refs;
+        long defs = counts.defs;
+        long storedRefs = 0, storedDefs = 0;
+        std::string stored;
+        if (db->Get(leveldb::ReadOptions(), entry.first, &stored).ok() && ParseSymbolCounts(stored, storedRefs, storedDefs))
+        {
+            refs += storedRefs;
+            defs += storedDefs;
+        }
+        else
+        {
+            delta.files++;
+        }
+        delta.refs += counts.refs;
+        delta.defs += counts.defs;
+
+        char buf[64];
+        snprintf(buf, sizeof(buf), "%ld %ld", refs, defs);
+        batch.Put(entry.first, std::string(buf));
+    }
+    ApplyAggregateDeltas(db, deltas, &batch);
+    db->Write(leveldb::WriteOptions(), &batch);
+    pthread_mutex_unlock(&ctx->indexer->aggregateLock);
+
+    ctx->symbolCounts.clear();
+}
+
+void RemoveFileEdges(leveldb::DB* db, const EdgeIndex& edges, const std::string& fileName, leveldb::WriteBatch* batch)
+{
+    DeleteFromIndex(db, std::string(edges.perFile) + "%%%" + fileName, batch,
+            [&edges](std::string edgeKey, leveldb::WriteBatch* batch)
+            {
+                std::string fname = ExtractPart(edgeKey, 1);
+                std::string from = ExtractPart(edgeKey, 2);
+                std::string to = ExtractPart(edgeKey, 3);
+                batch->Delete(std::string(edges.forward) + "%%%" + from + "%%%" + to + "%%%" + fname);
+                batch->Delete(std::string(edges.backward) + "%%%" + to + "%%%" + from + "%%%" + fname);
+            });
+}
+
+void RemoveFileSymbols(ProjectIndexer* indexer, std::string fileName)
+{
+    leveldb::DB* db = indexer->db;
+    leveldb::WriteBatch batch;
+    std::map<std::string, SymbolAggregate> deltas;
+
+    pthread_mutex_lock(&indexer->aggregateLock);
+    DeleteFromIndex(db, std::string("c%%%") + fileName, &batch,
+            [db, &deltas](std::string symbolKey, leveldb::WriteBatch* batch)
+            {
+                std::string value;
+                long refs = 0, defs = 0;
+                if (db->Get(leveldb::ReadOptions(), symbolKey, &value).ok() && ParseSymbolCounts(value, refs, defs))
+                {
+                    SymbolAggregate& delta = deltas[ExtractPart(symbolKey, 2)];
+                    delta.refs -= refs;
+                    delta.defs -= defs;
+                    delta.files--;
+                }
+                RemoveSymbol(db, symbolKey, batch);
+            });
+    ApplyAggregateDeltas(db, deltas, &batch);
+
+    RemoveFileEdges(db, c_callGraph, fileName, &batch);
+    RemoveFileEdges(db, c_typeHierarchy, fileName, &batch);
+
+    db->Write(leveldb::WriteOptions(), &batch);
+    pthread_mutex_unlock(&indexer->aggregateLock);
+
+    DeleteCounter counter;
+    batch.Iterate(&counter);
+    pthread_mutex_lock(&g_worklock);
+    for (auto& count : counter.counts)
+    {
+        indexer->deletedKeys[count.first] += count.second;
+    }
+    pthread_mutex_unlock(&g_worklock);
+}
+
+// The index action extractor: libclang calls back with the declarations and references of the TU
+//    as it parses it, and with CXIndexOpt_SkipParsedBodiesInSession it does not parse the bodies in
+//    headers again that an earlier file of the same session already went through. The files are
+//    claimed as their first entry comes in, since there is no TU to get the inclusions from yet.
+//
+//    Macros are not reported through this API, so their definitions and expansions are only
+//    indexed by the visitor.
+//
+
+// returns true, with the scope rule in rule, if the entries of fileName are written by this TU
+//
+bool CheckIndexedFile(IncludedFileContext* ctx, const std::string& fileName, CXCursor cursor, int& rule)
+{
+    if (ctx->checkedFiles.insert(fileName).second)
+    {
+        if (fileName != ctx->originFile)
+        {
+            bool isSystemHeader = ctx->checkSystemHeaders &&
+                    clang_Location_isInSystemHeader(clang_getCursorLocation(cursor));
+            ClaimIncludedFile(ctx, fileName, isSystemHeader);
+        }
+        if (ctx->allowedFiles.find(fileName) != ctx->allowedFiles.end())
+        {
+            RemoveFileSymbols(ctx->indexer, fileName);
+        }
+    }
+
+    auto allowed = ctx->allowedFiles.find(fileName);
+    if (allowed == ctx->allowedFiles.end())
+    {
+        auto excluded = ctx->excludedFiles.find(fileName);
+        if (excluded != ctx->excludedFiles.end())
+        {
+            ctx->scopeStats[excluded->second].cursorsSkipped++;
+        }
+        return false;
+    }
+
+    rule = allowed->second;
+    return true;
+}
+
+int IndexAbortQuery(CXClientData data, void* reserved)
+{
+    IncludedFileContext* ctx = reinterpret_cast<IncludedFileContext*>(data);
+    if (ctx->deadline > 0 && ++ctx->visited % c_deadlineCheckInterval == 0 && CurrentTime() > ctx->deadline)
+    {
+        ctx->truncated = true;
+    }
+    return ctx->truncated ? 1 : 0;
+}
+
+void IndexDeclaration(CXClientData data, const CXIdxDeclInfo* info)
+{
+    IncludedFileContext* ctx = reinterpret_cast<IncludedFileContext*>(data);
+    std::string fileName;
+    uint32_t lineNumber = 0;
+    uint32_t columnNumber = 0;
+    int rule = -1;
+    if (info->isImplicit || !GetCursorPosition(info->cursor, fileName, lineNumber, columnNumber) ||
+            !CheckIndexedFile(ctx, fileName, info->cursor, rule))
+    {
+        return;
+    }
+
+    // locals, which the visitor does not descend to in declaration only files either
+    //
+    bool declarationsOnly = rule >= 0 && ctx->scopeRules[rule].mode == Scope_Declarations;
+    if (declarationsOnly && info->lexicalContainer != nullptr &&
+            IsFunctionKind(clang_getCursorKind(info->lexicalContainer->cursor)))
+    {
+        ctx->scopeStats[rule].cursorsSkipped++;
+        return;
+    }
+
+    RecordCursor(ctx, info->cursor, fileName, lineNumber, columnNumber);
+
+    // the visitor sees the base specifiers as children of the class, but only in the files whose
+    //    references are indexed
+    //
+    const CXIdxCXXClassDeclInfo* classInfo = clang_index_getCXXClassDeclInfo(info);
+    if (classInfo != nullptr && !declarationsOnly)
+    {
+        for (unsigned i = 0; i < classInfo->numBases; i++)
+        {
+            std::string baseFileName;
+            uint32_t baseLine = 0;
+            uint32_t baseColumn = 0;
+            if (GetCursorPosition(classInfo->bases[i]->cursor, baseFileName, baseLine, baseColumn))
+            {
+                RecordBase(ctx, info->cursor, classInfo->bases[i]->cursor, baseFileName, baseLine, baseColumn);
+            }
+        }
+    }
+}
+
+void IndexEntityReference(CXClientData data, const CXIdxEntityRefInfo* info)
+{
+    IncludedFileContext* ctx = reinterpret_cast<IncludedFileContext*>(data);
+    std::string fileName;
+    uint32_t lineNumber = 0;
+    uint32_t columnNumber = 0;
+    int rule = -1;
+    if (!GetCursorPosition(info->cursor, fileName, lineNumber, columnNumber) ||
+            !CheckIndexedFile(ctx, fileName, info->cursor, rule))
+    {
+        return;
+    }
+
+    if (rule >= 0 && ctx->scopeRules[rule].mode == Scope_Declarations)
+    {
+        ctx->scopeStats[rule].cursorsSkipped++;
+        return;
+    }
+
+    RecordCursor(ctx, info->cursor, fileName, lineNumber, columnNumber);
+}
+
+// The session of the index action extractor, created on first use. Caller holds g_worklock.
+//
+CXIndexAction GetIndexAction(ProjectIndexer* indexer)
+{
+    if (indexer->indexAction == nullptr)
+    {
+        indexer->sessionIndex = clang_createIndex(0, 0);
+        indexer->indexAction = clang_IndexAction_create(indexer->sessionIndex);
+    }
+    return indexer->indexAction;
+}
+
+// Parses the file of the command and writes its entries through the callbacks above. Returns the
+//    TU, for the diagnostics and the memory budget, or nullptr if libclang could not parse the file.
+//
+CXTranslationUnit IndexWithAction(IncludedFileContext& ctx, CXIndexAction action, CompileCommand& command, unsigned parseOptions)
+{
+    IndexerCallbacks callbacks;
+    memset(&callbacks, 0, sizeof(callbacks));
+    callbacks.abortQuery = IndexAbortQuery;
+    callbacks.indexDeclaration = IndexDeclaration;
+    callbacks.indexEntityReference = IndexEntityReference;
+
+    CXTranslationUnit tu = nullptr;
+    int result = clang_indexSourceFile(action, reinterpret_cast<CXClientData>(&ctx), &callbacks, sizeof(callbacks),
+            CXIndexOpt_IndexFunctionLocalSymbols | CXIndexOpt_SkipParsedBodiesInSession,
+            nullptr, command.args, command.nargs, nullptr, 0, &tu, parseOptions);
+
+    // an abort from the deadline is not a parse failure
+    //
+    if (result != 0 && !ctx.truncated && tu != nullptr)
+    {
+        clang_disposeTranslationUnit(tu);
+        tu = nullptr;
+    }
+    return tu;
+}
+
+void IndexFile(ProjectIndexer* indexer, CompileCommand& command)
+{
+    std::string fileNameStr(command.fileName);
+
+    time_t actualModTime = command.modTime;
+    time_t savedModTime = 0;
+    if (!NeedToParseFile(indexer->db, fileNameStr, actualModTime, savedModTime))
+    {
+        pthread_mutex_lock(&g_worklock);
+        indexer->filesUpToDate++;
+        pthread_mutex_unlock(&g_worklock);
+        return;
+    }
+
+    pthread_mutex_lock(&g_worklock);
+    std::vector<ScopeRule> scopeRules = indexer->scopeRules;
+    int scopeGeneration = indexer->scopeGeneration;
+    pthread_mutex_unlock(&g_worklock);
+
+    int originRule = MatchScopeRule(scopeRules, fileNameStr, false);
+    if (originRule >= 0 && scopeRules[originRule].mode == Scope_Exclude)
+    {
+        pthread_mutex_lock(&g_worklock);
+        indexer->filesSkipped++;
+        if (indexer->scopeGeneration == scopeGeneration && indexer->scopeSeen.insert(fileNameStr).second)
+        {
+            indexer->scopeStats[originRule].files++;
+            indexer->scopeStats[originRule].sourceBytes += GetFileSize(fileNameStr);
+        }
+        pthread_mutex_unlock(&g_worklock);
+        return;
+    }
+
+    size_t argsHash = HashArgs(command);
+    ParseFailure failure;
+    bool hasFailure = false;
+    bool failedBefore = false;
+    // earlier failures only count against the same content and compile command
+    if (IsParseBackingOff(indexer, fileNameStr, actualModTime, argsHash, failure, hasFailure, failedBefore))
+    {
+        pthread_mutex_lock(&g_worklock);
+        indexer->filesSkipped++;
+        pthread_mutex_unlock(&g_worklock);
+        return;
+    }
+
+    pthread_mutex_lock(&g_worklock);
+    double timeBudget = indexer->timeBudgetSeconds;
+    double extractTimeBudget = indexer->extractTimeBudgetSeconds;
+    double memoryBudgetMb = indexer->memoryBudgetMb;
+    // the declaration and reference passes claim and skip files in their own way, so they always
+    //    use the visitor
+    CXIndexAction indexAction = indexer->extractor == Extractor_IndexAction && command.tier == 0 ?
+            GetIndexAction(indexer) : nullptr;
+    RecordEvent(indexer, "started", fileNameStr);
+    pthread_mutex_unlock(&g_worklock);
+
+    SlowFile slowFile;
+    bool wasSlow = GetSlowFile(indexer->db, fileNameStr, slowFile);
+    if (!wasSlow)
+    {
+        slowFile.timesOverBudget = 0;
+        slowFile.cheap = false;
+    }
+    else if (slowFile.modTime != actualModTime)
+    {
+        // the content that went over budget is gone, the new one gets a full parse to prove itself
+        slowFile.cheap = false;
+    }
+    slowFile.modTime = actualModTime;
+    const char* overBudget = nullptr;
+    if (slowFile.cheap)
+    {
+        indexAction = nullptr;
+    }
+
+    bool declarationPass = command.tier == 1;
+
+    IncludedFileContext ctx;
+    ctx.indexer = indexer;
+    ctx.originFile = fileNameStr;
+    ctx.allowedFiles[fileNameStr] = originRule;
+    ctx.tu = nullptr;
+    ctx.scopeRules = scopeRules;
+    ctx.checkSystemHeaders = HasSystemHeadersRule(scopeRules);
+    ctx.scopeStats.resize(scopeRules.size());
+    if (originRule >= 0)
+    {
+        ctx.scopeStats[originRule].files++;
+    }
+    ctx.deadline = extractTimeBudget > 0 ? CurrentTime() + extractTimeBudget : 0;
+    ctx.visited = 0;
+    ctx.truncated = false;
+    ctx.tier = command.tier;
+    ctx.writesSkipped = 0;
+    ctx.writeBytesSkipped = 0;
+
+    CXIndex idx = indexAction == nullptr ? clang_createIndex(0, 0) : nullptr;
+
+    struct timeval start, end;
+
+//        long seconds, useconds;    
+
+    gettimeofday(&start, NULL);
+
+    double parseStart = CurrentTime();
+    CXTranslationUnit tu;
+    if (indexAction != nullptr)
+    {
+        // the entries are written while the file is parsed, so the deadline covers both
+        ctx.deadline = extractTimeBudget > 0 ? parseStart + timeBudget + extractTimeBudget : 0;
+        tu = IndexWithAction(ctx, indexAction, command, CXTranslationUnit_None);
+    }
+    else
+    {
+        tu = clang_parseTranslationUnit(idx, nullptr, command.args, command.nargs, nullptr, 0,
+                slowFile.cheap || declarationPass ? CXTranslationUnit_SkipFunctionBodies : CXTranslationUnit_DetailedPreprocessingRecord);
+    }
+    gettimeofday(&end, NULL);
+
+    if (tu != nullptr)
+    {
+        slowFile.seconds = CurrentTime() - parseStart;
+        slowFile.memoryMb = GetMemoryUsageMb(tu);
+
+        if (memoryBudgetMb > 0 && slowFile.memoryMb > memoryBudgetMb)
+        {
+            overBudget = "memory";
+            if (!slowFile.cheap && !declarationPass && indexAction == nullptr)
+            {
+                // holding on to the full TU while extracting is what the budget is meant to prevent
+                clang_disposeTranslationUnit(tu);
+                slowFile.cheap = true;
+                tu = clang_parseTranslationUnit(idx, nullptr, command.args, command.nargs, nullptr, 0,
+                        CXTranslationUnit_SkipFunctionBodies);
+            }
+        }
+        else if (timeBudget > 0 && slowFile.seconds > timeBudget)
+        {
+            // the parse is already paid for, only the next one is downgraded
+            overBudget = "parse_time";
+        }
+    }
+
+    if (tu == nullptr)
+    {
+        if (idx != nullptr)
+        {
+            clang_disposeIndex(idx);
+        }
+
+        // the index action extractor claims headers while it parses
+        UnclaimIncludedFiles(&ctx);
+
+        SaveFailedParse(indexer, fileNameStr, actualModTime, argsHash, failure, failedBefore);
+
+        pthread_mutex_lock(&g_worklock);
+        indexer->filesFailed++;
+        RecordEvent(indexer, "failed", fileNameStr);
+        pthread_mutex_unlock(&g_worklock);
+        return;
+    }
+
+    std::string diagnostics = GetErrorDiagnostics(tu);
+    if (!diagnostics.empty())
+    {
+        failure.failures = 0;
+        failure.nextRetry = 0;
+        failure.modTime = actualModTime;
+        failure.argsHash = argsHash;
+        SaveParseFailure(indexer->db, fileNameStr, failure, diagnostics);
+    }
+    else if (hasFailure)
+    {
+        ClearParseFailure(indexer->db, fileNameStr);
+    }
+
+//        seconds  = end.tv_sec  - start.tv_sec;
+//        useconds = end.tv_usec - start.tv_usec;
+//        long parseTime = ((seconds) * 1000 + useconds/1000.0) + 0.5;
+
+    ctx.tu = tu;
+    if (indexAction == nullptr)
+    {
+        ctx.deadline = extractTimeBudget > 0 ? CurrentTime() + extractTimeBudget : 0;
+        clang_getInclusions(tu, IncludedFileVisitor, reinterpret_cast<CXClientData>(&ctx));
+
+        for (auto& allowedFile : ctx.allowedFiles)
+        {
+            // UNDONE: make this in the same batch as the extract, so that we atomically have the new symbols
+            //
+            RemoveFileSymbols(indexer, allowedFile.first);
+        }
+
+        gettimeofday(&start, NULL);
+        clang_visitChildren(clang_getTranslationUnitCursor(tu), SymbolVisitor, reinterpret_cast<CXClientData>(&ctx));
+        gettimeofday(&end, NULL);
+    }
+    else
+    {
+        // the files that nothing was reported in, the origin file or changed headers, still have
+        //    their old entries
+        clang_getInclusions(tu, IncludedFileVisitor, reinterpret_cast<CXClientData>(&ctx));
+        for (auto& allowedFile : ctx.allowedFiles)
+        {
+            if (ctx.checkedFiles.insert(allowedFile.first).second)
+            {
+                RemoveFileSymbols(indexer, allowedFile.first);
+            }
+        }
+    }
+
+//        seconds  = end.tv_sec  - start.tv_sec;
+//        useconds = end.tv_usec - start.tv_usec;
+//        long extractTime = ((seconds) * 1000 + useconds/1000.0) + 0.5;
+
+//        fprintf(stderr, "%s : parsing = %ld ms, extracting = %ld ms\n", command.fileName, parseTime, extractTime);
+//        fprintf(stderr, "%s : parsing \n", command.fileName);
+
+    CommitSymbolCounts(&ctx);
+
+    // an extraction that the deadline cut off is not stamped, and the file is queued again to be
+    //    parsed cheaply. One that was already cheap keeps what it extracted until the file changes.
+    //
+    bool retryCheap = ctx.truncated && !slowFile.cheap;
+    if (retryCheap)
+    {
+        UnclaimIncludedFiles(&ctx);
+    }
+    else
+    {
+        SaveParsedFile(indexer->db, fileNameStr, actualModTime);
+    }
+
+    clang_disposeTranslationUnit(tu);
+    if (idx != nullptr)
+    {
+        clang_disposeIndex(idx);
+    }
+
+    // a cheap parse has no function bodies, so a reference pass would not add anything
+    //
+    bool needsReferences = declarationPass && !slowFile.cheap && !retryCheap;
+    if (!retryCheap)
+    {
+        for (auto& allowedFile : ctx.allowedFiles)
+        {
+            SaveTier(indexer->db, allowedFile.first, needsReferences ? 1 : 2);
+        }
+    }
+
+    if (ctx.truncated)
+    {
+        overBudget = "extract_time";
+    }
+    if (overBudget != nullptr)
+    {
+        slowFile.timesOverBudget++;
+        slowFile.cheap = true;
+        SaveSlowFile(indexer->db, fileNameStr, slowFile, overBudget);
+    }
+
+    pthread_mutex_lock(&g_worklock);
+    indexer->filesIndexed++;
+    indexer->tuSizes[fileNameStr] = slowFile.memoryMb;
+    g_averageTuMb = 0.9 * g_averageTuMb + 0.1 * slowFile.memoryMb;
+    indexer->writesSkipped += ctx.writesSkipped;
+    indexer->writeBytesSkipped += ctx.writeBytesSkipped;
+    // the rules may have been replaced while this file was indexed
+    if (indexer->scopeGeneration == scopeGeneration)
+    {
+        for (size_t i = 0; i < ctx.scopeStats.size(); i++)
+        {
+            indexer->scopeStats[i].files += ctx.scopeStats[i].files;
+            indexer->scopeStats[i].sourceBytes += ctx.scopeStats[i].sourceBytes;
+            indexer->scopeStats[i].cursorsSkipped += ctx.scopeStats[i].cursorsSkipped;
+        }
+    }
+    if (overBudget != nullptr)
+    {
+        indexer->filesOverBudget++;
+        RecordEvent(indexer, "over_budget", fileNameStr);
+    }
+    if (needsReferences)
+    {
+        CompileCommand referencePass(command.fileName, std::vector<std::string>(command.args, command.args + command.nargs),
+                actualModTime);
+        referencePass.tier = 2;
+        EnqueueWork(indexer, referencePass);
+    }
+    if (retryCheap)
+    {
+        CompileCommand cheapRetry(command.fileName, std::vector<std::string>(command.args, command.args + command.nargs),
+                actualModTime);
+        cheapRetry.tier = command.tier;
+        EnqueueWork(indexer, cheapRetry);
+    }
+    RecordEvent(indexer, "finished", fileNameStr);
+    pthread_mutex_unlock(&g_worklock);
+}
+
+// The reference pass of tiered indexing: parses the file with function bodies, and adds the
+//    references to the entries that the declaration pass wrote for it and for the headers it
+//    claimed. Nothing is removed, the declarations it writes again are the same entries. Only the
+//    files still at tier 1 are visited, so a pass that is queued again (see Project.scan_and_index)
+//    does not count any reference twice, and one with nothing left to visit does not parse at all.
+//    A pass that goes over the extraction budget leaves its files at tier 1 and marks the file
+//    cheap in slow%%%, which no further reference pass is run for until the file changes.
+//
+void IndexReferences(ProjectIndexer* indexer, CompileCommand& command)
+{
+    std::string fileNameStr(command.fileName);
+
+    // the file changed since its declaration pass, and will get a new one
+    //
+    time_t actualModTime = 0;
+    time_t savedModTime = 0;
+    if (GetFileModificationTime(command.fileName) != command.modTime ||
+            NeedToParseFile(indexer->db, fileNameStr, actualModTime, savedModTime))
+    {
+        return;
+    }
+
+    SlowFile slowFile;
+    bool wasSlow = GetSlowFile(indexer->db, fileNameStr, slowFile);
+    if ((wasSlow && slowFile.cheap && slowFile.modTime == actualModTime) || !HasTierOneFiles(indexer->db, fileNameStr))
+    {
+        return;
+    }
+
+    // failures back off like the ones of the declaration pass; the files stay at tier 1 meanwhile
+    //
+    size_t argsHash = HashArgs(command);
+    ParseFailure failure;
+    bool hasFailure = false;
+    bool failedBefore = false;
+    if (IsParseBackingOff(indexer, fileNameStr, actualModTime, argsHash, failure, hasFailure, failedBefore))
+    {
+        pthread_mutex_lock(&g_worklock);
+        indexer->filesSkipped++;
+        pthread_mutex_unlock(&g_worklock);
+        return;
+    }
+
+    pthread_mutex_lock(&g_worklock);
+    std::vector<ScopeRule> scopeRules = indexer->scopeRules;
+    double extractTimeBudget = indexer->extractTimeBudgetSeconds;
+    RecordEvent(indexer, "references_started", fileNameStr);
+    pthread_mutex_unlock(&g_worklock);
+
+    auto idx = clang_createIndex(0, 0);
+    CXTranslationUnit tu = clang_parseTranslationUnit(idx, nullptr, command.args, command.nargs, nullptr, 0,
+            CXTranslationUnit_DetailedPreprocessingRecord);
+    if (tu == nullptr)
+    {
+        clang_disposeIndex(idx);
+        SaveFailedParse(indexer, fileNameStr, actualModTime, argsHash, failure, failedBefore);
+
+        pthread_mutex_lock(&g_worklock);
+        indexer->filesFailed++;
+        RecordEvent(indexer, "failed", fileNameStr);
+        pthread_mutex_unlock(&g_worklock);
+        return;
+    }
+    if (failedBefore && failure.failures > 0)
+    {
+        ClearParseFailure(indexer->db, fileNameStr);
+    }
+
+    IncludedFileContext ctx;
+    ctx.indexer = indexer;
+    ctx.originFile = fileNameStr;
+    if (GetTier(indexer->db, fileNameStr) == 1)
+    {
+        ctx.allowedFiles[fileNameStr] = MatchScopeRule(scopeRules, fileNameStr, false);
+    }
+    ctx.tu = tu;
+    ctx.scopeRules = scopeRules;
+    ctx.checkSystemHeaders = HasSystemHeadersRule(scopeRules);
+    ctx.scopeStats.resize(scopeRules.size());
+    ctx.deadline = extractTimeBudget > 0 ? CurrentTime() + extractTimeBudget : 0;
+    ctx.visited = 0;
+    ctx.truncated = false;
+    ctx.tier = 2;
+    ctx.writesSkipped = 0;
+    ctx.writeBytesSkipped = 0;
+    clang_getInclusions(tu, IncludedFileVisitor, reinterpret_cast<CXClientData>(&ctx));
+
+    if (!ctx.allowedFiles.empty())
+    {
+        clang_visitChildren(clang_getTranslationUnitCursor(tu), SymbolVisitor, reinterpret_cast<CXClientData>(&ctx));
+        CommitSymbolCounts(&ctx);
+    }
+
+    clang_disposeTranslationUnit(tu);
+    clang_disposeIndex(idx);
+
+    // the references that were counted stay, the files are not complete until they change
+    //
+    if (ctx.truncated)
+    {
+        if (!wasSlow)
+        {
+            slowFile.timesOverBudget = 0;
+            slowFile.seconds = 0;
+            slowFile.memoryMb = 0;
+        }
+        slowFile.timesOverBudget++;
+        slowFile.cheap = true;
+        slowFile.modTime = actualModTime;
+        SaveSlowFile(indexer->db, fileNameStr, slowFile, "extract_time");
+    }
+    else
+    {
+        for (auto& allowedFile : ctx.allowedFiles)
+        {
+            SaveTier(indexer->db, allowedFile.first, 2);
+        }
+    }
+
+    pthread_mutex_lock(&g_worklock);
+    if (ctx.truncated)
+    {
+        indexer->filesOverBudget++;
+        RecordEvent(indexer, "over_budget", fileNameStr);
+    }
+    indexer->filesReferenced++;
+    indexer->writesSkipped += ctx.writesSkipped;
+    indexer->writeBytesSkipped += ctx.writeBytesSkipped;
+    RecordEvent(indexer, "references_finished", fileNameStr);
+    pthread_mutex_unlock(&g_worklock);
+}
+
+// MemAvailable from /proc/meminfo, or -1 where there is none
+//
+double GetAvailableMemoryMb()
+{
+    FILE* f = fopen("/proc/meminfo", "r");
+    if (f == nullptr)
+    {
+        return -1;
+    }
+
+    double ret = -1;
+    char line[256];
+    long kb = 0;
+    while (fgets(line, sizeof(line), f) != nullptr)
+    {
+        if (sscanf(line, "MemAvailable: %ld kB", &kb) == 1)
+        {
+            ret = kb / 1024.0;
+            break;
+        }
+    }
+    fclose(f);
+    return ret;
+}
+
+// Caller holds g_worklock.
+//
+double EstimateTuMb(ProjectIndexer* indexer, const std::string& fileName)
+{
+    auto it = indexer->tuSizes.find(fileName);
+    return it != indexer->tuSizes.end() ? it->second : g_averageTuMb;
+}
+
+// Whether a file with a TU of estimateMb may start now. Caller holds g_worklock. Something always
+//    runs, so that a file bigger than the limits is still indexed, alone.
+//
+//    MemAvailable does not include what the files that just started will still allocate, so the
+//    reserve alone lets a burst of them through; g_memoryLimitMb accounts for those.
+//
+bool AdmitFile(double estimateMb)
+{
+    if (g_activeTasks.empty())
+    {
+        return true;
+    }
+    if (g_memoryLimitMb > 0 && g_admittedMb + estimateMb > g_memoryLimitMb)
+    {
+        return false;
+    }
+    if (g_memoryReserveMb > 0)
+    {
+        double available = GetAvailableMemoryMb();
+        if (available >= 0 && available - estimateMb < g_memoryReserveMb)
+        {
+            return false;
+        }
+    }
+    return true;
+}
+
+// Whether the calling worker should exit, because the pool was shrunk or replaced. Caller holds
+//    g_worklock.
+//
+bool LeavePool(int generation)
+{
+    if (generation != g_poolGeneration)
+    {
+        return true;
+    }
+    if (g_poolSize > g_poolTarget + g_stuckWorkers)
+    {
+        g_poolSize--;
+        return true;
+    }
+    return false;
+}
+
+// Lowers the CPU and I/O priority of the calling thread, both of which Linux keeps per thread.
+//
+void LowerThreadPriority()
+{
+#ifdef SYS_gettid
+    pid_t tid = (pid_t) syscall(SYS_gettid);
+    setpriority(PRIO_PROCESS, tid, c_backgroundNice);
+#ifdef SYS_ioprio_set
+    syscall(SYS_ioprio_set, c_ioprioWhoProcess, tid, c_ioprioIdle);
+#endif
+#endif
+}
+
+void worker(int generation)
+{
+    bool background = false;
+    while (true)
+    {
+        pthread_mutex_lock(&g_worklock);
+        double estimateMb = 0;
+        while (true)
+        {
+            if (LeavePool(generation))
+            {
+                pthread_mutex_unlock(&g_worklock);
+                return;
+            }
+
+            if (g_runnable.empty() && g_runnableLow.empty())
+            {
+                pthread_cond_wait(&g_workcond, &g_worklock);
+                continue;
+            }
+
+            ProjectIndexer* next = g_runnable.empty() ? g_runnableLow.front() : g_runnable.front();
+            std::queue<CompileCommand>& nextQueue = g_runnable.empty() ? next->lowWork : next->work;
+            estimateMb = EstimateTuMb(next, std::string(nextQueue.front().fileName));
+            if (AdmitFile(estimateMb))
+            {
+                break;
+            }
+
+            // files that finish signal the condition, the timeout is for memory freed elsewhere
+            //
+            g_admissionWaits++;
+            struct timespec deadline = DeadlineToTimespec(CurrentTime() + 1);
+            pthread_cond_timedwait(&g_workcond, &g_worklock, &deadline);
+        }
+
+        // reference passes only run when no project has anything else queued
+        //
+        bool low = g_runnable.empty();
+        std::deque<ProjectIndexer*>& runnable = low ? g_runnableLow : g_runnable;
+        ProjectIndexer* indexer = runnable.front();
+        runnable.pop_front();
+
+        std::queue<CompileCommand>& queue = low ? indexer->lowWork : indexer->work;
+        CompileCommand command = queue.front();
+        queue.pop();
+        indexer->activeTasks++;
+
+        ActiveTask task;
+        task.indexer = indexer;
+        task.fileName = command.fileName;
+        task.startTime = CurrentTime();
+        task.stuck = false;
+        task.replaced = false;
+        task.generation = generation;
+        task.estimateMb = estimateMb;
+        g_activeTasks.push_back(&task);
+        g_admittedMb += estimateMb;
+        bool lowerPriority = g_background && !background;
+
+        if (queue.empty())
+        {
+            (low ? indexer->lowScheduled : indexer->scheduled) = false;
+        }
+        else
+        {
+            runnable.push_back(indexer);
+        }
+        pthread_mutex_unlock(&g_worklock);
+
+        if (lowerPriority)
+        {
+            LowerThreadPriority();
+            background = true;
+        }
+
+        if (command.tier == 2)
+        {
+            IndexReferences(indexer, command);
+        }
+        else
+        {
+            IndexFile(indexer, command);
+        }
+
+        std::pair<std::string, time_t> referencePass(std::string(command.fileName), command.modTime);
+        command.Clear();
+
+        pthread_mutex_lock(&g_worklock);
+        if (low)
+        {
+            indexer->referencePasses.erase(referencePass);
+        }
+        g_activeTasks.remove(&task);
+        g_admittedMb -= task.estimateMb;
+        if (task.replaced && task.generation == g_poolGeneration)
+        {
+            g_stuckWorkers--;
+        }
+        indexer->activeTasks--;
+        indexer->outstandingTasks--;
+        if (indexer->outstandingTasks == 0)
+        {
+            RecordEvent(indexer, "idle", std::string(""));
+        }
+        pthread_cond_broadcast(&indexer->finishedCond);
+        // workers that wait for admission can go now
+        pthread_cond_broadcast(&g_workcond);
+        pthread_mutex_unlock(&g_worklock);
+    }
+}
+
+// Once a second, marks the files that run past their project's time budget as stuck, and
+//    starts a replacement worker for each of them.
+//
+void watchdog()
+{
+    while (true)
+    {
+        sleep(1);
+
+        pthread_mutex_lock(&g_worklock);
+        double now = CurrentTime();
+        for (ActiveTask* task : g_activeTasks)
+        {
+            double budget = task->indexer->timeBudgetSeconds;
+            if (task->stuck || budget <= 0 || now - task->startTime <= budget)
+            {
+                continue;
+            }
+            task->stuck = true;
+            // the workers of an old generation are already replaced, and files that hang for good
+            //    must not grow the pool without end
+            if (task->generation == g_poolGeneration && g_stuckWorkers < g_maxPoolSize)
+            {
+                task->replaced = true;
+                g_stuckWorkers++;
+                std::thread(worker, g_poolGeneration).detach();
+                g_poolSize++;
+            }
+            RecordEvent(task->indexer, "stuck", task->fileName);
+        }
+        pthread_mutex_unlock(&g_worklock);
+    }
+}
+
+// Starts workers until the pool has g_poolTarget of them, besides the stuck ones, and the
+//    watchdog with the first of them. Must hold g_worklock.
+//
+void FillWorkerPool()
+{
+    while (g_poolSize < g_poolTarget + g_stuckWorkers)
+    {
+        std::thread(worker, g_poolGeneration).detach();
+        g_poolSize++;
+    }
+
+    if (g_poolSize > 0 && !g_watchdogStarted)
+    {
+        g_watchdogStarted = true;
+        std::thread(watchdog).detach();
+    }
+}
+
+// Grows the shared pool to nWorkers threads, never past g_maxPoolSize, unless its size was set
+//    with set_pool_option. Must hold g_worklock.
+//
+void GrowWorkerPool(int nWorkers)
+{
+    if (g_userPoolSize == 0)
+    {
+        g_poolTarget = std::max(g_poolTarget, std::min(nWorkers, g_maxPoolSize));
+    }
+    FillWorkerPool();
+}
+
+ProjectIndexer* LookupIndexer(int id)
+{
+    ProjectIndexer* ret = nullptr;
+
+    pthread_mutex_lock(&g_worklock);
+    auto it = g_indexers.find(id);
+    if (it != g_indexers.end())
+    {
+        ret = it->second;
+    }
+    pthread_mutex_unlock(&g_worklock);
+
+    if (ret == nullptr)
+    {
+        PyErr_Format(PyExc_KeyError, "unknown indexer %d", id);
+    }
+    return ret;
+}
+
+PyObject* start_workers(PyObject *self, PyObject *args)
+{
+    int n_workers;
+    if (!PyArg_ParseTuple(args, "i", &n_workers))
+    {
+        return NULL;
+    }
+
+    std::vector<std::thread> workers;
+
+    for (int i = 0; i < n_workers; i++)
+    {
+        workers.emplace_back(worker, g_poolGeneration);
+    }
+
+    for (auto &thread : workers)
+    {
+        thread.join();
+    }
+    Py_RETURN_NONE;
+}
+
+PyObject* add_file_to_parse(PyObject *self, PyObject *args)
+{
+    int indexerId = 0;
+    const char* fileName = nullptr;
+    PyObject* argList;
+    time_t modTime = 0;
+    int tier = -1;
+
+    if (!PyArg_ParseTuple(args, "isO!l|i", &indexerId, &fileName, &PyList_Type, &argList, &modTime, &tier))
+    {
+        return NULL;
+    }
+
+    ProjectIndexer* indexer = LookupIndexer(indexerId);
+    if (indexer == nullptr)
+    {
+        return NULL;
+    }
+
+    std::vector<std::string> argv;
+    for (int i = 0; i < PyList_Size(argList); i++)
+    {
+        argv.push_back(PyString_AsString(PyList_GetItem(argList, i)));
+    }
+
+    CompileCommand cmd(fileName, argv, modTime);
+
+    Py_BEGIN_ALLOW_THREADS;
+    pthread_mutex_lock(&g_worklock);
+    // tier 2 queues the reference pass of a file whose declaration pass is done
+    cmd.tier = tier == 2 ? 2 : (indexer->tiered ? 1 : 0);
+    EnqueueWork(indexer, cmd);
+    pthread_mutex_unlock(&g_worklock);
+    Py_END_ALLOW_THREADS;
+
+    Py_RETURN_NONE;
+}
+
+
+PyObject* start(PyObject *self, PyObject *args)
+{
+    PyLevelDB* pyLevelDbConn = nullptr;
+    int nworkers = 0;
+    
+    if (!PyArg_ParseTuple(args, "Oi", &pyLevelDbConn, &nworkers))
+        return NULL;
+
+    assert(pyLevelDbConn != nullptr);
+    Py_INCREF(pyLevelDbConn);
+
+    int id = 0;
+
+    pthread_mutex_lock(&g_worklock);
+    id = g_nextIndexerId++;
+    g_indexers[id] = new ProjectIndexer(id, pyLevelDbConn);
+    GrowWorkerPool(nworkers);
+    pthread_mutex_unlock(&g_worklock);
+
+    return Py_BuildValue("i", id);
+}
+
+// wait_on_work(indexer_id[, timeout_seconds]) waits for the queue to drain, forever if no timeout
+//    is given. Returns False if the timeout expired first.
+//
+PyObject* wait_on_work(PyObject* self, PyObject* args)
 {
-    DeleteFromIndex(prefix, batch, EmptyDeleteCallback);
+    int indexerId = 0;
+    double timeout = -1;
+
+    if (!PyArg_ParseTuple(args, "i|d", &indexerId, &timeout))
+    {
+        return NULL;
+    }
+
+    ProjectIndexer* indexer = LookupIndexer(indexerId);
+    if (indexer == nullptr)
+    {
+        return NULL;
+    }
+
+    bool done = false;
+
+    Py_BEGIN_ALLOW_THREADS;
+    struct timespec deadline = DeadlineToTimespec(CurrentTime() + timeout);
+    pthread_mutex_lock(&g_worklock);
+    while (indexer->outstandingTasks > 0)
+    {
+        if (timeout < 0)
+        {
+            pthread_cond_wait(&indexer->finishedCond, &g_worklock);
+        }
+        else if (pthread_cond_timedwait(&indexer->finishedCond, &g_worklock, &deadline) == ETIMEDOUT)
+        {
+            break;
+        }
+    }
+    done = indexer->outstandingTasks == 0;
+    pthread_mutex_unlock(&g_worklock);
+    Py_END_ALLOW_THREADS;
+
+    return PyBool_FromLong(done);
 }
 
-std::string GetSymbolSpelling(std::string spelling)
-{
-    std::string ret;
-    leveldb::Status status = db->Get(leveldb::ReadOptions(), std::string("spelling%%%") + spelling, &ret);
-    if (status.ok())
+// wait_for_events(indexer_id, since_seq, timeout_seconds) blocks until there are events newer than
+//    since_seq or the timeout expires, and returns (last_seq, [(seq, type, file, time), ...]).
+//
+PyObject* wait_for_events(PyObject* self, PyObject* args)
+{
+    int indexerId = 0;
+    long since = 0;
+    double timeout = 0;
+
+    if (!PyArg_ParseTuple(args, "ild", &indexerId, &since, &timeout))
+    {
+        return NULL;
+    }
+
+    ProjectIndexer* indexer = LookupIndexer(indexerId);
+    if (indexer == nullptr)
+    {
+        return NULL;
+    }
+
+    std::vector<IndexerEvent> events;
+    long lastSeq = 0;
+
+    Py_BEGIN_ALLOW_THREADS;
+    struct timespec deadline = DeadlineToTimespec(CurrentTime() + timeout);
+    pthread_mutex_lock(&g_worklock);
+    while (indexer->lastEventSeq <= since)
+    {
+        if (pthread_cond_timedwait(&indexer->eventCond, &g_worklock, &deadline) == ETIMEDOUT)
+        {
+            break;
+        }
+    }
+    for (const IndexerEvent& event : indexer->events)
+    {
+        if (event.seq > since)
+        {
+            events.push_back(event);
+        }
+    }
+    lastSeq = indexer->lastEventSeq;
+    pthread_mutex_unlock(&g_worklock);
+    Py_END_ALLOW_THREADS;
+
+    PyObject* eventList = PyList_New(events.size());
+    if (eventList == nullptr)
     {
-        return ret;
+        return NULL;
     }
-    else
+    for (size_t i = 0; i < events.size(); i++)
     {
-        return std::string("(not found)");
+        PyList_SET_ITEM(eventList, i, Py_BuildValue("(lssd)", events[i].seq, events[i].type,
+                    events[i].fileName.c_str(), events[i].time));
     }
+
+    PyObject* ret = Py_BuildValue("(lO)", lastSeq, eventList);
+    Py_DECREF(eventList);
+    return ret;
 }
 
-void RemoveSymbol(std::string symbolKey, leveldb::WriteBatch* batch)
+// clear_queue(indexer_id) drops the files that are queued but not started yet, and returns how many
+//    were dropped. Files that are being indexed are finished, so wait_on_work still has to be called.
+//    The dropped files are not stamped in the index, so the next scan picks them up again.
+//
+PyObject* clear_queue(PyObject* self, PyObject* args)
 {
-    std::string fname = ExtractPart(symbolKey, 1);
-    std::string symbol = ExtractPart(symbolKey, 2);
-    std::string spelling = GetSymbolSpelling(symbol);
+    int indexerId = 0;
+    int dropped = 0;
 
-    DeleteFromIndex(std::string("s%%%") + symbol + std::string("%%%") + fname , batch);
+    if (!PyArg_ParseTuple(args, "i", &indexerId))
+    {
+        return NULL;
+    }
 
-    // UNDONE: refactor this so it's shared with SymbolVisitor
-    //
-    for (const char* symbolType : {"def", "decl"})
+    ProjectIndexer* indexer = LookupIndexer(indexerId);
+    if (indexer == nullptr)
     {
-        for (size_t i = 0; i < spelling.size(); i++)
-        {
-            std::string suffix = std::string(spelling, i, spelling.size());
-            std::transform(suffix.begin(), suffix.end(), suffix.begin(), ::tolower);
+        return NULL;
+    }
 
-            std::string entryPrefix = DbEntryPrefix(i, symbolType) + "%%%" + suffix + "%%%" + symbol + "%%%" + fname;
-            DeleteFromIndex(entryPrefix, batch);
-        }
+    Py_BEGIN_ALLOW_THREADS;
+    pthread_mutex_lock(&g_worklock);
+    while (!indexer->work.empty())
+    {
+        indexer->work.front().Clear();
+        indexer->work.pop();
+        dropped++;
     }
-}
+    while (!indexer->lowWork.empty())
+    {
+        CompileCommand& command = indexer->lowWork.front();
+        indexer->referencePasses.erase(std::make_pair(std::string(command.fileName), command.modTime));
+        command.Clear();
+        indexer->lowWork.pop();
+        dropped++;
+    }
+    indexer->outstandingTasks -= dropped;
+    if (indexer->scheduled)
+    {
+        indexer->scheduled = false;
+        g_runnable.erase(std::remove(g_runnable.begin(), g_runnable.end(), indexer), g_runnable.end());
+    }
+    if (indexer->lowScheduled)
+    {
+        indexer->lowScheduled = false;
+        g_runnableLow.erase(std::remove(g_runnableLow.begin(), g_runnableLow.end(), indexer), g_runnableLow.end());
+    }
+    if (dropped > 0 && indexer->outstandingTasks == 0)
+    {
+        RecordEvent(indexer, "idle", std::string(""));
+    }
+    pthread_cond_broadcast(&indexer->finishedCond);
+    pthread_mutex_unlock(&g_worklock);
+    Py_END_ALLOW_THREADS;
 
-void RemoveFileSymbols(std::string fileName)
-{
-    leveldb::WriteBatch batch;
-    DeleteFromIndex(std::string("c%%%") + fileName, &batch, RemoveSymbol);
-    db->Write(leveldb::WriteOptions(), &batch);
+    return Py_BuildValue("i", dropped);
 }
 
-void worker()
+// pause_queue(indexer_id, paused) stops the workers from starting any more of the project's files,
+//    and waits for the ones that are being indexed to finish, so nothing writes to the index until
+//    pause_queue(indexer_id, False) is called. Files can still be queued while the queue is paused.
+//
+PyObject* pause_queue(PyObject* self, PyObject* args)
 {
-    while (true)
-    {
-        pthread_mutex_lock(&g_worklock);
-        while (work.empty())
-        {
-            pthread_cond_wait(&g_workcond, &g_worklock);
-        }
+    int indexerId = 0;
+    PyObject* paused = nullptr;
 
-        CompileCommand command = work.front();
-        work.pop();
-        pthread_mutex_unlock(&g_worklock);
+    if (!PyArg_ParseTuple(args, "iO!", &indexerId, &PyBool_Type, &paused))
+    {
+        return NULL;
+    }
 
-        std::string fileNameStr(command.fileName);
+    ProjectIndexer* indexer = LookupIndexer(indexerId);
+    if (indexer == nullptr)
+    {
+        return NULL;
+    }
 
-        time_t actualModTime = command.modTime;
-        time_t savedModTime = 0;
-        if (NeedToParseFile(fileNameStr, actualModTime, savedModTime))
+    Py_BEGIN_ALLOW_THREADS;
+    pthread_mutex_lock(&g_worklock);
+    if (paused == Py_True)
+    {
+        indexer->paused = true;
+        if (indexer->scheduled)
+        {
+            indexer->scheduled = false;
+            g_runnable.erase(std::remove(g_runnable.begin(), g_runnable.end(), indexer), g_runnable.end());
+        }
+        if (indexer->lowScheduled)
+        {
+            indexer->lowScheduled = false;
+            g_runnableLow.erase(std::remove(g_runnableLow.begin(), g_runnableLow.end(), indexer), g_runnableLow.end());
+        }
+        while (indexer->activeTasks > 0)
+        {
+            pthread_cond_wait(&indexer->finishedCond, &g_worklock);
+        }
+    }
+    else if (indexer->paused)
+    {
+        indexer->paused = false;
+        if (!indexer->work.empty())
+        {
+            indexer->scheduled = true;
+            g_runnable.push_back(indexer);
+        }
+        if (!indexer->lowWork.empty())
         {
-            auto idx = clang_createIndex(0, 0);
+            indexer->lowScheduled = true;
+            g_runnableLow.push_back(indexer);
+        }
+        pthread_cond_broadcast(&g_workcond);
+    }
+    pthread_mutex_unlock(&g_worklock);
+    Py_END_ALLOW_THREADS;
 
-            struct timeval start, end;
+    Py_RETURN_NONE;
+}
 
-//            long seconds, useconds;    
+PyObject* work_queue_size(PyObject* self, PyObject* args)
+{
+    int indexerId = 0;
+    int ret = 0;
 
-            gettimeofday(&start, NULL);
+    if (!PyArg_ParseTuple(args, "i", &indexerId))
+    {
+        return NULL;
+    }
 
-            CXTranslationUnit tu = clang_parseTranslationUnit(idx, nullptr, command.args, command.nargs, nullptr, 0, CXTranslationUnit_DetailedPreprocessingRecord);
-            gettimeofday(&end, NULL);
+    ProjectIndexer* indexer = LookupIndexer(indexerId);
+    if (indexer == nullptr)
+    {
+        return NULL;
+    }
 
-//            seconds  = end.tv_sec  - start.tv_sec;
-//            useconds = end.tv_usec - start.tv_usec;
-//            long parseTime = ((seconds) * 1000 + useconds/1000.0) + 0.5;
+    Py_BEGIN_ALLOW_THREADS;
+    pthread_mutex_lock(&g_worklock);
+    ret = indexer->outstandingTasks;
+    pthread_mutex_unlock(&g_worklock);
+    Py_END_ALLOW_THREADS;
 
-            IncludedFileContext ctx;
-            ctx.originFile = fileNameStr;
-            ctx.allowedFiles.insert(fileNameStr);
-            clang_getInclusions(tu, IncludedFileVisitor, reinterpret_cast<CXClientData>(&ctx));
+    return Py_BuildValue("i", ret);
+}
 
-            for (std::string allowedFile : ctx.allowedFiles)
-            {
-                // UNDONE: make this in the same batch as the extract, so that we atomically have the new symbols
-                //
-                RemoveFileSymbols(allowedFile);
-            }
+PyObject* stats(PyObject* self, PyObject* args)
+{
+    int indexerId = 0;
 
-            gettimeofday(&start, NULL);
-            clang_visitChildren(clang_getTranslationUnitCursor(tu), SymbolVisitor, reinterpret_cast<CXClientData>(&ctx.allowedFiles));
-            gettimeofday(&end, NULL);
+    if (!PyArg_ParseTuple(args, "i", &indexerId))
+    {
+        return NULL;
+    }
 
-//            seconds  = end.tv_sec  - start.tv_sec;
-//            useconds = end.tv_usec - start.tv_usec;
-//            long extractTime = ((seconds) * 1000 + useconds/1000.0) + 0.5;
+    ProjectIndexer* indexer = LookupIndexer(indexerId);
+    if (indexer == nullptr)
+    {
+        return NULL;
+    }
 
-//            fprintf(stderr, "%s : parsing = %ld ms, extracting = %ld ms\n", command.fileName, parseTime, extractTime);
-//            fprintf(stderr, "%s : parsing \n", command.fileName);
+    int queued, queuedReferences, active, outstanding, poolSize;
+    int stuckWorkers;
+    long filesIndexed, filesUpToDate, filesFailed, filesSkipped, filesOverBudget, filesReferenced;
+    long writesSkipped, writeBytesSkipped;
 
-            SaveParsedFile(fileNameStr, actualModTime);
+    pthread_mutex_lock(&g_worklock);
+    queued = indexer->work.size();
+    queuedReferences = indexer->lowWork.size();
+    active = indexer->activeTasks;
+    outstanding = indexer->outstandingTasks;
+    filesIndexed = indexer->filesIndexed;
+    filesUpToDate = indexer->filesUpToDate;
+    filesFailed = indexer->filesFailed;
+    filesSkipped = indexer->filesSkipped;
+    filesOverBudget = indexer->filesOverBudget;
+    filesReferenced = indexer->filesReferenced;
+    writesSkipped = indexer->writesSkipped;
+    writeBytesSkipped = indexer->writeBytesSkipped;
+    poolSize = g_poolSize;
+    stuckWorkers = g_stuckWorkers;
+    pthread_mutex_unlock(&g_worklock);
 
-            clang_disposeTranslationUnit(tu);
-            clang_disposeIndex(idx);
-        }
+    return Py_BuildValue("{s:i,s:i,s:i,s:i,s:l,s:l,s:l,s:l,s:l,s:l,s:l,s:l,s:i,s:i}",
+            "queued", queued,
+            "queued_references", queuedReferences,
+            "active", active,
+            "outstanding", outstanding,
+            "files_indexed", filesIndexed,
+            "files_up_to_date", filesUpToDate,
+            "files_failed", filesFailed,
+            "files_skipped", filesSkipped,
+            "files_over_budget", filesOverBudget,
+            "files_referenced", filesReferenced,
+            "writes_skipped", writesSkipped,
+            "write_bytes_skipped", writeBytesSkipped,
+            "pool_size", poolSize,
+            "stuck_workers", stuckWorkers);
+}
 
-        command.Clear();
+// set_option(indexer_id, name, value) changes a per-project indexer setting:
+//
+//    parse_retry_seconds       delay before the first retry of a file that failed to parse,
+//                              doubled after every further failure
+//    max_parse_retry_seconds   upper bound for that delay
+//    max_parse_attempts        failures after which a file is skipped until it changes
+//    time_budget_seconds       parse time after which a file is parsed cheaply from then on, and
+//                              after which the watchdog starts a replacement worker
+//    extract_time_budget_seconds
+//                              time after which symbol extraction stops for a file
+//    memory_budget_mb          TU size over which a file is reparsed cheaply right away
+//    tiered                    1 to index files queued from now on in two passes: declarations
+//                              first, references later at a lower priority
+//    extractor                 0 to extract the entries with the AST visitor, 1 with libclang's
+//                              index action, see Extractor
+//
+PyObject* set_option(PyObject* self, PyObject* args)
+{
+    int indexerId = 0;
+    const char* name = nullptr;
+    double value = 0;
 
-        pthread_mutex_lock(&g_worklock);
-        g_outstandingTasks--;
-        pthread_cond_broadcast(&g_finished_cond);
-        pthread_mutex_unlock(&g_worklock);
+    if (!PyArg_ParseTuple(args, "isd", &indexerId, &name, &value))
+    {
+        return NULL;
     }
-}
 
-PyObject* start_workers(PyObject *self, PyObject *args)
-{
-    int n_workers;
-    if (!PyArg_ParseTuple(args, "i", &n_workers))
+    ProjectIndexer* indexer = LookupIndexer(indexerId);
+    if (indexer == nullptr)
     {
         return NULL;
     }
 
-    std::vector<std::thread> workers;
+    std::string option(name);
+    bool known = true;
 
-    for (int i = 0; i < n_workers; i++)
+    pthread_mutex_lock(&g_worklock);
+    if (option == "parse_retry_seconds")
+    {
+        indexer->parseRetrySeconds = value;
+    }
+    else if (option == "max_parse_retry_seconds")
+    {
+        indexer->maxParseRetrySeconds = value;
+    }
+    else if (option == "max_parse_attempts")
+    {
+        indexer->maxParseAttempts = (int) value;
+    }
+    else if (option == "time_budget_seconds")
+    {
+        indexer->timeBudgetSeconds = value;
+    }
+    else if (option == "extract_time_budget_seconds")
+    {
+        indexer->extractTimeBudgetSeconds = value;
+    }
+    else if (option == "memory_budget_mb")
+    {
+        indexer->memoryBudgetMb = value;
+    }
+    else if (option == "tiered")
+    {
+        indexer->tiered = value != 0;
+    }
+    else if (option == "extractor" && (value == Extractor_Visitor || value == Extractor_IndexAction))
+    {
+        indexer->extractor = (int) value;
+    }
+    else
     {
-        workers.emplace_back(worker);
+        known = false;
     }
+    pthread_mutex_unlock(&g_worklock);
 
-    for (auto &thread : workers)
+    if (!known)
     {
-        thread.join();
+        PyErr_Format(PyExc_KeyError, "unknown indexer option %s", name);
+        return NULL;
     }
     Py_RETURN_NONE;
 }
 
-PyObject* add_file_to_parse(PyObject *self, PyObject *args)
+// deleted_keys(indexer_id) returns {key prefix: keys deleted since the indexer started}, the
+//    tombstones that a compaction of the prefix's range would drop
+//
+PyObject* deleted_keys(PyObject* self, PyObject* args)
 {
-    const char* fileName = nullptr;
-    PyObject* argList;
-    time_t modTime = 0;
+    int indexerId = 0;
 
-    if (!PyArg_ParseTuple(args, "sO!l", &fileName, &PyList_Type, &argList, &modTime))
+    if (!PyArg_ParseTuple(args, "i", &indexerId))
     {
         return NULL;
     }
 
-    std::vector<std::string> argv;
-    for (int i = 0; i < PyList_Size(argList); i++)
+    ProjectIndexer* indexer = LookupIndexer(indexerId);
+    if (indexer == nullptr)
     {
-        argv.push_back(PyString_AsString(PyList_GetItem(argList, i)));
+        return NULL;
     }
 
-    CompileCommand cmd(fileName, argv, modTime);
-
-    Py_BEGIN_ALLOW_THREADS;
     pthread_mutex_lock(&g_worklock);
-    work.push(cmd);
-    g_outstandingTasks++;
-    pthread_cond_signal(&g_workcond);
+    std::map<std::string, long> deletedKeys = indexer->deletedKeys;
     pthread_mutex_unlock(&g_worklock);
-    Py_END_ALLOW_THREADS;
 
-    Py_RETURN_NONE;
+    PyObject* ret = PyDict_New();
+    for (auto& count : deletedKeys)
+    {
+        PyObject* value = Py_BuildValue("l", count.second);
+        PyDict_SetItemString(ret, count.first.c_str(), value);
+        Py_DECREF(value);
+    }
+    return ret;
 }
 
-
-PyObject* start(PyObject *self, PyObject *args)
+// set_pool_option(name, value) changes a setting of the worker pool that all projects share:
+//
+//    pool_size                 number of workers, at most 1.5 per CPU, takes effect right away;
+//                              idle workers exit when the pool shrinks, busy ones after their
+//                              file. Projects that start later keep this size
+//    background                1 to lower the CPU and I/O priority of the workers, so that
+//                              indexing does not compete with the editor, 0 to go back
+//    memory_limit_mb           upper bound for the estimated TU sizes of the files that are
+//                              parsed at once, 0 for none
+//    memory_reserve_mb         system memory (MemAvailable) that starting a file must leave, 0
+//                              for none
+//
+PyObject* set_pool_option(PyObject* self, PyObject* args)
 {
-    PyLevelDB* pyLevelDbConn = nullptr;
-    int nworkers = 0;
-    
-    if (!PyArg_ParseTuple(args, "Oi", &pyLevelDbConn, &nworkers))
+    const char* name = nullptr;
+    double value = 0;
+
+    if (!PyArg_ParseTuple(args, "sd", &name, &value))
+    {
         return NULL;
+    }
 
-    assert(pyLevelDbConn != nullptr);
-    Py_INCREF(pyLevelDbConn);
+    std::string option(name);
+    bool known = true;
 
-    for (int i = 0; i < nworkers; i++)
+    pthread_mutex_lock(&g_worklock);
+    if (option == "pool_size" && value >= 1)
+    {
+        g_userPoolSize = std::min((int) value, g_maxPoolSize);
+        g_poolTarget = g_userPoolSize;
+        FillWorkerPool();
+    }
+    else if (option == "background")
+    {
+        bool background = value != 0;
+        if (g_background && !background)
+        {
+            g_poolGeneration++;
+            g_poolSize = 0;
+            g_stuckWorkers = 0;
+            FillWorkerPool();
+        }
+        g_background = background;
+    }
+    else if (option == "memory_limit_mb")
+    {
+        g_memoryLimitMb = value;
+    }
+    else if (option == "memory_reserve_mb")
     {
-        g_workers.emplace_back(worker);
+        g_memoryReserveMb = value;
     }
-    for (std::thread& worker : g_workers)
+    else
     {
-        worker.detach();
+        known = false;
     }
+    // a shrunk pool or looser limits concern the workers that wait
+    pthread_cond_broadcast(&g_workcond);
+    pthread_mutex_unlock(&g_worklock);
 
-    db = pyLevelDbConn->_db;
+    if (!known)
+    {
+        PyErr_Format(PyExc_KeyError, "unknown pool option %s", name);
+        return NULL;
+    }
     Py_RETURN_NONE;
 }
 
-PyObject* wait_on_work(PyObject* self, PyObject* args)
+// pool_stats() returns the state of the shared worker pool and its admission control
+//
+PyObject* pool_stats(PyObject* self, PyObject* args)
 {
-    Py_BEGIN_ALLOW_THREADS;
+    int poolSize, poolTarget, userPoolSize, stuckWorkers, active;
+    bool background;
+    double memoryLimitMb, memoryReserveMb, admittedMb, averageTuMb;
+    long admissionWaits;
+
     pthread_mutex_lock(&g_worklock);
-    while (g_outstandingTasks > 0)
+    poolSize = g_poolSize;
+    poolTarget = g_poolTarget;
+    userPoolSize = g_userPoolSize;
+    stuckWorkers = g_stuckWorkers;
+    active = g_activeTasks.size();
+    background = g_background;
+    memoryLimitMb = g_memoryLimitMb;
+    memoryReserveMb = g_memoryReserveMb;
+    admittedMb = g_admittedMb;
+    averageTuMb = g_averageTuMb;
+    admissionWaits = g_admissionWaits;
+    pthread_mutex_unlock(&g_worklock);
+
+    return Py_BuildValue("{s:i,s:i,s:i,s:i,s:i,s:i,s:d,s:d,s:d,s:d,s:d,s:l}",
+            "pool_size", poolSize,
+            "pool_target", poolTarget,
+            "user_pool_size", userPoolSize,
+            "stuck_workers", stuckWorkers,
+            "active", active,
+            "background", background ? 1 : 0,
+            "memory_limit_mb", memoryLimitMb,
+            "memory_reserve_mb", memoryReserveMb,
+            "memory_available_mb", GetAvailableMemoryMb(),
+            "admitted_mb", admittedMb,
+            "average_tu_mb", averageTuMb,
+            "admission_waits", admissionWaits);
+}
+
+// set_scope_rules(indexer_id, [(pattern, mode), ...]) replaces the index scope rules of a project.
+//    A pattern with *, ? or [ is a glob (fnmatch, * also matches /), any other pattern is a path
+//    prefix, and "<system>" matches the headers clang considers system headers. The mode is one of
+//    "full", "declarations" (no references, no function bodies) or "exclude" (nothing is written).
+//    The first matching rule wins. Files indexed before keep their entries until they change.
+//
+PyObject* set_scope_rules(PyObject* self, PyObject* args)
+{
+    int indexerId = 0;
+    PyObject* ruleList = nullptr;
+
+    if (!PyArg_ParseTuple(args, "iO!", &indexerId, &PyList_Type, &ruleList))
     {
-        pthread_cond_wait(&g_finished_cond, &g_worklock);
+        return NULL;
+    }
+
+    ProjectIndexer* indexer = LookupIndexer(indexerId);
+    if (indexer == nullptr)
+    {
+        return NULL;
+    }
+
+    std::vector<ScopeRule> rules;
+    for (Py_ssize_t i = 0; i < PyList_Size(ruleList); i++)
+    {
+        const char* pattern = nullptr;
+        const char* mode = nullptr;
+        if (!PyArg_ParseTuple(PyList_GetItem(ruleList, i), "ss", &pattern, &mode))
+        {
+            return NULL;
+        }
+
+        ScopeRule rule;
+        rule.pattern = pattern;
+        rule.systemHeaders = rule.pattern == c_systemHeadersPattern;
+        rule.glob = rule.pattern.find_first_of("*?[") != std::string::npos;
+        if (strcmp(mode, "full") == 0)
+        {
+            rule.mode = Scope_Full;
+        }
+        else if (strcmp(mode, "declarations") == 0)
+        {
+            rule.mode = Scope_Declarations;
+        }
+        else if (strcmp(mode, "exclude") == 0)
+        {
+            rule.mode = Scope_Exclude;
+        }
+        else
+        {
+            PyErr_Format(PyExc_ValueError, "unknown index scope mode %s", mode);
+            return NULL;
+        }
+        rules.push_back(rule);
     }
+
+    pthread_mutex_lock(&g_worklock);
+    indexer->scopeRules = rules;
+    indexer->scopeStats.assign(rules.size(), ScopeRuleStats());
+    indexer->scopeSeen.clear();
+    indexer->scopeGeneration++;
     pthread_mutex_unlock(&g_worklock);
-    Py_END_ALLOW_THREADS;
+
     Py_RETURN_NONE;
 }
 
-PyObject* work_queue_size(PyObject* self, PyObject* args)
+// scope_stats(indexer_id) returns, for every scope rule, what it kept out of the index since the
+//    rules were set: [{pattern, mode, files, source_bytes, cursors_skipped}, ...]
+//
+PyObject* scope_stats(PyObject* self, PyObject* args)
 {
-    int ret = 0;
+    int indexerId = 0;
+
+    if (!PyArg_ParseTuple(args, "i", &indexerId))
+    {
+        return NULL;
+    }
+
+    ProjectIndexer* indexer = LookupIndexer(indexerId);
+    if (indexer == nullptr)
+    {
+        return NULL;
+    }
 
-    Py_BEGIN_ALLOW_THREADS;
     pthread_mutex_lock(&g_worklock);
-    ret = g_outstandingTasks;
+    std::vector<ScopeRule> rules = indexer->scopeRules;
+    std::vector<ScopeRuleStats> stats = indexer->scopeStats;
     pthread_mutex_unlock(&g_worklock);
-    Py_END_ALLOW_THREADS;
 
-    return Py_BuildValue("i", ret);
+    static const char* modeNames[] = {"full", "declarations", "exclude"};
+
+    PyObject* ret = PyList_New(rules.size());
+    if (ret == nullptr)
+    {
+        return NULL;
+    }
+    for (size_t i = 0; i < rules.size(); i++)
+    {
+        PyList_SET_ITEM(ret, i, Py_BuildValue("{s:s,s:s,s:l,s:l,s:l}",
+                    "pattern", rules[i].pattern.c_str(),
+                    "mode", modeNames[rules[i].mode],
+                    "files", stats[i].files,
+                    "source_bytes", stats[i].sourceBytes,
+                    "cursors_skipped", stats[i].cursorsSkipped));
+    }
+    return ret;
 }
 
 PyObject* extract_part(PyObject* self, PyObject* args)
@@ -660,14 +3257,21 @@ PyObject* extract_part(PyObject* self, PyObject* args)
 
 PyObject* remove_file_symbols(PyObject* self, PyObject* args)
 {
+    int indexerId = 0;
     const char* s = nullptr;
 
-    if (!PyArg_ParseTuple(args, "s", &s))
+    if (!PyArg_ParseTuple(args, "is", &indexerId, &s))
+    {
+        return NULL;
+    }
+
+    ProjectIndexer* indexer = LookupIndexer(indexerId);
+    if (indexer == nullptr)
     {
         return NULL;
     }
 
-    RemoveFileSymbols(std::string(s));
+    RemoveFileSymbols(indexer, std::string(s));
     Py_RETURN_NONE;
 }
 
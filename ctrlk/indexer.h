@@ -4,3 +4,13 @@ PyObject* wait_on_work(PyObject* self, PyObject* args);
 PyObject* extract_part(PyObject* self, PyObject* args);
 PyObject* remove_file_symbols(PyObject* self, PyObject* args);
 PyObject* work_queue_size(PyObject* self, PyObject* args);
+PyObject* stats(PyObject* self, PyObject* args);
+PyObject* wait_for_events(PyObject* self, PyObject* args);
+PyObject* clear_queue(PyObject* self, PyObject* args);
+PyObject* pause_queue(PyObject* self, PyObject* args);
+PyObject* set_option(PyObject* self, PyObject* args);
+PyObject* set_scope_rules(PyObject* self, PyObject* args);
+PyObject* scope_stats(PyObject* self, PyObject* args);
+PyObject* set_pool_option(PyObject* self, PyObject* args);
+PyObject* pool_stats(PyObject* self, PyObject* args);
+PyObject* deleted_keys(PyObject* self, PyObject* args);
@@ -0,0 +1,165 @@
+import bisect
+import collections
+import threading
+
+# Request instrumentation for ctrlk_server, rendered in the Prometheus text format.
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+SIZE_BUCKETS = [64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216]
+
+LEVELDB_STATS_COLUMNS = ['files', 'size_mb', 'compaction_seconds', 'compaction_read_mb', 'compaction_write_mb']
+
+# (column of the "leveldb.stats" table, metric name, type, help)
+LEVELDB_METRICS = [
+    ('files', 'ctrlk_leveldb_level_files', 'gauge', 'Table files in a LevelDB level.'),
+    ('size_mb', 'ctrlk_leveldb_level_size_mb', 'gauge', 'Size of a LevelDB level in MB.'),
+    ('compaction_seconds', 'ctrlk_leveldb_level_compaction_seconds_total', 'counter',
+     'Time spent compacting into a LevelDB level.'),
+    ('compaction_read_mb', 'ctrlk_leveldb_level_compaction_read_mb_total', 'counter',
+     'MB read by compactions into a LevelDB level.'),
+    ('compaction_write_mb', 'ctrlk_leveldb_level_compaction_write_mb_total', 'counter',
+     'MB written by compactions into a LevelDB level.'),
+]
+
+# (key of indexer.stats(), metric name, type, help); stats that are not listed are not exported
+INDEXER_METRICS = [
+    ('queued', 'ctrlk_indexer_queued', 'gauge', 'Files waiting to be indexed.'),
+    ('queued_references', 'ctrlk_indexer_queued_references', 'gauge', 'Reference passes waiting to run.'),
+    ('active', 'ctrlk_indexer_active', 'gauge', 'Files being indexed.'),
+    ('outstanding', 'ctrlk_indexer_outstanding', 'gauge', 'Files queued or being indexed.'),
+    ('files_indexed', 'ctrlk_indexer_files_indexed_total', 'counter', 'Files indexed.'),
+    ('files_up_to_date', 'ctrlk_indexer_files_up_to_date_total', 'counter', 'Files skipped because they were up to date.'),
+    ('files_failed', 'ctrlk_indexer_files_failed_total', 'counter', 'Files that libclang failed to parse.'),
+    ('files_skipped', 'ctrlk_indexer_files_skipped_total', 'counter', 'Files skipped while their parse failures back off.'),
+    ('files_over_budget', 'ctrlk_indexer_files_over_budget_total', 'counter', 'Files that went over a time or memory budget.'),
+    ('files_referenced', 'ctrlk_indexer_files_referenced_total', 'counter', 'Reference passes that finished.'),
+    ('writes_skipped', 'ctrlk_indexer_writes_skipped_total', 'counter', 'Index writes skipped because the entry was unchanged.'),
+    ('write_bytes_skipped', 'ctrlk_indexer_write_bytes_skipped_total', 'counter', 'Bytes of the skipped index writes.'),
+    ('pool_size', 'ctrlk_indexer_pool_size', 'gauge', 'Worker threads of the shared pool.'),
+    ('stuck_workers', 'ctrlk_indexer_stuck_workers', 'gauge', 'Workers replaced because their file went over the time budget.'),
+]
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (name, format_labels(labels + [('le', format_value(bound))]), cumulative))
+        lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(self.sum)))
+        lines.append('%s_count%s %d' % (name, format_labels(labels), self.count))
+        return lines
+
+# Latency, request and response size histograms, status counts and in-flight gauges per route.
+class RequestMetrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = collections.defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.request_size = collections.defaultdict(lambda: Histogram(SIZE_BUCKETS))
+        self.response_size = collections.defaultdict(lambda: Histogram(SIZE_BUCKETS))
+        self.responses = collections.defaultdict(int)
+        self.errors = collections.defaultdict(int)
+        self.in_flight = collections.defaultdict(int)
+
+    def start(self, route):
+        with self.lock:
+            self.in_flight[route] += 1
+
+    def finish(self, route, status, seconds, request_bytes, response_bytes):
+        with self.lock:
+            self.in_flight[route] -= 1
+            self.latency[route].observe(seconds)
+            self.request_size[route].observe(request_bytes)
+            self.response_size[route].observe(response_bytes)
+            self.responses[(route, status)] += 1
+            if status >= 400:
+                self.errors[route] += 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines += ['# HELP ctrlk_request_duration_seconds Time to answer a request.',
+                      '# TYPE ctrlk_request_duration_seconds histogram']
+            for route, histogram in sorted(self.latency.items()):
+                lines += histogram.render('ctrlk_request_duration_seconds', [('route', route)])
+
+            lines += ['# HELP ctrlk_request_size_bytes Size of the request URI and body.',
+                      '# TYPE ctrlk_request_size_bytes histogram']
+            for route, histogram in sorted(self.request_size.items()):
+                lines += histogram.render('ctrlk_request_size_bytes', [('route', route)])
+
+            lines += ['# HELP ctrlk_response_size_bytes Size of the response body before compression.',
+                      '# TYPE ctrlk_response_size_bytes histogram']
+            for route, histogram in sorted(self.response_size.items()):
+                lines += histogram.render('ctrlk_response_size_bytes', [('route', route)])
+
+            lines += ['# HELP ctrlk_responses_total Responses by route and status code.',
+                      '# TYPE ctrlk_responses_total counter']
+            for (route, status), count in sorted(self.responses.items()):
+                lines.append('ctrlk_responses_total%s %d' % (format_labels([('route', route), ('code', status)]), count))
+
+            lines += ['# HELP ctrlk_request_errors_total Responses with a 4xx or 5xx status.',
+                      '# TYPE ctrlk_request_errors_total counter']
+            for route, count in sorted(self.errors.items()):
+                lines.append('ctrlk_request_errors_total%s %d' % (format_labels([('route', route)]), count))
+
+            lines += ['# HELP ctrlk_requests_in_flight Requests currently being handled.',
+                      '# TYPE ctrlk_requests_in_flight gauge']
+            for route, count in sorted(self.in_flight.items()):
+                lines.append('ctrlk_requests_in_flight%s %d' % (format_labels([('route', route)]), count))
+        return lines
+
+# Turns the per-level table of the "leveldb.stats" property into
+#    {level: {'files': .., 'size_mb': .., ...}}.
+def parse_leveldb_stats(stats):
+    ret = {}
+    for line in stats.splitlines():
+        parts = line.split()
+        if len(parts) != len(LEVELDB_STATS_COLUMNS) + 1 or not parts[0].isdigit():
+            continue
+        ret[int(parts[0])] = dict(zip(LEVELDB_STATS_COLUMNS, [float(x) for x in parts[1:]]))
+    return ret
+
+# projects is [(project_root, "leveldb.stats" property)], every metric is rendered with the samples
+#    of all the projects under one HELP and TYPE
+def render_leveldb_stats(projects):
+    levels = [(project_root, parse_leveldb_stats(stats)) for project_root, stats in projects]
+    lines = []
+    for column, name, metric_type, help_text in LEVELDB_METRICS:
+        lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s %s' % (name, metric_type)]
+        for project_root, project_levels in levels:
+            for level, columns in sorted(project_levels.items()):
+                labels = [('project', project_root), ('level', level)]
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(columns[column])))
+    return lines
+
+# projects is [(project_root, indexer.stats())], see render_leveldb_stats
+def render_indexer_stats(projects):
+    lines = []
+    for key, name, metric_type, help_text in INDEXER_METRICS:
+        lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s %s' % (name, metric_type)]
+        for project_root, stats in projects:
+            if key in stats:
+                lines.append('%s%s %s' % (name, format_labels([('project', project_root)]), format_value(stats[key])))
+    return lines
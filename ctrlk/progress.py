@@ -0,0 +1,72 @@
+import collections
+import threading
+import time
+
+from ctrlk import indexer
+
+# how far back finished files count towards the throughput estimate
+THROUGHPUT_WINDOW_SECONDS = 60
+
+MAX_EVENTS = 1000
+
+# Follows the indexer events of one project on a background thread, so that any number of
+#    clients can wait for progress without each of them holding an indexer call open. Listeners
+#    are called from that thread whenever new events arrive.
+class ProgressFeed(object):
+    def __init__(self, project):
+        self.project = project
+        self.lock = threading.Lock()
+        self.events = collections.deque(maxlen=MAX_EVENTS)
+        self.finish_times = collections.deque()
+        self.seq = 0
+        self.listeners = []
+
+        t = threading.Thread(target=self.follow)
+        t.daemon = True
+        t.start()
+
+    def follow(self):
+        while True:
+            seq, events = indexer.wait_for_events(self.project.indexer_id, self.seq, 60.0)
+            if not events:
+                continue
+
+            with self.lock:
+                for event_seq, event_type, file_name, event_time in events:
+                    self.events.append({'seq': event_seq, 'type': event_type, 'file': file_name, 'time': event_time})
+                    if event_type == 'finished':
+                        self.finish_times.append(event_time)
+                self.seq = seq
+                listeners = list(self.listeners)
+
+            for listener in listeners:
+                listener()
+
+    def add_listener(self, listener):
+        with self.lock:
+            self.listeners.append(listener)
+
+    def throughput(self):
+        cutoff = time.time() - THROUGHPUT_WINDOW_SECONDS
+        with self.lock:
+            while self.finish_times and self.finish_times[0] < cutoff:
+                self.finish_times.popleft()
+            return len(self.finish_times) / float(THROUGHPUT_WINDOW_SECONDS)
+
+    # everything a client needs to render progress: events after `since`, the queue and rates
+    def snapshot(self, since):
+        with self.lock:
+            events = [event for event in self.events if event['seq'] > since]
+            seq = self.seq
+
+        ret = self.project.indexer_stats()
+        ret['seq'] = seq
+        ret['events'] = events
+        ret['throughput'] = self.throughput()
+        if ret['outstanding'] == 0:
+            ret['eta_seconds'] = 0
+        elif ret['throughput'] > 0:
+            ret['eta_seconds'] = ret['outstanding'] / ret['throughput']
+        else:
+            ret['eta_seconds'] = None
+        return ret
@@ -1,5 +1,6 @@
-from clang.cindex import Index, Config, TranslationUnitLoadError, CursorKind, File, SourceLocation, Cursor, TranslationUnit
 from ctrlk import indexer
+import bisect
+import glob
 import multiprocessing
 import threading
 import os
@@ -7,13 +8,64 @@ import time
 import re
 import sys
 
+from ctrlk import compaction
+from ctrlk import progress
 from ctrlk import search
+from ctrlk import segment
 
 try:
     import simplejson as json
 except ImportError:
     import json
 
+# Per-project settings, read from the project root when the project is registered:
+#
+#   {
+#     "index_scope": [
+#       {"path": "third_party/", "mode": "declarations"},
+#       {"path": "*/generated/*.pb.h", "mode": "exclude"},
+#       {"system_headers": true, "mode": "declarations"}
+#     ],
+#     "time_budget_seconds": 120,
+#     "extract_time_budget_seconds": 120
+#   }
+#
+# Relative paths are relative to the project root. See indexer.set_scope_rules for the semantics.
+# The per-file budgets are off unless they are set here, see BUDGET_OPTIONS.
+CONFIG_FILE_NAME = '.ctrlk.json'
+
+# matches c_defaultMaxParseAttempts in indexer.cpp
+DEFAULT_MAX_PARSE_ATTEMPTS = 5
+
+# values of the "extractor" config key and the --extractor option => indexer.set_option value
+EXTRACTORS = {'visitor': 0, 'index_action': 1}
+
+# config keys that are passed to indexer.set_option as they are, all of them default to 0 (off)
+BUDGET_OPTIONS = ('time_budget_seconds', 'extract_time_budget_seconds', 'memory_budget_mb')
+
+# see set_pool_option in indexer.cpp
+POOL_OPTIONS = ('pool_size', 'background', 'memory_limit_mb', 'memory_reserve_mb')
+
+BUILTIN_HEADER_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.ctrlk', 'builtin_header_cache.json')
+
+# clang.cindex is imported on first use, so that starting the server and registering a
+# project with a cached builtin header path never has to load libclang
+_cindex = None
+_cindex_lock = threading.Lock()
+
+def cindex(library_path=None):
+    global _cindex
+    with _cindex_lock:
+        if _cindex is None:
+            start = time.time()
+            import clang.cindex
+            _cindex = clang.cindex
+            print >>sys.stderr, "ctrlk: imported clang.cindex in %.1f ms" % ((time.time() - start) * 1000)
+        if library_path is not None and not _cindex.Config.loaded:
+            _cindex.Config.set_library_path(library_path)
+            _cindex.Config.set_compatibility_check(False)
+    return _cindex
+
 def GetCursorForFile(tu, fileName):
     cursor = tu.cursor
     if str(cursor.extent.start.file) == str(cursor.extent.end.file) and os.path.abspath(str(cursor.extent.start.file)) == fileName:
@@ -50,6 +102,51 @@ def PopulateScopeNames(cursor, scopeNames, scopeDepths, depth = 0):
 
                 PopulateScopeNames(ch, scopeNames, scopeDepths, depth + 1)
 
+def ResolveCursor(cursor):
+    while cursor is not None and (not cursor.referenced or not cursor.referenced.get_usr()):
+        nextCursor = cursor.lexical_parent
+        if nextCursor is not None and nextCursor == cursor:
+            return ""
+        cursor = nextCursor
+    if cursor is None:
+        return ""
+
+    cursor = cursor.referenced
+    if cursor is None:
+        return ""
+
+    return {'usr': cursor.get_usr(), 'file': str(cursor.location.file), 'line': cursor.location.line, 'column': cursor.location.column}
+
+# Sorted (line, column range) -> referenced symbol table for one parsed file. It is
+# built once after the current file is parsed, so that cursor queries become a binary
+# search instead of a chain of libclang calls. Only identifiers are in the table.
+class CursorTable(object):
+    def __init__(self, tu, file_name, content_length):
+        self.starts = []
+        self.ends = []
+        self.results = []
+
+        ci = cindex()
+        f = ci.File.from_name(tu, file_name)
+        extent = ci.SourceRange.from_locations(ci.SourceLocation.from_offset(tu, f, 0),
+                                               ci.SourceLocation.from_offset(tu, f, content_length))
+        for token in tu.get_tokens(extent=extent):
+            if token.kind != ci.TokenKind.IDENTIFIER:
+                continue
+            start = token.extent.start
+            end = token.extent.end
+            if start.line != end.line:
+                continue
+            self.starts.append((start.line, start.column))
+            self.ends.append(end.column)
+            self.results.append(ResolveCursor(token.cursor))
+
+    def lookup(self, line, col):
+        i = bisect.bisect_right(self.starts, (line, col)) - 1
+        if i < 0 or self.starts[i][0] != line or col >= self.ends[i]:
+            return None
+        return self.results[i]
+
 def ParseCurrentFileThread(project):
     while True:
         with project.c_parse_lock:
@@ -61,61 +158,117 @@ def ParseCurrentFileThread(project):
         project.parse_current_file_internal(work[0], work[1], work[2])
 
 class Project(object):
-    def __init__(self, library_path, project_root, n_workers=None):
+    def __init__(self, library_path, project_root, n_workers=None, cursor_table=False):
         if n_workers is None:
             n_workers = (multiprocessing.cpu_count() * 3) / 2
 
-        self.clang_library_path = library_path
+        start = time.time()
 
-        if not Config.loaded:
-            Config.set_library_path(self.clang_library_path)
-            Config.set_compatibility_check(False)
+        self.clang_library_path = library_path
 
-        self.builtin_header_path = getBuiltinHeaderPath(self.clang_library_path)
+        self.builtin_header_path = getCachedBuiltinHeaderPath(self.clang_library_path)
 
         if self.builtin_header_path is None:
             raise Exception("Cannot find clang includes")
 
-        project_root = os.path.abspath(project_root)
-
-        curr_path = project_root
-        self.compile_commands_path = None
-        while curr_path:
-            compile_commands_path = os.path.join(curr_path, 'compile_commands.json')
-            if os.path.exists(compile_commands_path):
-                self.compile_commands_path = compile_commands_path
-                self.index_db_path = os.path.join(curr_path, '.ctrlk-index')
-                self.project_root = curr_path
-                break
-            elif curr_path == '/':
-                break
-            curr_path = os.path.dirname(curr_path)
-
-        if self.compile_commands_path is None:
-            raise Exception("Could not find a 'compile_commands.json' file in the " +\
-                                "directory hierarchy from '%s'" % (project_root))
+        probe_done = time.time()
+
+        self.project_root = find_project_root(project_root)
+        self.compile_commands_path = os.path.join(self.project_root, 'compile_commands.json')
+        self.index_db_path = get_index_db_path(self.project_root)
+        self.config = load_project_config(self.project_root)
+        self.scope_rules = get_scope_rules(self.config, self.project_root)
+        self.segment_path = get_segment_path(self.project_root)
 
         self._compilation_db = None
         self._compilation_db_modtime = 0
 
         self._leveldb_connection = None
-        indexer.start(self.leveldb_connection, n_workers)
+        self._leveldb_lock = threading.Lock()
+        self._segment = None
+        self._segment_lock = threading.Lock()
+        self._indexer_id = None
+        self._indexer_lock = threading.Lock()
+        self.n_workers = n_workers
+        self.max_parse_attempts = DEFAULT_MAX_PARSE_ATTEMPTS
+        self._progress_feed = None
+        self._compaction_scheduler = None
 
         self.current_file_tus = {}
         self.current_file_expire = {}
         self.current_file_scopes = {}
+        self.current_file_cursor_tables = {}
+        self.use_cursor_table = cursor_table
 
         self.c_parse_queue = []
         self.c_parse_lock = threading.Lock()
         self.c_parse_cond = threading.Condition(self.c_parse_lock)
 
-        threading.Thread(target=ParseCurrentFileThread, args=(self,)).start()
+        # daemon, so that a command line indexer can exit once the indexer is done
+        t = threading.Thread(target=ParseCurrentFileThread, args=(self,))
+        t.daemon = True
+        t.start()
+
+        end = time.time()
+        print >>sys.stderr, "ctrlk: registered %s in %.1f ms (builtin header probe %.1f ms, project setup %.1f ms)" % \
+                (self.project_root, (end - start) * 1000, (probe_done - start) * 1000, (end - probe_done) * 1000)
 
     @property
     def leveldb_connection(self):
-        if not self._leveldb_connection:
-            self._leveldb_connection = indexer.LevelDB(self.index_db_path)
-        return self._leveldb_connection
+        # a second LevelDB on the same path fails to take its lock, so only one thread may open it
+        with self._leveldb_lock:
+            if not self._leveldb_connection:
+                start = time.time()
+                self._leveldb_connection = indexer.LevelDB(self.index_db_path)
+                print >>sys.stderr, "ctrlk: opened %s in %.1f ms" % (self.index_db_path, (time.time() - start) * 1000)
+            return self._leveldb_connection
+
+    @property
+    def segment(self):
+        with self._segment_lock:
+            if self._segment is None and os.path.exists(self.segment_path):
+                self._segment = segment.Segment(self.segment_path)
+            return self._segment
+
+    # what queries should read: the frozen segment with LevelDB on top of it, if there is a segment
+    @property
+    def query_connection(self):
+        current_segment = self.segment
+        if current_segment is None:
+            return self.leveldb_connection
+        return segment.LayeredIndex(self.leveldb_connection, current_segment)
+
+    # moves the file list, navigation names and references into a new segment, see segment.freeze.
+    # The indexer is paused for the whole freeze, a file that is half written when the snapshot is
+    # taken would otherwise have its partial entries frozen and then hidden once it is stamped.
+    def freeze_index(self):
+        paused = self.indexer_running
+        if paused:
+            indexer.pause_queue(self.indexer_id, True)
+        try:
+            new_segment = segment.freeze(self.leveldb_connection, self.segment_path, self.segment)
+        finally:
+            if paused:
+                indexer.pause_queue(self.indexer_id, False)
+        with self._segment_lock:
+            self._segment = new_segment
+        return new_segment.count
+
+    # the index and the indexer are only set up when the project first needs them
+    @property
+    def indexer_id(self):
+        with self._indexer_lock:
+            if self._indexer_id is None:
+                self._indexer_id = indexer.start(self.leveldb_connection, self.n_workers)
+                indexer.set_scope_rules(self._indexer_id, self.scope_rules)
+                if self.config.get('tiered_indexing'):
+                    indexer.set_option(self._indexer_id, 'tiered', 1)
+                if 'extractor' in self.config:
+                    indexer.set_option(self._indexer_id, 'extractor', EXTRACTORS[self.config['extractor']])
+                for name in BUDGET_OPTIONS:
+                    if name in self.config:
+                        indexer.set_option(self._indexer_id, name, self.config[name])
+        return self._indexer_id
 
     @property
     def compilation_db(self):
@@ -168,6 +321,7 @@ class Project(object):
                     self.current_file_tus.pop(file_name, None)
                     self.current_file_expire.pop(file_name, None)
                     self.current_file_scopes.pop(file_name, None)
+                    self.current_file_cursor_tables.pop(file_name, None)
 
     def parse_file(self, file_name):
         try:
@@ -179,7 +333,7 @@ class Project(object):
                 print >>sys.stderr, "Unable to stat() %s: %s" % (file_name, e)
                 return
 
-        indexer.add_file_to_parse(origin_file, compile_command, mod_time)
+        indexer.add_file_to_parse(self.indexer_id, origin_file, compile_command, mod_time)
 
     def parse_current_file(self, command, file_name, content):
         with self.c_parse_lock:
@@ -190,11 +344,15 @@ class Project(object):
     def parse_current_file_internal(self, command, file_name, content):
         self.cleanup_expired_tus()
 
-        index = Index.create()
-        tu = index.parse(None, json.loads(command), unsaved_files=[(file_name, RemoveNonAscii(content))], options = TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD)
+        content = RemoveNonAscii(content)
+        ci = cindex(self.clang_library_path)
+        index = ci.Index.create()
+        tu = index.parse(None, json.loads(command), unsaved_files=[(file_name, content)], options = ci.TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD)
         with self.c_parse_lock:
             self.current_file_tus[file_name] = tu
             self.current_file_expire[file_name] = time.time() + 3600 * 10
+            # the old table describes the previous content, drop it until the new one is built
+            self.current_file_cursor_tables.pop(file_name, None)
 
         scopeNames = []
         scopeDepths = []
@@ -203,34 +361,40 @@ class Project(object):
         with self.c_parse_lock:
             self.current_file_scopes[file_name] = scopeNames
 
+        if self.use_cursor_table:
+            cursorTable = CursorTable(tu, file_name, len(content))
+            with self.c_parse_lock:
+                if self.current_file_tus.get(file_name) is tu:
+                    self.current_file_cursor_tables[file_name] = cursorTable
+
     def unload_current_file(self, file_name):
         with self.c_parse_lock:
             self.current_file_tus.pop(file_name, None)
             self.current_file_expire.pop(file_name, None)
             self.current_file_scopes.pop(file_name, None)
+            self.current_file_cursor_tables.pop(file_name, None)
     
     def get_usr_under_cursor(self, file_name, line, col):
+        line = int(line)
+        col = int(col)
         with self.c_parse_lock:
             if file_name not in self.current_file_tus:
                 return ""
             tu = self.current_file_tus[file_name]
-        f = File.from_name(tu, file_name)
-        loc = SourceLocation.from_position(tu, f, int(line), int(col))
-        cursor = Cursor.from_location(tu, loc)
+            cursorTable = self.current_file_cursor_tables.get(file_name)
 
-        while cursor is not None and (not cursor.referenced or not cursor.referenced.get_usr()):
-            nextCursor = cursor.lexical_parent
-            if nextCursor is not None and nextCursor == cursor:
-                return ""
-            cursor = nextCursor
-        if cursor is None:
-            return ""
+        if cursorTable is not None:
+            ret = cursorTable.lookup(line, col)
+            if ret is not None:
+                return ret
 
-        cursor = cursor.referenced
-        if cursor is None:
-            return ""
+        ci = cindex()
+        f = ci.File.from_name(tu, file_name)
+        loc = ci.SourceLocation.from_position(tu, f, line, col)
+        return ResolveCursor(ci.Cursor.from_location(tu, loc))
 
-        return {'usr': cursor.get_usr(), 'file': str(cursor.location.file), 'line': cursor.location.line, 'column': cursor.location.column}
+    def get_usrs_under_cursor(self, file_name, positions):
+        return [self.get_usr_under_cursor(file_name, line, col) for line, col in positions]
 
     def get_current_scope_str(self, file_name, line):
         line = int(line)
@@ -246,7 +410,7 @@ class Project(object):
                 mod_time = get_file_modtime(file_name)
             except OSError:
                 continue
-            indexer.add_file_to_parse(file_name, compile_command, mod_time)
+            indexer.add_file_to_parse(self.indexer_id, file_name, compile_command, mod_time)
 
         cpp_files_to_reparse = set()
         for header_file_key, origin_file_name in search.leveldb_range_iter(self.leveldb_connection, "h%%%"):
@@ -256,7 +420,7 @@ class Project(object):
             try:
                 real_mod_time = get_file_modtime(header_file_name)
             except OSError:
-                indexer.remove_file_symbols(header_file_name)
+                self.forget_file(header_file_name)
                 continue
 
             if real_mod_time <= saved_mod_time:
@@ -265,13 +429,188 @@ class Project(object):
             compile_command = project_files[origin_file_name]
             if origin_file_name not in cpp_files_to_reparse:
                 cpp_files_to_reparse.add(origin_file_name)
-                indexer.add_file_to_parse(origin_file_name, compile_command, real_mod_time)
+                indexer.add_file_to_parse(self.indexer_id, origin_file_name, compile_command, real_mod_time)
+
+        self.resume_reference_passes(cpp_files_to_reparse)
+
+    # Removes everything the index holds about a file that no longer exists: its symbols, and the
+    #    entries keyed by its name. Without its f%%% stamp, the frozen entries of the file are
+    #    ignored by queries and left out of the next segment, see segment.LayeredIndex.
+    def forget_file(self, file_name):
+        indexer.remove_file_symbols(self.indexer_id, file_name)
+
+        batch = indexer.WriteBatch()
+        for prefix in ('f', 'h', 't', 'x', 'slow'):
+            batch.Delete(prefix + '%%%' + file_name)
+        batch.Delete('F%%%' + os.path.basename(file_name).lower() + '%%%' + file_name)
+        self.leveldb_connection.Write(batch)
+
+    # Queues the reference pass (tier 2) of every file whose declaration pass is done but whose
+    #    references are not in: passes that were queued when the server stopped or the queue was
+    #    cleared, and ones that failed, which retry with the parse failure backoff. A header at
+    #    tier 1 is covered by the pass of the file that claimed it. Files whose pass went over the
+    #    extraction budget are left alone until they change.
+    def resume_reference_passes(self, skip=()):
+        project_files = self.compilation_db
+        origin_files = set()
+        for tier_key, tier in search.leveldb_range_iter(self.leveldb_connection, "t%%%"):
+            if tier != '1':
+                continue
+            file_name = search.extract_part(tier_key, 1)
+            if file_name not in project_files:
+                try:
+                    file_name = self.leveldb_connection.Get("h%%%" + file_name)
+                except KeyError:
+                    continue
+            origin_files.add(file_name)
+
+        for origin_file_name in origin_files:
+            # files that changed get a new declaration pass, which queues its own reference pass
+            if origin_file_name in skip or origin_file_name not in project_files:
+                continue
+            try:
+                mod_time = get_file_modtime(origin_file_name)
+                saved_mod_time = int(self.leveldb_connection.Get("f%%%" + origin_file_name))
+            except (OSError, KeyError):
+                continue
+            if mod_time > saved_mod_time or self.is_cheap(origin_file_name, mod_time):
+                continue
+            indexer.add_file_to_parse(self.indexer_id, origin_file_name, project_files[origin_file_name], mod_time, 2)
+
+    # true if file_name went over budget at mod_time, and is only parsed without function bodies
+    def is_cheap(self, file_name, mod_time):
+        try:
+            parts = self.leveldb_connection.Get("slow%%%" + file_name).split()
+        except KeyError:
+            return False
+        return len(parts) > 5 and parts[3] == 'cheap' and int(parts[5]) == mod_time
+
+    # returns False if the work is still not done after timeout seconds
+    def wait_on_work(self, timeout=None):
+        if timeout is None:
+            return indexer.wait_on_work(self.indexer_id)
+        return indexer.wait_on_work(self.indexer_id, timeout)
+
+    # metrics must not start the indexer or open the index of a project that does not use them yet
+    @property
+    def indexer_running(self):
+        return self._indexer_id is not None
+
+    def leveldb_stats(self):
+        if not self._leveldb_connection:
+            return None
+        return self._leveldb_connection.GetStats()
+
+    @property
+    def progress_feed(self):
+        with self._indexer_lock:
+            if self._progress_feed is None:
+                self._progress_feed = progress.ProgressFeed(self)
+        return self._progress_feed
 
-    def wait_on_work(self):
-        indexer.wait_on_work()
+    @property
+    def compaction_scheduler(self):
+        with self._indexer_lock:
+            if self._compaction_scheduler is None:
+                self._compaction_scheduler = compaction.CompactionScheduler(self)
+        return self._compaction_scheduler
+
+    # drops the queued files that are not started yet, returns how many were dropped
+    def clear_queue(self):
+        return indexer.clear_queue(self.indexer_id)
+
+    # see indexer.set_option for the names
+    def set_indexer_option(self, name, value):
+        indexer.set_option(self.indexer_id, name, value)
+        if name == 'max_parse_attempts':
+            self.max_parse_attempts = int(value)
+
+    # files that libclang could not parse, or parsed with errors, see the x%%% entries in search.py
+    def parse_failures(self):
+        now = time.time()
+        ret = []
+        for key, value in search.leveldb_range_iter(self.leveldb_connection, 'x%%%'):
+            header, diagnostics = value.split('\n', 1)
+            failures, next_retry, mod_time, args_hash = header.split()
+            failures = int(failures)
+            ret.append({
+                'file_name': search.extract_part(key, 1),
+                'failures': failures,
+                'next_retry': float(next_retry) if failures > 0 else None,
+                'hopeless': failures >= self.max_parse_attempts,
+                'retry_in_seconds': max(0, float(next_retry) - now) if failures > 0 else None,
+                'diagnostics': diagnostics.splitlines(),
+            })
+        return ret
+
+    # files that went over their time or memory budget, the most frequent offenders first
+    def slow_files(self):
+        ret = []
+        for key, value in search.leveldb_range_iter(self.leveldb_connection, 'slow%%%'):
+            times_over_budget, seconds, memory_mb, mode, reason = value.split()[:5]
+            ret.append({
+                'file_name': search.extract_part(key, 1),
+                'times_over_budget': int(times_over_budget),
+                'seconds': float(seconds),
+                'memory_mb': float(memory_mb),
+                'mode': mode,
+                'reason': reason,
+            })
+        ret.sort(key=lambda x: (-x['times_over_budget'], -x['seconds']))
+        return ret
+
+    def scope_stats(self):
+        return indexer.scope_stats(self.indexer_id)
 
     def work_queue_size(self):
-        return indexer.work_queue_size()
+        return indexer.work_queue_size(self.indexer_id)
+
+    def indexer_stats(self):
+        return indexer.stats(self.indexer_id)
+
+# The worker pool is shared by all the projects of a process, so it is configured here rather
+#    than on a Project. Returns indexer.pool_stats() after the change.
+def configure_pool(**options):
+    for name, value in options.iteritems():
+        indexer.set_pool_option(name, float(value))
+    return indexer.pool_stats()
+
+# the closest directory at or above path that has a compile_commands.json
+def find_project_root(path):
+    curr_path = os.path.abspath(path)
+    while curr_path:
+        if os.path.exists(os.path.join(curr_path, 'compile_commands.json')):
+            return curr_path
+        elif curr_path == '/':
+            break
+        curr_path = os.path.dirname(curr_path)
+
+    raise Exception("Could not find a 'compile_commands.json' file in the " +\
+                        "directory hierarchy from '%s'" % (path))
+
+def load_project_config(project_root):
+    config_path = os.path.join(project_root, CONFIG_FILE_NAME)
+    if not os.path.exists(config_path):
+        return {}
+    with open(config_path, 'r') as f:
+        return json.load(f)
+
+# [(pattern, mode)] as indexer.set_scope_rules expects them
+def get_scope_rules(config, project_root):
+    ret = []
+    for rule in config.get('index_scope', []):
+        if rule.get('system_headers'):
+            pattern = '<system>'
+        else:
+            pattern = os.path.join(project_root, rule['path'])
+        ret.append((str(pattern), str(rule.get('mode', 'full'))))
+    return ret
+
+def get_index_db_path(project_root):
+    return os.path.join(project_root, '.ctrlk-index')
+
+def get_segment_path(project_root):
+    return os.path.join(project_root, '.ctrlk-segment')
 
 def get_file_modtime(file_name):
     return int(os.path.getmtime(file_name))
@@ -282,7 +621,7 @@ def canFindBuiltinHeaders(index, args = []):
   currentFile = ("test.c", '#include "stddef.h"')
   try:
     tu = index.parse("test.c", args, [currentFile], flags)
-  except TranslationUnitLoadError:
+  except cindex().TranslationUnitLoadError:
     return 0
   return len(tu.diagnostics) == 0
 
@@ -293,7 +632,7 @@ def canFindBuiltinHeaders(index, args = []):
 # for all manual installations (the ones where the builtin header path problem
 # is very common) as well as a set of very common distributions.
 def getBuiltinHeaderPath(library_path):
-  index = Index.create()
+  index = cindex(library_path).Index.create()
   knownPaths = [
           library_path + "/../lib/clang", # default value
           library_path + "/../clang", # gentoo
@@ -319,3 +658,53 @@ def getBuiltinHeaderPath(library_path):
       pass
 
   return None
+
+# the resolved path of the libclang in library_path, or None. Distributions often ship only versioned
+#    names like libclang-14.so.1 or libclang.so.18.1, without the unversioned symlink.
+def find_libclang(library_path):
+    for name in ['libclang.so', 'libclang.dylib', 'libclang.dll']:
+        path = os.path.join(library_path, name)
+        if os.path.exists(path):
+            return os.path.realpath(path)
+    for pattern in ['libclang*.so*', 'libclang*.dylib']:
+        matches = sorted(set(os.path.realpath(path) for path in glob.glob(os.path.join(library_path, pattern))))
+        if matches:
+            return matches[-1]
+    return None
+
+# Probing for the builtin headers means loading libclang and parsing a test file for
+# every candidate directory, so the result is persisted keyed by the library path, the
+# file libclang resolves to and its mtime, and only redone when any of them changes.
+def getCachedBuiltinHeaderPath(library_path):
+    key = os.path.abspath(library_path)
+    library = find_libclang(library_path)
+    mod_time = get_file_modtime(library) if library is not None else 0
+
+    try:
+        with open(BUILTIN_HEADER_CACHE_PATH, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+
+    entry = cache.get(key)
+    if entry is not None and entry.get('library') == library and entry.get('mtime') == mod_time \
+            and os.path.isdir(entry.get('path', '')):
+        return entry['path']
+
+    path = getBuiltinHeaderPath(library_path)
+    if path is None:
+        return None
+
+    cache[key] = {'library': library, 'mtime': mod_time, 'path': path}
+    try:
+        cache_dir = os.path.dirname(BUILTIN_HEADER_CACHE_PATH)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = BUILTIN_HEADER_CACHE_PATH + '.%d' % os.getpid()
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.rename(tmp_path, BUILTIN_HEADER_CACHE_PATH)
+    except (IOError, OSError) as e:
+        print >>sys.stderr, "Unable to save builtin header path cache %s: %s" % (BUILTIN_HEADER_CACHE_PATH, e)
+
+    return path
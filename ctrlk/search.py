@@ -1,3 +1,4 @@
+import heapq
 import os
 
 # TODO: handle files that are deleted. today we only add and reparse files
@@ -7,8 +8,12 @@ import os
 #   f%%%<file_name> => <lastModified>
 #      file <file_name> was indexed, at that moment its mtime was lastModified
 #
-#   c%%%<file_name>%%%<symbol> => 1
-#      file <file_name> contains symbol <symbol>. used to delete symbols when we reparse file
+#   c%%%<file_name>%%%<symbol> => <refs> <defs>
+#      file <file_name> contains symbol <symbol>. used to delete symbols when we reparse file. <refs>
+#      and <defs> count its s%%% entries in the file; the value is 1 until the TU that wrote it is done
+#
+#   a%%%<symbol> => <refs> <defs> <files>
+#      sums of the counted c%%% entries of <symbol>, kept up to date as files are indexed and removed
 #
 #   spelling%%%<symbol> => <spelling>
 #      spelling of a symbol
@@ -28,12 +33,42 @@ import os
 #   ndeclsuf%%%<spelling suffix>%%%<symbol>%%%<file_name>%%%<line>%%%<col>%%%<spelling_with_class> => <use_type>
 #      Suffixes of declarations for symbol navigation
 #
+#   calls%%%<caller>%%%<callee>%%%<file_name> => <line> <col>
+#      function <caller> calls (or otherwise uses) function <callee> in <file_name>, first at line, col
+#
+#   calledby%%%<callee>%%%<caller>%%%<file_name> => <line> <col>
+#      the same edge, for the callers of a function
+#
+#   cg%%%<file_name>%%%<caller>%%%<callee> => 1
+#      <file_name> has a calls%%% edge. used to delete the edges when we reparse file
+#
+#   bases%%%<derived>%%%<base>%%%<file_name> => <line> <col>
+#      class <derived> names class <base> (the template, for a specialization) in a base specifier
+#
+#   derived%%%<base>%%%<derived>%%%<file_name> => <line> <col>
+#      the same edge, for the subtypes of a class
+#
+#   th%%%<file_name>%%%<derived>%%%<base> => 1
+#      <file_name> has a bases%%% edge. used to delete the edges when we reparse file
+#
 #   F%%%<file_name_without_path>%%%<full_file_path> => 1
 #      so that we can show files in Ctrl_K
 #
 #   h%%%<header_name> => <source_file_name>
 #      command line args we can use to compile any file
 #
+#   x%%%<file_name> => <failures> <next_retry> <mtime> <args_hash>\n<diagnostics>
+#      file failed to parse (failures > 0, retried with backoff) or parsed with errors (failures == 0)
+#
+#   slow%%%<file_name> => <times_over_budget> <seconds> <memory_mb> <mode> <reason> <mtime>
+#      file went over its time or memory budget, <mode> is how it is parsed next time (full or cheap)
+#      as long as its mtime is <mtime>
+#
+#   t%%%<file_name> => 1|2
+#      1 while only the declarations of the file are indexed (tiered_indexing), 2 once its references
+#      are too; files without an entry are fully indexed. files left at 1 get their reference pass
+#      queued again by Project.scan_and_index
+#
 # <symbol> is what get_usr for a cursor returns
 # <use_type> is a CursorKind.value. If the entry is also a definition, <use_type> is negative of that number
 #
@@ -103,32 +138,191 @@ def get_reference_kind(val):
         return ret
     return "other"
 
-def get_items_matching_pattern(conn, prefix, limit):
-    if prefix == "" or prefix == None:
-        return ["Search for a function, class, variable, or file name."], []
+EMPTY_PREFIX_MESSAGE = "Search for a function, class, variable, or file name."
 
-    ret = []
-    locations = []
+def format_file_item(full_path, ordinal):
+    return os.path.basename(full_path) + " (" + full_path + ") [" + str(ordinal) + "]"
 
-    ordinal = 0
+def format_symbol_item(name, use_type, full_path, ordinal):
+    return name + " - " + get_reference_kind(use_type) + " from " + full_path + " [" + str(ordinal) + "]"
 
+# yields (name, use_type, file_name, line, col); name and use_type are None for file entries
+def iter_items_matching_pattern(conn, prefix, limit):
     for key, value in leveldb_range_iter(conn, 'F%%%' + prefix.lower()):
         if limit > 0:
-            full_path = extract_part(key, 2)
-            ret.append(os.path.basename(full_path) + " (" + full_path + ") [" + str(ordinal) + "]")
-            locations.append([extract_part(key, 2), 1, 1])
-            ordinal += 1
+            yield None, None, extract_part(key, 2), 1, 1
             limit -= 1
         else:
             break
     for dbPrefix in ["ndef", "ndefsuf", "ndecl", "ndeclsuf"]:
         for key, value in leveldb_range_iter(conn, dbPrefix + '%%%' + prefix.lower()):
             if limit > 0:
-                ret.append(extract_part(key, 6) + " - " + get_reference_kind(int(value)) + " from " + (extract_part(key, 3)) + " [" + str(ordinal) + "]")
-                locations.append([extract_part(key, 3), int(extract_part(key, 4)), int(extract_part(key, 5))])
-                ordinal += 1
+                yield extract_part(key, 6), int(value), extract_part(key, 3), int(extract_part(key, 4)), int(extract_part(key, 5))
                 limit -= 1
             else:
                 break
 
+# returns (refs, defs, files) for a symbol, zeros if it has no aggregate
+def get_symbol_counts(conn, symbol):
+    try:
+        value = conn.Get('a%%%' + symbol)
+    except KeyError:
+        return 0, 0, 0
+    refs, defs, files = value.split(' ')
+    return int(refs), int(defs), int(files)
+
+# Like iter_items_matching_pattern, but the entries of each navigation prefix are ordered by how
+#    often their symbol is referenced (then by in how many files, then by key) instead of by key. The
+#    prefixes keep their order, so a definition still comes before any declaration.
+#
+# The counts do not follow the key order, so every entry of a prefix that items are taken from is
+#    ranked, and the items are the exact top ones. Returns (items, truncated), where truncated tells
+#    if more entries matched than limit.
+def rank_items_matching_pattern(conn, prefix, limit):
+    items = []
+    truncated = False
+    for key, value in leveldb_range_iter(conn, 'F%%%' + prefix.lower()):
+        if len(items) >= limit:
+            truncated = True
+            break
+        items.append((None, None, extract_part(key, 2), 1, 1))
+
+    counts = {}
+    for dbPrefix in ["ndef", "ndefsuf", "ndecl", "ndeclsuf"]:
+        if truncated:
+            break
+        entries = leveldb_range_iter(conn, dbPrefix + '%%%' + prefix.lower())
+        wanted = limit - len(items)
+        if wanted <= 0:
+            truncated = next(entries, None) is not None
+            continue
+
+        candidates = []
+        for key, value in entries:
+            symbol = extract_part(key, 2)
+            if symbol not in counts:
+                refs, defs, files = get_symbol_counts(conn, symbol)
+                counts[symbol] = (refs, files)
+            candidates.append((counts[symbol], key, value))
+
+        truncated = len(candidates) > wanted
+        # nlargest keeps equal counts in key order, like a stable sort would
+        for rank, key, value in heapq.nlargest(wanted, candidates, key=lambda candidate: candidate[0]):
+            items.append((extract_part(key, 6), int(value), extract_part(key, 3), int(extract_part(key, 4)), int(extract_part(key, 5))))
+
+    return items, truncated
+
+# ranked=True returns (ret, locations, truncated), see rank_items_matching_pattern
+def get_items_matching_pattern(conn, prefix, limit, ranked=False):
+    if prefix == "" or prefix == None:
+        if ranked:
+            return [EMPTY_PREFIX_MESSAGE], [], False
+        return [EMPTY_PREFIX_MESSAGE], []
+
+    ret = []
+    locations = []
+    if ranked:
+        items, truncated = rank_items_matching_pattern(conn, prefix, limit)
+    else:
+        items = iter_items_matching_pattern(conn, prefix, limit)
+
+    for ordinal, (name, use_type, file_name, line, col) in enumerate(items):
+        if name is None:
+            ret.append(format_file_item(file_name, ordinal))
+        else:
+            ret.append(format_symbol_item(name, use_type, file_name, ordinal))
+        locations.append([file_name, line, col])
+
+    if ranked:
+        return ret, locations, truncated
     return ret, locations
+
+# Columnar form of get_items_matching_pattern: every path is sent once in `paths`, and the
+#    display strings are rebuilt by the client with format_file_item/format_symbol_item. Ranked
+#    results also have `truncated`.
+def get_items_matching_pattern_compact(conn, prefix, limit, ranked=False):
+    if prefix == "" or prefix == None:
+        if ranked:
+            return {'message': EMPTY_PREFIX_MESSAGE, 'truncated': False}
+        return {'message': EMPTY_PREFIX_MESSAGE}
+
+    path_ids = {}
+    ret = {'paths': [], 'names': [], 'use_types': [], 'path_ids': [], 'lines': [], 'cols': []}
+    if ranked:
+        items, ret['truncated'] = rank_items_matching_pattern(conn, prefix, limit)
+    else:
+        items = iter_items_matching_pattern(conn, prefix, limit)
+
+    for name, use_type, file_name, line, col in items:
+        if file_name not in path_ids:
+            path_ids[file_name] = len(ret['paths'])
+            ret['paths'].append(file_name)
+        ret['names'].append(name)
+        ret['use_types'].append(use_type)
+        ret['path_ids'].append(path_ids[file_name])
+        ret['lines'].append(line)
+        ret['cols'].append(col)
+
+    return ret
+
+DEFAULT_GRAPH_DEPTH = 1
+DEFAULT_GRAPH_LIMIT = 100
+
+# Breadth first walk of the edges stored under <edge_prefix>%%%<from>%%%<to>%%%<file_name>, starting
+#    at symbol and going at most depth edges away. Every edge is returned once per file it is in,
+#    and every symbol is expanded once, so cycles end the walk. Stops after limit edges.
+def walk_graph(conn, edge_prefix, symbol, depth=DEFAULT_GRAPH_DEPTH, limit=DEFAULT_GRAPH_LIMIT):
+    edges = []
+    spellings = {}
+    expanded = set([symbol])
+    level = [symbol]
+    truncated = False
+
+    for distance in xrange(1, depth + 1):
+        next_level = []
+        for source in level:
+            for key, value in leveldb_range_iter(conn, edge_prefix + '%%%' + source + '%%%'):
+                if len(edges) >= limit:
+                    truncated = True
+                    break
+                target, file_name = extract_part(key, 2), extract_part(key, 3)
+                line, col = value.split(' ')
+                edges.append({'from': source, 'to': target, 'depth': distance,
+                              'file': file_name, 'line': int(line), 'col': int(col)})
+                if target not in expanded:
+                    expanded.add(target)
+                    next_level.append(target)
+            if truncated:
+                break
+        if truncated or not next_level:
+            break
+        level = next_level
+
+    for name in expanded:
+        try:
+            spellings[name] = conn.Get('spelling%%%' + name)
+        except KeyError:
+            pass
+
+    return {'symbol': symbol, 'edges': edges, 'spellings': spellings, 'truncated': truncated}
+
+# the functions that symbol calls, and what they call in turn up to depth
+def get_callees(conn, symbol, depth=DEFAULT_GRAPH_DEPTH, limit=DEFAULT_GRAPH_LIMIT):
+    return walk_graph(conn, 'calls', symbol, depth, limit)
+
+# the functions that call symbol, and their callers in turn up to depth
+def get_callers(conn, symbol, depth=DEFAULT_GRAPH_DEPTH, limit=DEFAULT_GRAPH_LIMIT):
+    return walk_graph(conn, 'calledby', symbol, depth, limit)
+
+# the classes that derive from symbol, and the ones that derive from them in turn up to depth
+def get_subtypes(conn, symbol, depth=DEFAULT_GRAPH_DEPTH, limit=DEFAULT_GRAPH_LIMIT):
+    return walk_graph(conn, 'derived', symbol, depth, limit)
+
+# the bases of symbol, and their bases in turn up to depth
+def get_supertypes(conn, symbol, depth=DEFAULT_GRAPH_DEPTH, limit=DEFAULT_GRAPH_LIMIT):
+    return walk_graph(conn, 'bases', symbol, depth, limit)
+
+def leveldb_search_compact(conn, starts_with):
+    items = [x for x in leveldb_range_iter(conn, starts_with)]
+    prefix = starts_with if all(key.startswith(starts_with) for key, value in items) else ''
+    return {'prefix': prefix, 'keys': [key[len(prefix):] for key, value in items], 'values': [value for key, value in items]}
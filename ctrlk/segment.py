@@ -0,0 +1,243 @@
+import bisect
+import mmap
+import os
+import struct
+import time
+
+from ctrlk import indexer
+from ctrlk import search
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# Immutable, memory mapped, sorted segments that hold the read-mostly part of the index (file list,
+# navigation names and reference postings), with LevelDB as a small delta on top of them.
+#
+# A segment file is
+#
+#   MAGIC
+#   <key length> <value length> <key> <value>, for every entry in key order
+#   <offset>, for every INDEX_INTERVAL-th entry
+#   <meta json>
+#   <index offset> <index count> <meta offset> <meta length> <entry count> MAGIC
+#
+# Lookups bisect the sparse index, which is read once when the segment is opened, and then scan
+# at most INDEX_INTERVAL entries straight out of the mapping, without decompressing any blocks.
+# Every key and value that is read is still copied out of the mapping into a str, since callers
+# compare and split them like the strs LevelDB returns.
+#
+# The meta block holds the f%%% stamp of every file at the time the segment was written. The f%%%
+# entries stay in LevelDB, so once a file is reindexed its stamp in LevelDB no longer matches the
+# one in the segment, and its frozen entries are ignored in favor of the ones in the delta.
+
+MAGIC = 'CTRLK-SEGMENT-1\n'
+ENTRY_HEADER = struct.Struct('>II')
+INDEX_ENTRY = struct.Struct('>Q')
+FOOTER = struct.Struct('>QIQII')
+
+INDEX_INTERVAL = 64
+
+WRITE_BATCH_SIZE = 10000
+
+# prefix => ordinal of the %%%-separated part that holds the file name
+FROZEN_PREFIXES = {
+    'F%%%': 2,
+    's%%%': 2,
+    'ndef%%%': 3,
+    'ndecl%%%': 3,
+    'ndefsuf%%%': 3,
+    'ndeclsuf%%%': 3,
+}
+
+def prefix_range(prefix):
+    return prefix, prefix[:-1] + '^'
+
+def frozen_file_name(key):
+    ordinal = FROZEN_PREFIXES.get(key[:key.find('%%%') + 3])
+    if ordinal is None:
+        return None
+    return search.extract_part(key, ordinal)
+
+def write_segment(path, items, stamps):
+    offsets = []
+    count = 0
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        position = len(MAGIC)
+        for key, value in items:
+            if count % INDEX_INTERVAL == 0:
+                offsets.append(position)
+            f.write(ENTRY_HEADER.pack(len(key), len(value)))
+            f.write(key)
+            f.write(value)
+            position += ENTRY_HEADER.size + len(key) + len(value)
+            count += 1
+
+        index_offset = position
+        for offset in offsets:
+            f.write(INDEX_ENTRY.pack(offset))
+        position += INDEX_ENTRY.size * len(offsets)
+
+        meta = json.dumps({'stamps': stamps, 'created': time.time()})
+        f.write(meta)
+        f.write(FOOTER.pack(index_offset, len(offsets), position, len(meta), count))
+        f.write(MAGIC)
+    return count
+
+class Segment(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        end = len(self.mm) - len(MAGIC)
+        if self.mm[:len(MAGIC)] != MAGIC or self.mm[end:] != MAGIC:
+            raise Exception("%s is not a ctrlk segment" % path)
+        index_offset, index_count, meta_offset, meta_length, self.count = \
+                FOOTER.unpack_from(self.mm, end - FOOTER.size)
+        self.data_end = index_offset
+
+        self.offsets = [INDEX_ENTRY.unpack_from(self.mm, index_offset + i * INDEX_ENTRY.size)[0]
+                        for i in range(index_count)]
+        self.index_keys = [self.read_entry(offset)[0] for offset in self.offsets]
+        self.stamps = json.loads(self.mm[meta_offset:meta_offset + meta_length])['stamps']
+
+    # returns (key, value offset, value length, next entry offset)
+    def read_entry(self, offset):
+        key_length, value_length = ENTRY_HEADER.unpack_from(self.mm, offset)
+        key_start = offset + ENTRY_HEADER.size
+        value_start = key_start + key_length
+        return self.mm[key_start:value_start], value_start, value_length, value_start + value_length
+
+    def seek(self, key):
+        i = bisect.bisect_right(self.index_keys, key) - 1
+        if i < 0:
+            return len(MAGIC)
+        return self.offsets[i]
+
+    # (key, value) for key_from <= key <= key_to, in key order; None means unbounded
+    def iter_range(self, key_from=None, key_to=None):
+        offset = len(MAGIC) if key_from is None else self.seek(key_from)
+        while offset < self.data_end:
+            key, value_start, value_length, offset = self.read_entry(offset)
+            if key_from is not None and key < key_from:
+                continue
+            if key_to is not None and key > key_to:
+                break
+            yield key, self.mm[value_start:value_start + value_length]
+
+    def get(self, key):
+        for found_key, value in self.iter_range(key, key):
+            return value
+        return None
+
+# Reads like a LevelDB connection (RangeIter, Get), merging a segment with the LevelDB delta.
+# RangeIter takes the same arguments, in the same order, as leveldb.LevelDB.RangeIter.
+class LayeredIndex(object):
+    def __init__(self, conn, segment):
+        self.conn = conn
+        self.segment = segment
+
+    def is_dirty(self, key, memo):
+        file_name = frozen_file_name(key)
+        if file_name is None:
+            return False
+        if file_name not in memo:
+            try:
+                stamp = self.conn.Get('f%%%' + file_name)
+            except KeyError:
+                stamp = None
+            memo[file_name] = stamp != self.segment.stamps.get(file_name)
+        return memo[file_name]
+
+    def RangeIter(self, key_from=None, key_to=None, verify_checksums=False, fill_cache=True,
+                  include_value=True, reverse=False):
+        if reverse:
+            raise Exception("LayeredIndex does not iterate in reverse")
+        memo = {}
+        frozen = ((key, value) for key, value in self.segment.iter_range(key_from, key_to)
+                  if not self.is_dirty(key, memo))
+        delta = self.conn.RangeIter(key_from, key_to, verify_checksums=verify_checksums,
+                                    fill_cache=fill_cache, include_value=True)
+
+        for key, value in merge(delta, frozen):
+            yield (key, value) if include_value else key
+
+    def Get(self, key):
+        try:
+            return self.conn.Get(key)
+        except KeyError:
+            pass
+        value = self.segment.get(key)
+        if value is None or self.is_dirty(key, {}):
+            raise KeyError(key)
+        return value
+
+# merges two sorted (key, value) iterators, the first one wins on equal keys
+def merge(first, second):
+    first = iter(first)
+    second = iter(second)
+    a = next(first, None)
+    b = next(second, None)
+    while a is not None and b is not None:
+        if a[0] < b[0]:
+            yield a
+            a = next(first, None)
+        elif b[0] < a[0]:
+            yield b
+            b = next(second, None)
+        else:
+            yield a
+            a = next(first, None)
+            b = next(second, None)
+    while a is not None:
+        yield a
+        a = next(first, None)
+    while b is not None:
+        yield b
+        b = next(second, None)
+
+# Writes everything under FROZEN_PREFIXES, from the old segment and LevelDB, into a new segment
+#    at path, and deletes the frozen entries from LevelDB. Returns the new segment. Nothing may write
+#    to the index while this runs (Project.freeze_index pauses the indexer), the stamp check below
+#    only keeps the entries of files that were restamped since the snapshot.
+def freeze(conn, path, old_segment=None):
+    snapshot = conn.CreateSnapshot()
+    view = LayeredIndex(snapshot, old_segment) if old_segment is not None else snapshot
+    stamps = dict((search.extract_part(key, 1), value) for key, value in search.leveldb_range_iter(snapshot, 'f%%%'))
+
+    def frozen_items():
+        for prefix in sorted(FROZEN_PREFIXES):
+            key_from, key_to = prefix_range(prefix)
+            for key, value in view.RangeIter(key_from, key_to, include_value=True):
+                yield key, value
+
+    tmp_path = path + '.%d' % os.getpid()
+    write_segment(tmp_path, frozen_items(), stamps)
+    os.rename(tmp_path, path)
+    segment = Segment(path)
+
+    memo = {}
+    pending = 0
+    batch = indexer.WriteBatch()
+    for prefix in sorted(FROZEN_PREFIXES):
+        key_from, key_to = prefix_range(prefix)
+        for key in snapshot.RangeIter(key_from, key_to, include_value=False):
+            file_name = frozen_file_name(key)
+            if file_name not in memo:
+                try:
+                    memo[file_name] = conn.Get('f%%%' + file_name) == stamps.get(file_name)
+                except KeyError:
+                    memo[file_name] = False
+            if not memo[file_name]:
+                continue
+            batch.Delete(key)
+            pending += 1
+            if pending % WRITE_BATCH_SIZE == 0:
+                conn.Write(batch)
+                batch = indexer.WriteBatch()
+    conn.Write(batch)
+
+    return segment
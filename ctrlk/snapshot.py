@@ -0,0 +1,249 @@
+import argparse
+import gzip
+import hashlib
+import os
+import shutil
+import struct
+import sys
+import time
+
+from ctrlk import indexer
+from ctrlk import project
+from ctrlk import search
+from ctrlk import segment
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# Relocatable snapshots of .ctrlk-index, so that an index built in CI can be used on a machine
+# where the project lives somewhere else.
+#
+#   python -m ctrlk.snapshot export [project_root] index.snapshot
+#   python -m ctrlk.snapshot import [project_root] index.snapshot
+#
+# Every %%%-separated part of a key or value that is a path inside the project root is stored as
+# ROOT_MARKER followed by the path relative to the root, and rebased on import. Paths outside of
+# the root (system headers) are kept as they are. The indexer stores the headers under their
+# realpath, so the root is resolved with os.path.realpath on both ends; paths under the root as
+# it was given are made relative too.
+#
+# The snapshot is gzip compressed, and the uncompressed stream is
+#
+#   MAGIC
+#   <record: header json>
+#   <record: key> <record: value>, for every entry
+#   <record: empty>
+#   sha256 of everything above
+#
+# where a record is a 4 byte big endian length followed by that many bytes. The header holds the
+# sha256 of the content of every indexed file at export time. On import, the f%%% entry of a file
+# whose local content matches is stamped with the local mtime, the rest are stamped with 0, so
+# that the indexer only reparses what differs locally.
+
+MAGIC = 'CTRLK-SNAPSHOT-1\n'
+ROOT_MARKER = '$ROOT'
+
+WRITE_BATCH_SIZE = 10000
+
+class SnapshotError(Exception):
+    pass
+
+# roots are the forms of the project root that paths may start with
+def to_relative(part, roots):
+    for root in roots:
+        if part == root:
+            return ROOT_MARKER
+        if part.startswith(root + '/'):
+            return ROOT_MARKER + part[len(root):]
+    return part
+
+def from_relative(part, root):
+    if part.startswith(ROOT_MARKER):
+        return root + part[len(ROOT_MARKER):]
+    return part
+
+def rewrite_parts(s, fn, root):
+    if '/' not in s and ROOT_MARKER not in s:
+        return s
+    return '%%%'.join(fn(part, root) for part in s.split('%%%'))
+
+def file_hash(file_name):
+    h = hashlib.sha256()
+    try:
+        with open(file_name, 'rb') as f:
+            while True:
+                chunk = f.read(1 << 16)
+                if not chunk:
+                    break
+                h.update(chunk)
+    except IOError:
+        return None
+    return h.hexdigest()
+
+class RecordWriter(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.checksum = hashlib.sha256()
+
+    def write_raw(self, data):
+        self.stream.write(data)
+        self.checksum.update(data)
+
+    def write(self, data):
+        self.write_raw(struct.pack('>I', len(data)))
+        self.write_raw(data)
+
+    def finish(self):
+        self.stream.write(self.checksum.digest())
+
+class RecordReader(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.checksum = hashlib.sha256()
+
+    def read_raw(self, n):
+        data = self.stream.read(n)
+        if len(data) != n:
+            raise SnapshotError("snapshot is truncated")
+        self.checksum.update(data)
+        return data
+
+    def read(self):
+        length, = struct.unpack('>I', self.read_raw(4))
+        return self.read_raw(length)
+
+    def finish(self):
+        expected = self.checksum.digest()
+        if self.stream.read(len(expected)) != expected:
+            raise SnapshotError("snapshot checksum does not match")
+
+def export_snapshot(project_root, output_path):
+    given_root = project.find_project_root(project_root)
+    root = os.path.realpath(given_root)
+    roots = (root, given_root) if given_root != root else (root,)
+    conn = indexer.LevelDB(project.get_index_db_path(root), create_if_missing=False)
+    segment_path = project.get_segment_path(root)
+    if os.path.exists(segment_path):
+        conn = segment.LayeredIndex(conn, segment.Segment(segment_path))
+
+    hashes = {}
+    for key, value in search.leveldb_range_iter(conn, 'f%%%'):
+        file_name = search.extract_part(key, 1)
+        hashes[to_relative(file_name, roots)] = file_hash(file_name)
+
+    header = {'root': root, 'created': time.time(), 'hashes': hashes}
+
+    entries = 0
+    with gzip.open(output_path, 'wb') as f:
+        writer = RecordWriter(f)
+        writer.write_raw(MAGIC)
+        writer.write(json.dumps(header))
+        for key, value in conn.RangeIter(None, None, True):
+            writer.write(rewrite_parts(key, to_relative, roots))
+            writer.write(rewrite_parts(value, to_relative, roots))
+            entries += 1
+        writer.write('')
+        writer.finish()
+
+    return {'root': root, 'entries': entries, 'files': len(hashes)}
+
+# stamps the files that are the same locally as indexed, so that only the rest is reparsed
+def freshness_stamp(file_name, exported_hash):
+    try:
+        mod_time = project.get_file_modtime(file_name)
+    except OSError:
+        return '0', False
+    if exported_hash is None or file_hash(file_name) != exported_hash:
+        return '0', False
+    return str(mod_time), True
+
+# The snapshot is loaded into a new database next to the index and only moved in place once the
+#    checksum is verified, so a corrupt snapshot never replaces a working index. Nothing may have
+#    the index open while it is imported.
+def import_snapshot(project_root, input_path):
+    root = os.path.realpath(project.find_project_root(project_root))
+    index_db_path = project.get_index_db_path(root)
+    import_db_path = index_db_path + '.import'
+    if os.path.exists(import_db_path):
+        shutil.rmtree(import_db_path)
+
+    entries = 0
+    up_to_date = 0
+    stale = 0
+    try:
+        conn = indexer.LevelDB(import_db_path, error_if_exists=True)
+        with gzip.open(input_path, 'rb') as f:
+            reader = RecordReader(f)
+            if reader.read_raw(len(MAGIC)) != MAGIC:
+                raise SnapshotError("%s is not a ctrlk snapshot" % input_path)
+            header = json.loads(reader.read())
+            hashes = header['hashes']
+
+            batch = indexer.WriteBatch()
+            while True:
+                key = reader.read()
+                if not key:
+                    break
+                value = reader.read()
+
+                if key.startswith('f%%%'):
+                    exported_hash = hashes.get(search.extract_part(key, 1))
+                    key = rewrite_parts(key, from_relative, root)
+                    value, fresh = freshness_stamp(search.extract_part(key, 1), exported_hash)
+                    if fresh:
+                        up_to_date += 1
+                    else:
+                        stale += 1
+                else:
+                    key = rewrite_parts(key, from_relative, root)
+                    value = rewrite_parts(value, from_relative, root)
+
+                batch.Put(key, value)
+                entries += 1
+                if entries % WRITE_BATCH_SIZE == 0:
+                    conn.Write(batch)
+                    batch = indexer.WriteBatch()
+            conn.Write(batch)
+            reader.finish()
+        del conn
+    except:
+        shutil.rmtree(import_db_path, ignore_errors=True)
+        raise
+
+    if os.path.exists(index_db_path):
+        indexer.DestroyDB(index_db_path)
+        shutil.rmtree(index_db_path, ignore_errors=True)
+    os.rename(import_db_path, index_db_path)
+    # the snapshot has the frozen entries too, the old segment only holds stale copies of them
+    if os.path.exists(project.get_segment_path(root)):
+        os.remove(project.get_segment_path(root))
+
+    return {'root': root, 'exported_root': header['root'], 'entries': entries,
+            'files_up_to_date': up_to_date, 'files_to_reindex': stale}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ctrlk.snapshot')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('project_root', nargs='?', default=os.getcwd(),
+                        help='any directory at or below the one with compile_commands.json')
+    parser.add_argument('snapshot', help='snapshot file to write or read')
+    options = parser.parse_args(argv)
+
+    start = time.time()
+    try:
+        if options.command == 'export':
+            result = export_snapshot(options.project_root, options.snapshot)
+        else:
+            result = import_snapshot(options.project_root, options.snapshot)
+    except SnapshotError as e:
+        print >>sys.stderr, "ctrlk: %s" % e
+        return 1
+
+    result['seconds'] = time.time() - start
+    print json.dumps(result, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
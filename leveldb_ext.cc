@@ -16,6 +16,16 @@ static PyMethodDef leveldb_extension_methods[] =
     {"extract_part", extract_part, METH_VARARGS, "Fill in."},
     {"remove_file_symbols", remove_file_symbols, METH_VARARGS, "Fill in."},
     {"work_queue_size", work_queue_size, METH_VARARGS, "Fill in."},
+    {"stats", stats, METH_VARARGS, "Fill in."},
+    {"wait_for_events", wait_for_events, METH_VARARGS, "Fill in."},
+    {"clear_queue", clear_queue, METH_VARARGS, "Fill in."},
+    {"pause_queue", pause_queue, METH_VARARGS, "Fill in."},
+    {"set_option", set_option, METH_VARARGS, "Fill in."},
+    {"set_scope_rules", set_scope_rules, METH_VARARGS, "Fill in."},
+    {"scope_stats", scope_stats, METH_VARARGS, "Fill in."},
+    {"set_pool_option", set_pool_option, METH_VARARGS, "Fill in."},
+    {"pool_stats", pool_stats, METH_VARARGS, "Fill in."},
+    {"deleted_keys", deleted_keys, METH_VARARGS, "Fill in."},
 	{NULL, NULL},
 };
 
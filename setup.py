@@ -113,7 +113,7 @@ setup(
 	description = 'C++ source code indexer',
 
     #py_modules = ['tornado', 'request', 'python-dev'],
-    install_requires = ['tornado', 'requests', 'ez_setup'],
+    install_requires = ['tornado', 'requests', 'ez_setup'] + (['futures'] if sys.version_info[0] < 3 else []),
 	packages = ['ctrlk'],
 	#package_dir = {'leveldb': ''},
 
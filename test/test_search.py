@@ -0,0 +1,198 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ctrlk import indexer
+from ctrlk import search
+
+class IndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='ctrlk-search-')
+        self.conn = indexer.LevelDB(os.path.join(self.dir, 'index'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+class TestRankedMatches(IndexTestCase):
+    def define(self, name, refs, files=1, nav_prefix='ndef', line=1):
+        symbol = 'c:@F@' + name
+        self.conn.Put('%s%%%%%%%s%%%%%%%s%%%%%%a.cpp%%%%%%%d%%%%%%1%%%%%%%s' % (nav_prefix, name.lower(), symbol, line, name), '-8')
+        if refs is not None:
+            self.conn.Put('a%%%' + symbol, '%d 1 %d' % (refs, files))
+
+    def names(self, items):
+        return [name for name, use_type, file_name, line, col in items]
+
+    def testMostReferencedSymbolComesFirstWhereverItSorts(self):
+        for i in range(200):
+            self.define('foo%03d' % i, 1)
+        self.define('foozzz', 1000)
+
+        items, truncated = search.rank_items_matching_pattern(self.conn, 'foo', 1)
+        self.assertEqual(self.names(items), ['foozzz'])
+        self.assertTrue(truncated)
+
+    def testTiesGoByFilesThenByKey(self):
+        self.define('foo_a', 5, files=1)
+        self.define('foo_b', 5, files=3)
+        self.define('foo_c', 5, files=1)
+        self.define('foo_d', None)
+
+        items, truncated = search.rank_items_matching_pattern(self.conn, 'foo', 10)
+        self.assertEqual(self.names(items), ['foo_b', 'foo_a', 'foo_c', 'foo_d'])
+        self.assertFalse(truncated)
+
+    def testFilesAndDefinitionsComeBeforeDeclarations(self):
+        self.conn.Put('F%%%foo.h%%%/src/foo.h', '1')
+        self.define('foo_decl', 100, nav_prefix='ndecl')
+        self.define('foo_def', 1)
+
+        items, truncated = search.rank_items_matching_pattern(self.conn, 'foo', 10)
+        self.assertEqual([(name, file_name) for name, use_type, file_name, line, col in items],
+                         [(None, '/src/foo.h'), ('foo_def', 'a.cpp'), ('foo_decl', 'a.cpp')])
+        self.assertFalse(truncated)
+
+    def testTruncatedWhenALaterPrefixIsLeftOut(self):
+        self.define('foo_def', 1)
+        self.define('foo_decl', 1, nav_prefix='ndecl')
+
+        items, truncated = search.rank_items_matching_pattern(self.conn, 'foo', 1)
+        self.assertEqual(self.names(items), ['foo_def'])
+        self.assertTrue(truncated)
+
+    def testTruncatedWhenFilesFillTheLimit(self):
+        self.conn.Put('F%%%foo.h%%%/src/foo.h', '1')
+        self.conn.Put('F%%%foo.h%%%/src/other/foo.h', '1')
+
+        items, truncated = search.rank_items_matching_pattern(self.conn, 'foo', 1)
+        self.assertEqual([file_name for name, use_type, file_name, line, col in items], ['/src/foo.h'])
+        self.assertTrue(truncated)
+
+    def testResponsesCarryTruncated(self):
+        self.define('foo_a', 1)
+        self.define('foo_b', 2)
+
+        ret, locations, truncated = search.get_items_matching_pattern(self.conn, 'foo', 1, ranked=True)
+        self.assertEqual(ret, [search.format_symbol_item('foo_b', -8, 'a.cpp', 0)])
+        self.assertEqual(locations, [['a.cpp', 1, 1]])
+        self.assertTrue(truncated)
+
+        compact = search.get_items_matching_pattern_compact(self.conn, 'foo', 2, ranked=True)
+        self.assertFalse(compact['truncated'])
+        self.assertNotIn('truncated', search.get_items_matching_pattern_compact(self.conn, 'foo', 2))
+
+        self.assertEqual(search.get_items_matching_pattern(self.conn, '', 1, ranked=True),
+                         ([search.EMPTY_PREFIX_MESSAGE], [], False))
+
+class TestSymbolCounts(IndexTestCase):
+    def testReadsTheAggregate(self):
+        self.conn.Put('a%%%c:@F@foo', '12 2 3')
+        self.assertEqual(search.get_symbol_counts(self.conn, 'c:@F@foo'), (12, 2, 3))
+
+    def testZerosWithoutAnAggregate(self):
+        self.assertEqual(search.get_symbol_counts(self.conn, 'c:@F@missing'), (0, 0, 0))
+
+class TestCallGraph(IndexTestCase):
+    def call(self, caller, callee, file_name='a.cpp', line=1):
+        self.conn.Put('calls%%%' + caller + '%%%' + callee + '%%%' + file_name, '%d 5' % line)
+        self.conn.Put('calledby%%%' + callee + '%%%' + caller + '%%%' + file_name, '%d 5' % line)
+
+    def edges(self, graph):
+        return [(edge['from'], edge['to'], edge['depth'], edge['file']) for edge in graph['edges']]
+
+    def testDirectCallees(self):
+        self.call('main', 'parse', line=3)
+        self.call('main', 'run', line=4)
+        self.call('parse', 'lex')
+        self.call('mainloop', 'spin')
+        self.conn.Put('spelling%%%parse', 'parse')
+
+        graph = search.get_callees(self.conn, 'main')
+        self.assertEqual(self.edges(graph), [('main', 'parse', 1, 'a.cpp'), ('main', 'run', 1, 'a.cpp')])
+        self.assertEqual(graph['edges'][0]['line'], 3)
+        self.assertEqual(graph['edges'][0]['col'], 5)
+        self.assertEqual(graph['spellings'], {'parse': 'parse'})
+        self.assertFalse(graph['truncated'])
+
+    def testDepthLimitsTheWalk(self):
+        self.call('main', 'parse')
+        self.call('parse', 'lex')
+        self.call('lex', 'read')
+
+        self.assertEqual(self.edges(search.get_callees(self.conn, 'main', depth=2)),
+                         [('main', 'parse', 1, 'a.cpp'), ('parse', 'lex', 2, 'a.cpp')])
+        self.assertEqual(self.edges(search.get_callers(self.conn, 'read', depth=3)),
+                         [('read', 'lex', 1, 'a.cpp'), ('lex', 'parse', 2, 'a.cpp'), ('parse', 'main', 3, 'a.cpp')])
+
+    def testCycleEndsTheWalk(self):
+        self.call('even', 'odd')
+        self.call('odd', 'even')
+        self.call('even', 'even')
+
+        self.assertEqual(self.edges(search.get_callees(self.conn, 'even', depth=10)),
+                         [('even', 'even', 1, 'a.cpp'), ('even', 'odd', 1, 'a.cpp'), ('odd', 'even', 2, 'a.cpp')])
+
+    def testEdgeIsReturnedOncePerFile(self):
+        self.call('main', 'parse', file_name='a.cpp')
+        self.call('main', 'parse', file_name='b.cpp')
+        self.call('parse', 'lex')
+
+        self.assertEqual(self.edges(search.get_callees(self.conn, 'main', depth=2)),
+                         [('main', 'parse', 1, 'a.cpp'), ('main', 'parse', 1, 'b.cpp'), ('parse', 'lex', 2, 'a.cpp')])
+
+    def testLimitCutsTheWalk(self):
+        self.call('main', 'a')
+        self.call('main', 'b')
+        self.call('a', 'c')
+
+        graph = search.get_callees(self.conn, 'main', depth=2, limit=2)
+        self.assertEqual(self.edges(graph), [('main', 'a', 1, 'a.cpp'), ('main', 'b', 1, 'a.cpp')])
+        self.assertTrue(graph['truncated'])
+
+        graph = search.get_callees(self.conn, 'main', depth=2, limit=3)
+        self.assertEqual(len(graph['edges']), 3)
+        self.assertFalse(graph['truncated'])
+
+class TestTypeHierarchy(IndexTestCase):
+    def derive(self, derived, base, file_name='a.h'):
+        self.conn.Put('bases%%%' + derived + '%%%' + base + '%%%' + file_name, '1 7')
+        self.conn.Put('derived%%%' + base + '%%%' + derived + '%%%' + file_name, '1 7')
+
+    def edges(self, graph):
+        return [(edge['from'], edge['to'], edge['depth'], edge['file']) for edge in graph['edges']]
+
+    def testSubtypesAndSupertypes(self):
+        self.derive('Circle', 'Shape')
+        self.derive('Square', 'Shape')
+        self.derive('Unit', 'Circle')
+
+        self.assertEqual(self.edges(search.get_subtypes(self.conn, 'Shape')),
+                         [('Shape', 'Circle', 1, 'a.h'), ('Shape', 'Square', 1, 'a.h')])
+        self.assertEqual(self.edges(search.get_supertypes(self.conn, 'Unit', depth=2)),
+                         [('Unit', 'Circle', 1, 'a.h'), ('Circle', 'Shape', 2, 'a.h')])
+
+    def testDiamondExpandsTheSharedBaseOnce(self):
+        self.derive('Left', 'Root')
+        self.derive('Right', 'Root')
+        self.derive('Bottom', 'Left')
+        self.derive('Bottom', 'Right')
+        self.derive('Root', 'Object')
+
+        self.assertEqual(self.edges(search.get_supertypes(self.conn, 'Bottom', depth=3)),
+                         [('Bottom', 'Left', 1, 'a.h'), ('Bottom', 'Right', 1, 'a.h'),
+                          ('Left', 'Root', 2, 'a.h'), ('Right', 'Root', 2, 'a.h'),
+                          ('Root', 'Object', 3, 'a.h')])
+
+    def testSpecializationsInSeveralFiles(self):
+        self.derive('Impl', 'Base<T>', file_name='a.h')
+        self.derive('Impl', 'Base<T>', file_name='b.h')
+
+        graph = search.get_supertypes(self.conn, 'Impl', limit=1)
+        self.assertEqual(self.edges(graph), [('Impl', 'Base<T>', 1, 'a.h')])
+        self.assertTrue(graph['truncated'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ctrlk import indexer
+from ctrlk import segment
+
+class TestSegment(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='ctrlk-segment-')
+        self.path = os.path.join(self.dir, 'segment')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, items, stamps=None):
+        segment.write_segment(self.path, items, stamps or {})
+        return segment.Segment(self.path)
+
+    def testRoundTrip(self):
+        items = [('s%%%sym' + '%03d' % i + '%%%a.cpp%%%1%%%1', str(i)) for i in range(segment.INDEX_INTERVAL * 3 + 5)]
+        seg = self.write(items, {'a.cpp': '10'})
+
+        self.assertEqual(seg.count, len(items))
+        self.assertEqual(seg.stamps, {'a.cpp': '10'})
+        self.assertEqual(list(seg.iter_range()), items)
+        for key, value in items:
+            self.assertEqual(seg.get(key), value)
+        self.assertIsNone(seg.get('s%%%missing'))
+
+    def testRangeBoundsAreInclusive(self):
+        items = [(key, key.upper()) for key in ['a', 'b', 'c', 'd', 'e']]
+        seg = self.write(items)
+
+        self.assertEqual([key for key, value in seg.iter_range('b', 'd')], ['b', 'c', 'd'])
+        self.assertEqual([key for key, value in seg.iter_range('bb', None)], ['c', 'd', 'e'])
+        self.assertEqual([key for key, value in seg.iter_range(None, 'a')], ['a'])
+        self.assertEqual(list(seg.iter_range('f', None)), [])
+
+    def testEmptySegment(self):
+        seg = self.write([])
+        self.assertEqual(seg.count, 0)
+        self.assertEqual(list(seg.iter_range()), [])
+        self.assertIsNone(seg.get('a'))
+
+    def testRejectsOtherFiles(self):
+        with open(self.path, 'wb') as f:
+            f.write('not a segment' * 10)
+        self.assertRaises(Exception, segment.Segment, self.path)
+
+class TestMerge(unittest.TestCase):
+    def testInterleaves(self):
+        first = [('a', 1), ('c', 1), ('e', 1)]
+        second = [('b', 2), ('d', 2), ('f', 2), ('g', 2)]
+        self.assertEqual([key for key, value in segment.merge(first, second)], list('abcdefg'))
+
+    def testFirstWinsOnEqualKeys(self):
+        first = [('a', 1), ('b', 1)]
+        second = [('a', 2), ('b', 2), ('c', 2)]
+        self.assertEqual(list(segment.merge(first, second)), [('a', 1), ('b', 1), ('c', 2)])
+
+    def testEmptySides(self):
+        self.assertEqual(list(segment.merge([], [('a', 2)])), [('a', 2)])
+        self.assertEqual(list(segment.merge([('a', 1)], [])), [('a', 1)])
+        self.assertEqual(list(segment.merge([], [])), [])
+
+class TestLayeredIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='ctrlk-segment-')
+        self.conn = indexer.LevelDB(os.path.join(self.dir, 'index'))
+        self.conn.Put('f%%%a.cpp', '10')
+        self.conn.Put('f%%%b.h', '20')
+        self.conn.Put('s%%%foo%%%a.cpp%%%1%%%1', '8')
+        self.conn.Put('s%%%foo%%%b.h%%%2%%%2', '-8')
+        self.conn.Put('F%%%b.h%%%b.h', '1')
+        self.conn.Put('h%%%b.h', 'a.cpp')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def freeze(self, old_segment=None):
+        return segment.freeze(self.conn, os.path.join(self.dir, 'segment'), old_segment)
+
+    def keys(self, conn, prefix):
+        return [key for key, value in conn.RangeIter(prefix, prefix[:-1] + '^', True)]
+
+    def testFreezeMovesFrozenPrefixes(self):
+        seg = self.freeze()
+        layered = segment.LayeredIndex(self.conn, seg)
+
+        self.assertEqual(self.keys(self.conn, 's%%%'), [])
+        self.assertEqual(self.keys(self.conn, 'F%%%'), [])
+        # stamps and other bookkeeping stay in LevelDB
+        self.assertEqual(self.conn.Get('f%%%a.cpp'), '10')
+        self.assertEqual(self.conn.Get('h%%%b.h'), 'a.cpp')
+
+        self.assertEqual(self.keys(layered, 's%%%'), ['s%%%foo%%%a.cpp%%%1%%%1', 's%%%foo%%%b.h%%%2%%%2'])
+        self.assertEqual(layered.Get('s%%%foo%%%b.h%%%2%%%2'), '-8')
+        self.assertEqual(seg.stamps, {'a.cpp': '10', 'b.h': '20'})
+
+    def testReindexedFileHidesFrozenEntries(self):
+        layered = segment.LayeredIndex(self.conn, self.freeze())
+
+        self.conn.Put('f%%%a.cpp', '11')
+        self.conn.Put('s%%%foo%%%a.cpp%%%5%%%1', '8')
+
+        self.assertEqual(self.keys(layered, 's%%%'), ['s%%%foo%%%a.cpp%%%5%%%1', 's%%%foo%%%b.h%%%2%%%2'])
+        self.assertRaises(KeyError, layered.Get, 's%%%foo%%%a.cpp%%%1%%%1')
+
+    def testDeltaWinsOverFrozenEntry(self):
+        layered = segment.LayeredIndex(self.conn, self.freeze())
+        self.conn.Put('s%%%foo%%%a.cpp%%%1%%%1', '-8')
+        self.assertEqual(layered.Get('s%%%foo%%%a.cpp%%%1%%%1'), '-8')
+
+    def testForgottenFileHidesFrozenEntries(self):
+        old_segment = self.freeze()
+        layered = segment.LayeredIndex(self.conn, old_segment)
+
+        # what Project.forget_file leaves behind for a deleted header
+        self.conn.Delete('f%%%b.h')
+        self.conn.Delete('h%%%b.h')
+
+        self.assertEqual(self.keys(layered, 's%%%'), ['s%%%foo%%%a.cpp%%%1%%%1'])
+        self.assertEqual(self.keys(layered, 'F%%%'), [])
+        self.assertRaises(KeyError, layered.Get, 's%%%foo%%%b.h%%%2%%%2')
+
+        # and they are not carried over into the next segment
+        new_segment = self.freeze(old_segment)
+        self.assertEqual([key for key, value in new_segment.iter_range()], ['s%%%foo%%%a.cpp%%%1%%%1'])
+        self.assertNotIn('b.h', new_segment.stamps)
+
+    def testRefreezeKeepsCleanEntries(self):
+        old_segment = self.freeze()
+        self.conn.Put('f%%%a.cpp', '11')
+        self.conn.Put('s%%%bar%%%a.cpp%%%3%%%3', '8')
+
+        new_segment = self.freeze(old_segment)
+        self.assertEqual([key for key, value in new_segment.iter_range()],
+                         ['F%%%b.h%%%b.h', 's%%%bar%%%a.cpp%%%3%%%3', 's%%%foo%%%b.h%%%2%%%2'])
+        self.assertEqual(self.keys(self.conn, 's%%%'), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+
+import json
+import time
+import unittest
+
+import tornado.testing
+
+from ctrlk import ctrlk_server
+
+HEAVY_QUERY_SECONDS = 1.0
+
+class SlowConnection(object):
+    def RangeIter(self, key_from=None, key_to=None, verify_checksums=False, fill_cache=True,
+                  include_value=True, reverse=False):
+        time.sleep(HEAVY_QUERY_SECONDS)
+        return iter([])
+
+class FakeProject(object):
+    leveldb_connection = SlowConnection()
+    query_connection = leveldb_connection
+
+    def get_current_scope_str(self, file_name, line):
+        return "ns::func"
+
+class TestServerConcurrency(tornado.testing.AsyncHTTPTestCase):
+    def setUp(self):
+        super(TestServerConcurrency, self).setUp()
+        ctrlk_server.g_projects['/fake'] = FakeProject()
+
+    def tearDown(self):
+        ctrlk_server.g_projects.pop('/fake', None)
+        super(TestServerConcurrency, self).tearDown()
+
+    def get_app(self):
+        return ctrlk_server.application
+
+    def timed_fetch(self, path):
+        start = time.time()
+        response = self.fetch(path)
+        self.assertEqual(response.code, 200)
+        return time.time() - start, response
+
+    def testLightRequestsStayFastUnderHeavyQueries(self):
+        idle_ping, _ = self.timed_fetch('/')
+        idle_scope, _ = self.timed_fetch('/get_current_scope_str?project_root=/fake&file_name=a.cpp&row=1')
+
+        heavy = [self.http_client.fetch(self.get_url('/match?project_root=/fake&prefix=foo&limit=10'))
+                 for i in range(ctrlk_server.DEFAULT_BULK_THREADS * 2)]
+
+        busy_ping, _ = self.timed_fetch('/')
+        busy_scope, response = self.timed_fetch('/get_current_scope_str?project_root=/fake&file_name=a.cpp&row=1')
+        self.assertEqual(json.loads(response.body), "ns::func")
+
+        # both would take at least one heavy query if they were queued behind /match
+        self.assertLess(busy_ping, idle_ping + HEAVY_QUERY_SECONDS / 2)
+        self.assertLess(busy_scope, idle_scope + HEAVY_QUERY_SECONDS / 2)
+
+        for future in heavy:
+            self.wait_for(future)
+
+    def wait_for(self, future):
+        self.io_loop.add_future(future, lambda f: self.stop())
+        self.wait(timeout=HEAVY_QUERY_SECONDS * 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ctrlk import indexer
+from ctrlk import project
+from ctrlk import snapshot
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = os.path.realpath(tempfile.mkdtemp(prefix='ctrlk-snapshot-'))
+        self.ci_root = self.make_root('ci')
+        self.local_root = self.make_root('local')
+        self.snapshot_path = os.path.join(self.dir, 'index.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # a project with two files, reached through a symlink like a mounted checkout
+    def make_root(self, name):
+        root = os.path.join(self.dir, name)
+        os.makedirs(os.path.join(root, 'src'))
+        with open(os.path.join(root, 'compile_commands.json'), 'w') as f:
+            f.write('[]')
+        for file_name, content in [('src/a.cpp', '#include "a.h"\n'), ('src/a.h', 'int a();\n')]:
+            with open(os.path.join(root, file_name), 'w') as f:
+                f.write(content)
+        os.symlink(root, os.path.join(self.dir, name + '-link'))
+        return root
+
+    def index(self, root):
+        conn = indexer.LevelDB(project.get_index_db_path(root))
+        source = root + '/src/a.cpp'
+        header = root + '/src/a.h'
+        conn.Put('f%%%' + source, str(project.get_file_modtime(source)))
+        conn.Put('f%%%' + header, str(project.get_file_modtime(header)))
+        conn.Put('h%%%' + header, source)
+        conn.Put('F%%%a.h%%%' + header, '1')
+        conn.Put('s%%%c:@F@a%%%' + header + '%%%1%%%5', '-8')
+        conn.Put('s%%%c:@F@printf%%%/usr/include/stdio.h%%%3%%%5', '8')
+        return conn
+
+    def items(self, root):
+        conn = indexer.LevelDB(project.get_index_db_path(root), create_if_missing=False)
+        return dict(conn.RangeIter(None, None, include_value=True))
+
+    def testImportRebasesOntoTheOtherRoot(self):
+        conn = self.index(self.ci_root)
+        del conn
+        with open(os.path.join(self.local_root, 'src/a.cpp'), 'a') as f:
+            f.write('// changed locally\n')
+
+        exported = snapshot.export_snapshot(os.path.join(self.dir, 'ci-link'), self.snapshot_path)
+        self.assertEqual(exported['root'], self.ci_root)
+        self.assertEqual(exported['files'], 2)
+
+        imported = snapshot.import_snapshot(os.path.join(self.dir, 'local-link', 'src'), self.snapshot_path)
+        self.assertEqual(imported['root'], self.local_root)
+        self.assertEqual(imported['exported_root'], self.ci_root)
+        self.assertEqual(imported['files_up_to_date'], 1)
+        self.assertEqual(imported['files_to_reindex'], 1)
+
+        source = self.local_root + '/src/a.cpp'
+        header = self.local_root + '/src/a.h'
+        self.assertEqual(self.items(self.local_root), {
+            'f%%%' + source: '0',
+            'f%%%' + header: str(project.get_file_modtime(header)),
+            'h%%%' + header: source,
+            'F%%%a.h%%%' + header: '1',
+            's%%%c:@F@a%%%' + header + '%%%1%%%5': '-8',
+            's%%%c:@F@printf%%%/usr/include/stdio.h%%%3%%%5': '8',
+        })
+
+    def testPathsUnderTheGivenRootAreRelativeToo(self):
+        conn = self.index(self.ci_root)
+        link = os.path.join(self.dir, 'ci-link')
+        conn.Put('f%%%' + link + '/src/a.cpp', '1')
+        del conn
+
+        snapshot.export_snapshot(link, self.snapshot_path)
+        snapshot.import_snapshot(self.local_root, self.snapshot_path)
+        keys = self.items(self.local_root).keys()
+        self.assertIn('f%%%' + self.local_root + '/src/a.cpp', keys)
+        self.assertFalse([key for key in keys if self.dir + '/ci' in key])
+
+    def testRejectsOtherFiles(self):
+        with open(self.snapshot_path, 'wb') as f:
+            f.write('not a snapshot')
+        self.assertRaises(Exception, snapshot.import_snapshot, self.local_root, self.snapshot_path)
+        self.assertFalse(os.path.exists(project.get_index_db_path(self.local_root) + '.import'))
+
+if __name__ == '__main__':
+    unittest.main()